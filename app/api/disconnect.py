@@ -0,0 +1,30 @@
+import asyncio
+from typing import Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+
+def watch_disconnect(
+    receive: Callable[[], Awaitable[dict]], task: asyncio.Task
+) -> asyncio.Task:
+    # 后台等待客户端断开，断开时取消 task，取消会一路传递到攒批和推理队列；
+    # 只能在请求体 / 所需消息读取完毕后使用，调用方结束时需取消返回的 watcher
+    async def watch():
+        while True:
+            message = await receive()
+            if message["type"] in ("http.disconnect", "websocket.disconnect"):
+                task.cancel()
+                return
+
+    return asyncio.create_task(watch())
+
+
+async def cancel_on_disconnect(
+    receive: Callable[[], Awaitable[dict]], coro: Awaitable[T]
+) -> T:
+    task = asyncio.ensure_future(coro)
+    watcher = watch_disconnect(receive, task)
+    try:
+        return await task
+    finally:
+        watcher.cancel()
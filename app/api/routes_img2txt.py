@@ -5,32 +5,57 @@ from fastapi import (
     Depends,
     Form,
     File,
+    Query,
     UploadFile,
     WebSocket,
 )
-from starlette.requests import HTTPConnection
-from app.service.img2txt_service import Img2TxtService
-import tempfile
-import mimetypes
+from fastapi.responses import StreamingResponse
+from starlette.requests import HTTPConnection, Request
+from app.api.disconnect import cancel_on_disconnect, watch_disconnect
+from app.models.admission import Overloaded
+from app.models.bucket_planner import InputTooLarge
+from app.models.infer_queue import DeadlineExceeded
+from PIL import UnidentifiedImageError
+from contextlib import aclosing
+import asyncio
 import traceback
+from typing import TYPE_CHECKING, Literal
+import json
+
+# 服务模块会导入 torch / diffusers / transformers，只在类型检查时导入，
+# 由后台加载任务在真正构造服务时再导入
+if TYPE_CHECKING:
+    from app.service.img2txt_service import Img2TxtService
 
 router = APIRouter(prefix="/img2txt", tags=["Image-to-Text"])
 
+Priority = Literal["high", "normal", "best_effort"]
+
 
 class Img2TxtResponse(BaseModel):
     text: str
 
 
-def get_img2txt_service(request: HTTPConnection) -> Img2TxtService | None:
+def get_img2txt_service(request: HTTPConnection) -> "Img2TxtService | None":
     return request.app.state.services.get("img2txt")
 
 
-@router.post("/generate", response_model=Img2TxtResponse)
-async def generate_text(
-    prompt: str = Form(...),
-    image: UploadFile = File(...),
-    service: Img2TxtService | None = Depends(get_img2txt_service),
-):
+def _check_max_new_tokens(
+    service: "Img2TxtService", max_new_tokens: int | None
+) -> str | None:
+    # 返回错误信息，合法（或未指定）时返回 None
+    limit = service.max_new_tokens_limit
+    if max_new_tokens is not None and not 1 <= max_new_tokens <= limit:
+        return f"max_new_tokens must be between 1 and {limit}"
+    return None
+
+
+def _validate_request(
+    service: "Img2TxtService | None",
+    prompt: str,
+    image: UploadFile,
+    max_new_tokens: int | None = None,
+) -> str:
     if service is None:
         raise HTTPException(status_code=503, detail="Service not initialized")
 
@@ -39,50 +64,176 @@ async def generate_text(
         raise HTTPException(status_code=400, detail="Prompt cannot be empty")
     if not (image.content_type and image.content_type.startswith("image/")):
         raise HTTPException(status_code=400, detail="Uploaded file is not an image")
+    error = _check_max_new_tokens(service, max_new_tokens)
+    if error is not None:
+        raise HTTPException(status_code=400, detail=error)
+    return prompt
+
+
+def _overloaded(e: Overloaded) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=f"Service overloaded: {e}",
+        headers={"Retry-After": str(e.retry_after_s)},
+    )
+
 
-    suffix = mimetypes.guess_extension(image.content_type) or ".png"
+def _sse_event(data: dict, event: str | None = None) -> str:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post("/generate", response_model=Img2TxtResponse)
+async def generate_text(
+    request: Request,
+    prompt: str = Form(...),
+    image: UploadFile = File(...),
+    # 不传时使用服务默认值
+    max_new_tokens: int | None = Form(None),
+    # 推理队列中的优先级与本请求的截止时间（毫秒），不传时为 normal 与服务默认值
+    priority: Priority | None = Form(None),
+    timeout_ms: int | None = Form(None, gt=0),
+    service: "Img2TxtService | None" = Depends(get_img2txt_service),
+):
+    prompt = _validate_request(service, prompt, image, max_new_tokens)
 
     try:
-        with tempfile.NamedTemporaryFile(suffix=suffix, delete=True) as tmp_file:
-            tmp_file.write(await image.read())
-            tmp_file.flush()
-            text = await service.queued_generate(tmp_file.name, prompt)
+        # 执行到这里时 FastAPI 已把上传内容解析到临时文件，准入检查省不掉上传本身；
+        # 过载时在把图片读入内存、解码与预处理之前拒绝
+        service.admission.check()
+        image_bytes = await image.read()
+        # 客户端中途断开时取消生成，未 flush 的请求会从批次中移出
+        text = await cancel_on_disconnect(
+            request.receive,
+            service.queued_generate(
+                image_bytes,
+                prompt,
+                max_new_tokens=max_new_tokens,
+                priority=priority,
+                timeout_ms=timeout_ms,
+            ),
+        )
+    except Overloaded as e:
+        raise _overloaded(e)
+    except UnidentifiedImageError:
+        raise HTTPException(status_code=400, detail="Uploaded file is not an image")
+    except InputTooLarge as e:
+        raise HTTPException(status_code=413, detail=f"Image too large: {e}")
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=f"Request deadline exceeded: {e}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Generation failed: {e}")
 
     return Img2TxtResponse(text=text)
 
 
+# 接口规范（Server-Sent Events）
+# 每生成一段文本发送一个 data 事件：{"text": "..."}
+# 生成完毕发送 event: done；生成失败发送 event: error，data 为 {"detail": "..."}
+# 客户端断开时 StreamingResponse 取消生成器，生成随之取消
+@router.post("/stream")
+async def stream_text(
+    prompt: str = Form(...),
+    image: UploadFile = File(...),
+    # 不传时使用服务默认值
+    max_new_tokens: int | None = Form(None),
+    # 推理队列中的优先级与本请求的截止时间（毫秒），不传时为 normal 与服务默认值
+    priority: Priority | None = Form(None),
+    timeout_ms: int | None = Form(None, gt=0),
+    service: "Img2TxtService | None" = Depends(get_img2txt_service),
+):
+    prompt = _validate_request(service, prompt, image, max_new_tokens)
+    try:
+        service.admission.check()
+    except Overloaded as e:
+        raise _overloaded(e)
+    image_bytes = await image.read()
+
+    async def event_stream():
+        try:
+            async for text in service.stream_generate(
+                image_bytes,
+                prompt,
+                max_new_tokens=max_new_tokens,
+                priority=priority,
+                timeout_ms=timeout_ms,
+            ):
+                yield _sse_event({"text": text})
+        except Exception as e:
+            yield _sse_event({"detail": f"Generation failed: {e}"}, "error")
+            return
+        yield _sse_event({}, "done")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # 接口规范
 # 客户端发送图片二进制数据帧
 # 客户端发送文本帧作为 prompt
 # 服务端开始生成文本，过程中可能发送任意数量文本帧表示生成内容
 # 服务端生成完毕直接正常关闭连接
+# 服务过载时以 1013 关闭连接，reason 中给出建议的重试秒数
+# 图片展开后 token 数超过上限时以 1009 关闭连接
+# 客户端提前断开时取消生成
+# 连接参数 max_new_tokens 限制生成长度，priority、timeout_ms 与 HTTP 接口的请求字段
+# 含义相同，不合法时以 1008 关闭连接
 @router.websocket("/ws/generate")
 async def websocket_generate_text(
-    ws: WebSocket, service: Img2TxtService | None = Depends(get_img2txt_service)
+    ws: WebSocket,
+    max_new_tokens: int | None = None,
+    priority: Priority | None = None,
+    timeout_ms: int | None = Query(None, gt=0),
+    service: "Img2TxtService | None" = Depends(get_img2txt_service),
 ):
     await ws.accept()
 
     if service is None:
         await ws.close(code=1011)  # Internal Error: Service not initialized
         return
+    error = _check_max_new_tokens(service, max_new_tokens)
+    if error is not None:
+        await ws.close(code=1008, reason=error)  # Policy Violation
+        return
 
     image_bytes = await ws.receive_bytes()
     prompt = (await ws.receive_text()).strip()
     if not prompt:
         await ws.close(code=1008)  # Policy Violation: Prompt cannot be empty
         return
-    try:
-        with tempfile.NamedTemporaryFile(suffix=".bin", delete=True) as tmp_file:
-            tmp_file.write(image_bytes)
-            tmp_file.flush()
 
-            # TODO: 实现流式输出
-            gen_txt = await service.queued_generate(tmp_file.name, prompt)
+    async def forward():
+        texts = service.stream_generate(
+            image_bytes,
+            prompt,
+            max_new_tokens=max_new_tokens,
+            priority=priority,
+            timeout_ms=timeout_ms,
+        )
+        async with aclosing(texts):
+            async for text in texts:
+                await ws.send_text(text)
 
-            await ws.send_text(gen_txt)
+    try:
+        service.admission.check()
+        task = asyncio.create_task(forward())
+        watcher = watch_disconnect(ws.receive, task)
+        try:
+            await asyncio.wait({task})
+        finally:
+            watcher.cancel()
+            task.cancel()
+        if task.cancelled():
+            return
+        task.result()
         await ws.close()
+    except Overloaded as e:
+        await ws.close(code=1013, reason=f"retry after {e.retry_after_s}s")
+    except InputTooLarge as e:
+        await ws.close(code=1009, reason=str(e))  # Message Too Big
     except Exception as e:
         error_trace = traceback.format_exc()
         await ws.close(code=1011)  # Internal Error: Generation failed
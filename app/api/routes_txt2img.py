@@ -1,17 +1,44 @@
-from fastapi import APIRouter, HTTPException, Depends, WebSocket
-from starlette.requests import HTTPConnection
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel, field_validator
-from app.service.txt2img_service import Txt2ImgService
-from io import BytesIO
+from fastapi import APIRouter, HTTPException, Depends, Query, WebSocket
+from starlette.requests import HTTPConnection, Request
+from fastapi.responses import Response
+from pydantic import BaseModel, Field, field_validator
+from app.api.disconnect import cancel_on_disconnect, watch_disconnect
+from app.config import parse_size
+from app.models.admission import Overloaded
+from app.models.image_codec import MEDIA_TYPES, negotiate
+from app.models.infer_queue import DeadlineExceeded
+from app.models.progress import GenerationProgress
+from typing import TYPE_CHECKING, Literal
 import asyncio
+import json
 import traceback
 
+# 服务模块会导入 torch / diffusers / transformers，只在类型检查时导入，
+# 由后台加载任务在真正构造服务时再导入
+if TYPE_CHECKING:
+    from app.service.txt2img_service import Txt2ImgService
+
 router = APIRouter(prefix="/txt2img", tags=["Text-to-Image"])
 
+Priority = Literal["high", "normal", "best_effort"]
+
 
 class Text2ImgRequest(BaseModel):
     prompt: str
+    # 以下参数不传时使用服务默认值
+    # "宽x高"，须为服务配置的分辨率之一
+    size: str | None = None
+    # 去噪步数（1..服务配置的最大步数）与 classifier-free guidance 强度
+    steps: int | None = None
+    guidance_scale: float | None = None
+    # 固定 seed 时同一请求的结果可复现
+    seed: int | None = None
+    negative_prompt: str | None = None
+    # 输出格式，不传时按 Accept 头协商，都没有时使用服务默认格式
+    format: Literal["png", "webp", "jpeg", "avif"] | None = None
+    # 推理队列中的优先级与本请求的截止时间（毫秒），不传时为 normal 与服务默认值
+    priority: Priority | None = None
+    timeout_ms: int | None = Field(None, gt=0)
 
     @field_validator("prompt")
     def strip_and_validate(cls, v: str) -> str:
@@ -20,69 +47,194 @@ class Text2ImgRequest(BaseModel):
             raise ValueError("Prompt cannot be empty")
         return v
 
+    @field_validator("size")
+    def validate_size(cls, v: str | None) -> str | None:
+        if v is not None:
+            try:
+                parse_size(v)
+            except ValueError:
+                raise ValueError("Size must look like 1024x768")
+        return v
 
-def get_txt2img_service(request: HTTPConnection) -> Txt2ImgService | None:
+
+def resolve_params(
+    service: "Txt2ImgService",
+    size: str | None = None,
+    steps: int | None = None,
+    guidance_scale: float | None = None,
+    seed: int | None = None,
+    negative_prompt: str | None = None,
+    output_format: str | None = None,
+    accept: str | None = None,
+    priority: str | None = None,
+    timeout_ms: int | None = None,
+) -> dict:
+    # 用服务的校验方法检查生成参数并转成 cached_generate 的关键字参数，不合法时
+    # 抛出 ValueError；未指定的参数保持 None，由服务取默认值
+    if size is not None:
+        size = service.check_size(parse_size(size))
+    if steps is not None:
+        service.check_steps(steps)
+    service.check_guidance_scale(guidance_scale)
+    service.check_seed(seed)
+    if negative_prompt is not None:
+        negative_prompt = negative_prompt.strip() or None
+    if output_format is None:
+        output_format = negotiate(accept, service.output_formats)
+    output_format = service.check_format(output_format)
+    return {
+        "size": size,
+        "steps": steps,
+        "guidance_scale": guidance_scale,
+        "seed": seed,
+        "negative_prompt": negative_prompt,
+        "output_format": output_format,
+        "priority": priority,
+        "timeout_ms": timeout_ms,
+    }
+
+
+def get_txt2img_service(request: HTTPConnection) -> "Txt2ImgService | None":
     return request.app.state.services.get("txt2img")
 
 
 @router.post("/generate")
 async def generate_image(
     request_body: Text2ImgRequest,
-    service: Txt2ImgService | None = Depends(get_txt2img_service),
+    request: Request,
+    service: "Txt2ImgService | None" = Depends(get_txt2img_service),
 ):
     if service is None:
         raise HTTPException(status_code=503, detail="Service not initialized")
 
     prompt = request_body.prompt
+    try:
+        params = resolve_params(
+            service,
+            **request_body.model_dump(exclude={"prompt", "format"}),
+            output_format=request_body.format,
+            accept=request.headers.get("accept"),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     try:
-        image = await service.queued_generate(prompt)
+        # 客户端中途断开时取消生成，未 flush 的请求会从批次中移出
+        image_bytes = await cancel_on_disconnect(
+            request.receive, service.cached_generate(prompt, **params)
+        )
+    except Overloaded as e:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Service overloaded: {e}",
+            headers={"Retry-After": str(e.retry_after_s)},
+        )
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=f"Request deadline exceeded: {e}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Generation failed: {e}")
 
-    buffer = BytesIO()
-    image.save(buffer, format="PNG")
-    buffer.seek(0)
-
-    return StreamingResponse(buffer, media_type="image/png")
+    return Response(
+        content=image_bytes,
+        media_type=MEDIA_TYPES[params["output_format"]],
+        headers={"Vary": "Accept"},
+    )
 
 
 # 接口规范
 # 客户端发送文本帧作为 prompt
-# 服务端开始生成图片，过程中每隔1s发送一个文本帧标识完成情况（0-99的数字）
-# 服务端发送 100 表示生成完毕，然后立刻发送png图片的二进制数据，然后关闭连接
+# 服务端开始生成图片，过程中进度变化时（至少每隔1s）发送一个文本帧标识完成情况（0-99的数字，按去噪步数计算）
+# 服务端发送 100 表示生成完毕，然后立刻发送图片的二进制数据，然后关闭连接
+# 图片格式由连接参数 format（png / webp / jpeg / avif）指定，不传时为服务默认格式
+# 服务过载时以 1013 关闭连接，reason 中给出建议的重试秒数
+# 客户端提前断开时取消生成
+# 连接参数 size=宽x高、steps、guidance_scale、seed、negative_prompt、priority、
+# timeout_ms 与 HTTP 接口的请求字段含义相同，不合法时以 1008 关闭连接
+# 连接参数 progress_format=json 时进度帧改为 JSON：
+#   {"phase": "queued" | "denoising" | "decoding" | "done", "step", "total_steps",
+#    "progress": 0-100, "eta_ms", "durations_ms": {各阶段耗时}}
+#   phase 为 done 的帧代替 100，随后发送图片
+# 连接参数 preview_every=N（> 0）时每 N 个去噪步额外发送一个二进制帧：由 latent 线性近似
+# 得到的低分辨率 WebP 预览（输出的 1/8）。完成帧（100 / done）之前的二进制帧都是预览，
+# 之后的一帧是结果；不想要的结果可以看到预览后直接断开，服务端随即取消生成
 @router.websocket("/ws/generate")
 async def websocket_generate_image(
     ws: WebSocket,
-    service: Txt2ImgService | None = Depends(get_txt2img_service),
+    progress_format: Literal["number", "json"] = "number",
+    size: str | None = None,
+    steps: int | None = None,
+    guidance_scale: float | None = None,
+    seed: int | None = None,
+    negative_prompt: str | None = None,
+    output_format: str | None = Query(None, alias="format"),
+    preview_every: int = 0,
+    priority: Priority | None = None,
+    timeout_ms: int | None = Query(None, gt=0),
+    service: "Txt2ImgService | None" = Depends(get_txt2img_service),
 ):
     await ws.accept()
     if service is None:
         await ws.close(code=1011)  # Internal Error: Service not initialized
         return
+    try:
+        params = resolve_params(
+            service,
+            size,
+            steps,
+            guidance_scale,
+            seed,
+            negative_prompt,
+            output_format,
+            priority=priority,
+            timeout_ms=timeout_ms,
+        )
+    except ValueError as e:
+        await ws.close(code=1008, reason=str(e))  # Policy Violation: bad params
+        return
+    if preview_every < 0:
+        await ws.close(code=1008, reason="preview_every must not be negative")
+        return
 
     prompt = (await ws.receive_text()).strip()
     if not prompt:
         await ws.close(code=1008)  # Policy Violation: Prompt cannot be empty
         return
 
+    def progress_frame(progress: GenerationProgress) -> str:
+        if progress_format == "json":
+            return json.dumps(progress.snapshot())
+        return str(progress.percent)
+
+    progress = GenerationProgress(preview_every)
+    gen_task = asyncio.create_task(
+        service.cached_generate(prompt, progress=progress, **params)
+    )
+    watcher = watch_disconnect(ws.receive, gen_task)
+    preview_step = 0
     try:
-        gen_task = asyncio.create_task(service.queued_generate(prompt))
-        progress = 0
         while not gen_task.done():
-            await ws.send_text(str(progress))
-            # TODO: 获取真实进度
-            progress = min(progress + 4, 99)
-            await asyncio.sleep(1)
-
-        image = await gen_task
-        await ws.send_text("100")
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        buffer.seek(0)
-        await ws.send_bytes(buffer.read())
+            await ws.send_text(progress_frame(progress))
+            if progress.preview_step > preview_step:
+                preview_step = progress.preview_step
+                await ws.send_bytes(progress.preview)
+            await progress.wait_changed(timeout=1)
+
+        if gen_task.cancelled():
+            return
+        image_bytes = await gen_task
+        if progress_format == "json":
+            await ws.send_text(progress_frame(progress))
+        else:
+            await ws.send_text("100")
+        await ws.send_bytes(image_bytes)
         await ws.close()
+    except Overloaded as e:
+        await ws.close(code=1013, reason=f"retry after {e.retry_after_s}s")
     except Exception as e:
         error_trace = traceback.format_exc()
         await ws.close(code=1011)  # Internal Error: Generation failed
         print(f"WebSocket generation error: {e}\n{error_trace}")
+    finally:
+        watcher.cancel()
+        if not gen_task.done():
+            gen_task.cancel()
@@ -1,16 +1,143 @@
 from pydantic_settings import BaseSettings
 
 
+def parse_size(value: str) -> tuple[int, int]:
+    # "1024x768" -> (1024, 768)
+    width, _, height = value.strip().lower().partition("x")
+    return int(width), int(height)
+
+
 class Settings(BaseSettings):
-    service_mode: str = "txt2img"  # or "img2txt"
+    service_mode: str = "txt2img"  # or "img2txt" / "all"
     hf_home: str = "./models"
     txt2img_model: str = "Tencent-Hunyuan/HunyuanDiT-v1.2-Diffusers"
     img2txt_model: str = "Qwen/Qwen2.5-VL-3B-Instruct"
 
+    # 攒批策略："fixed" 固定等待 max_wait_ms；"arrival_rate" 按到达率估计，
+    # 预计在 max_wait_ms 内攒不满批时立即 flush
+    batch_policy: str = "arrival_rate"
+    # 请求截止时间（秒，0 表示不限）；到达 GPU 前已过期的请求 "drop" 直接失败，
+    # "demote" 降到最低优先级空闲时再执行
+    request_timeout_s: float = 0
+    expired_policy: str = "drop"
+    # 推理队列中各 flow 的加权公平份额（默认均为 1），如 {"bucket-2": 2}：
+    # img2txt 的分桶为 bucket-0、bucket-1 ...，txt2img 为 txt2img；
+    # 请求还可以指定 priority（high / normal / best_effort）与更短的 timeout_ms
+    infer_flow_weights: dict[str, float] = {}
+    # 准入控制：已接收未完成的请求数上限，以及按最近批次耗时估计的排队时间上限（秒）；
+    # 超限时 HTTP 返回 429 + Retry-After，WebSocket 以 1013 关闭
+    txt2img_admission_max_queued: int = 64
+    txt2img_admission_max_queue_time_s: float = 300
+    img2txt_admission_max_queued: int = 256
+    img2txt_admission_max_queue_time_s: float = 60
+
+    # 模型加载后先跑一次推理（触发编译与 CUDA 初始化），完成后 /readyz 才返回就绪
+    warmup: bool = True
+
+    # service_mode="all" 时两个模型共用设备：首次请求时才加载，按 LRU 在显存预算内
+    # 驻留（0 不限）；空闲超过 idle_timeout_s（0 不处理）的模型 "offload" 到主机内存
+    # 或 "unload" 卸载。特征 / prompt 缓存的显存层按上限从预算中扣除
+    residency_device_budget_mb: int = 0
+    residency_idle_timeout_s: float = 600
+    residency_idle_action: str = "offload"
+
+    # 多进程模式：设置后本进程只作为前端，请求经 unix socket 转发给持有模型的
+    # 工作进程（python -m app.model_worker，每个设备一个），攒批集中在工作进程中
+    model_worker_sockets: list[str] = []
+    model_worker_connect_timeout_s: float = 600
+
     txt2img_batch_size: int = 2
+    # 可选分辨率（宽x高），第一个为默认值；每种分辨率单独攒批与预热，
+    # 推理开销约与像素数成正比（512x512 约为 1024x1024 的四分之一）
+    txt2img_sizes: list[str] = [
+        "1024x1024",
+        "1280x768",
+        "768x1280",
+        "1024x768",
+        "768x1024",
+        "512x512",
+    ]
+    # 请求未指定时的去噪步数与 guidance_scale，以及请求可指定的最大步数；
+    # 分辨率、步数与 guidance 相同的请求才会拼成一批，seed / negative prompt 可以混批
     txt2img_infer_steps: int = 50
+    txt2img_guidance_scale: float = 5.0
+    txt2img_max_infer_steps: int = 100
+    # step 级批处理：自定义去噪循环，每个 step 边界都可加入新请求、移出已完成的请求，
+    # 步数与 guidance 不同的请求也可同批；替代上面按批 flush 的攒批
+    txt2img_continuous_batching: bool = False
+    txt2img_max_running: int = 8
+    # 文本编码器输出缓存（CLIP 与 mT5 的 embedding、attention mask），按文本索引：
+    # 显存层上限（0 关闭），淘汰后转存的主机内存层上限
+    txt2img_prompt_cache_device_mb: int = 256
+    txt2img_prompt_cache_host_mb: int = 1024
+    # transformer 的 torch.compile 模式（空字符串不编译）；预热的批大小（空表示
+    # 1..batch_size）与每次预热的步数
+    txt2img_compile_mode: str = "max-autotune"
+    txt2img_warmup_batch_sizes: list[int] = []
+    txt2img_warmup_steps: int = 2
+    # torch.compile / autotune 产物的持久化目录（空表示使用 torch 默认临时目录），
+    # 挂载到持久卷后重启不再重新编译
+    compile_cache_dir: str = ""
     txt2img_max_wait_ms: int = 5 * 1000
+    # 生成结果缓存：内存 LRU（0 关闭）+ 可选磁盘层（设置目录后开启，重启后保留）
+    txt2img_cache_memory_mb: int = 256
+    txt2img_cache_dir: str = ""
+    txt2img_cache_disk_mb: int = 4096
+    # 未指定 seed 的请求是否也读写缓存：开启时重复的 prompt（如模板 prompt）直接返回
+    # 第一次生成的图片，代价是相同参数的请求不再得到新的随机结果；关闭时每次重新生成
+    txt2img_cache_unseeded: bool = True
+    # 输出编码：请求未指定格式且 Accept 头未选中可用格式时的默认格式；各格式的质量
+    # （PNG 为 zlib 压缩级别 0-9，其余为 0-100）；编码进程数（0 表示单个专用线程）
+    txt2img_output_format: str = "png"
+    txt2img_png_compress_level: int = 6
+    txt2img_webp_quality: int = 90
+    txt2img_jpeg_quality: int = 90
+    txt2img_avif_quality: int = 75
+    txt2img_encode_workers: int = 2
     img2txt_max_wait_ms: int = 5 * 1000
+    # 请求未指定时的 max_new_tokens 与请求可指定的上限；不同取值的请求可以混批
+    img2txt_max_new_tokens: int = 100
+    img2txt_max_new_tokens_limit: int = 1024
+    # 迭代级批处理：每个 decode step 都可加入/移出请求，替代分桶攒批
+    img2txt_continuous_batching: bool = False
+    img2txt_max_running: int = 16
+    # 结果缓存：按图片内容哈希 + prompt + 生成参数，内存上限（0 关闭）与过期时间
+    img2txt_cache_memory_mb: int = 64
+    img2txt_cache_ttl_s: int = 3600
+    # 使用感知哈希，缩放/重新编码后的同一张图片也能命中
+    img2txt_cache_perceptual: bool = False
+    # 视觉编码器特征缓存：显存层上限（0 关闭），淘汰后转存的主机内存层上限
+    img2txt_feature_cache_device_mb: int = 1024
+    img2txt_feature_cache_host_mb: int = 4096
+    # 图片解码与预处理进程数（0 表示在单个专用线程中执行）
+    img2txt_preprocess_workers: int = 2
+    # 分桶：按视觉 token + 文本 token 数路由，批大小 = token 预算 // 桶上界；
+    # 每 refit_every 个请求按观测到的大小分布重新划分边界，填充浪费不超过 max_waste
+    img2txt_bucket_edges: list[int] = [1536, 6144, 24576]
+    img2txt_batch_token_budget: int = 49152
+    img2txt_bucket_max_waste: float = 0.2
+    img2txt_bucket_refit_every: int = 256
+
+    @property
+    def txt2img_size_list(self) -> list[tuple[int, int]]:
+        return [parse_size(size) for size in self.txt2img_sizes]
+
+    @property
+    def txt2img_output_qualities(self) -> dict[str, int]:
+        # 格式 -> 质量，默认格式在前
+        qualities = {
+            "png": self.txt2img_png_compress_level,
+            "webp": self.txt2img_webp_quality,
+            "jpeg": self.txt2img_jpeg_quality,
+            "avif": self.txt2img_avif_quality,
+        }
+        default = self.txt2img_output_format.strip().lower()
+        if default not in qualities:
+            raise ValueError(
+                f"Unsupported TXT2IMG_OUTPUT_FORMAT {self.txt2img_output_format!r}, "
+                f"use one of {', '.join(qualities)}"
+            )
+        return {default: qualities[default], **qualities}
 
 
 settings = Settings()
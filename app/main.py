@@ -1,45 +1,74 @@
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
-from app.config import settings
-from contextlib import asynccontextmanager
-from pathlib import Path
-from fastapi.middleware.cors import CORSMiddleware
+import time
+
+# 在其它导入之前开始计时，记录本模块导入 fastapi 等依赖的耗时
+_import_start = time.monotonic()
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse  # noqa: E402
+from app.config import settings  # noqa: E402
+from app.models.startup import StartupTracker  # noqa: E402
+from contextlib import asynccontextmanager  # noqa: E402
+from pathlib import Path  # noqa: E402
+from fastapi.middleware.cors import CORSMiddleware  # noqa: E402
+import asyncio  # noqa: E402
+import traceback  # noqa: E402
+
+# 本模块只导入轻量依赖；torch / diffusers / transformers 由后台加载任务导入
+startup = StartupTracker()
+
+
+async def _load_services(app: FastAPI) -> None:
+    # 在后台构造（或连接）模型服务；完成前路由返回 503，/readyz 返回未就绪
+    from app.service.builder import service_names
+
+    try:
+        names = service_names(settings.service_mode)
+        if settings.model_worker_sockets:
+            # 多进程模式：模型在独立的工作进程中，本进程只处理 HTTP / WebSocket
+            from app.service.remote import connect_remote_services
+
+            with startup.phase("connect_workers"):
+                services = await connect_remote_services(
+                    names,
+                    settings.model_worker_sockets,
+                    settings.model_worker_connect_timeout_s,
+                )
+        else:
+            from app.service.builder import build_services
+
+            services = await build_services(
+                settings.service_mode, startup, settings.warmup
+            )
+        app.state.services.update(services)
+        startup.mark_ready()
+        print(f"Service ready: {startup.stats()}")
+    except Exception as e:
+        startup.fail(e)
+        print(f"Service startup failed: {e}\n{traceback.format_exc()}")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # 启动
+    # 启动：立即开始接受连接，模型在后台加载
     app.state.services = {}
     app.state.html = {}
-    if settings.service_mode == "txt2img":
-        from app.service.txt2img_service import Txt2ImgService
-
-        service = await Txt2ImgService.build(
-            model=settings.hf_home + "/" + settings.txt2img_model,
-            batch_size=settings.txt2img_batch_size,
-            num_inference_steps=settings.txt2img_infer_steps,
-            max_wait_ms=settings.txt2img_max_wait_ms,
-        )
-        app.state.services["txt2img"] = service
-    elif settings.service_mode == "img2txt":
-        from app.service.img2txt_service import Img2TxtService
-
-        service = await Img2TxtService.build(
-            model=settings.hf_home + "/" + settings.img2txt_model,
-            max_new_tokens=100,
-            max_wait_ms=settings.img2txt_max_wait_ms,
-        )
-        app.state.services["img2txt"] = service
-
     txt2img_html = Path("app/static/txt2img_test.html").read_text(encoding="utf-8")
     img2txt_html = Path("app/static/img2txt_test.html").read_text(encoding="utf-8")
 
     app.state.html["txt2img"] = txt2img_html
     app.state.html["img2txt"] = img2txt_html
 
+    load_task = asyncio.create_task(_load_services(app))
+
     yield
 
     # 关闭
+    load_task.cancel()
+    for service in app.state.services.values():
+        if hasattr(service, "shutdown"):
+            service.shutdown()
+        if getattr(service, "residency", None) is not None:
+            service.residency.stop()
 
 
 app = FastAPI(title="vision-service", version="0.1", lifespan=lifespan)
@@ -53,25 +82,74 @@ app.add_middleware(
 )
 
 
-# 选择服务模式
-if settings.service_mode == "txt2img":
-    from app.api.routes_txt2img import router as service_router
+# 选择服务模式；"all" 时同时注册两组路由
+if settings.service_mode in ("txt2img", "all"):
+    from app.api.routes_txt2img import router as txt2img_router
+
+    app.include_router(txt2img_router)
 
     @app.get("/static/txt2img/page", include_in_schema=False)
     async def txt2img_page():
         return HTMLResponse(app.state.html["txt2img"])
-elif settings.service_mode == "img2txt":
-    from app.api.routes_img2txt import router as service_router
+
+
+if settings.service_mode in ("img2txt", "all"):
+    from app.api.routes_img2txt import router as img2txt_router
+
+    app.include_router(img2txt_router)
 
     @app.get("/static/img2txt/page", include_in_schema=False)
     async def img2txt_page():
         return HTMLResponse(app.state.html["img2txt"])
-else:
-    raise ValueError(f"Unsupported service mode: {settings.service_mode}")
 
-app.include_router(service_router)
+
+if settings.service_mode not in ("txt2img", "img2txt", "all"):
+    raise ValueError(f"Unsupported service mode: {settings.service_mode}")
 
 
 @app.get("/")
 async def root():
-    return {"service_mode": settings.service_mode, "status": "running"}
+    return {
+        "service_mode": settings.service_mode,
+        "status": "running" if startup.ready else "starting",
+    }
+
+
+# 存活探针：进程在运行即可；后台加载失败时返回 500，交给编排系统重启
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    if startup.error is not None:
+        return JSONResponse({"status": "failed", "error": startup.error}, 500)
+    return {"status": "alive"}
+
+
+# 就绪探针：模型加载并预热完成后返回 200，之前返回 503 与当前阶段
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    return JSONResponse(startup.stats(), 200 if startup.ready else 503)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    from app.models.metrics import REGISTRY
+
+    text = REGISTRY.render()
+    # 多进程模式下推理相关指标在模型工作进程中
+    for service in app.state.services.values():
+        if hasattr(service, "render_metrics"):
+            text = await service.render_metrics()
+            break
+    return PlainTextResponse(
+        text, media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+# 负载均衡器据此把流量从繁忙的副本上移走
+@app.get("/load")
+async def load():
+    return {
+        name: service.admission.stats() for name, service in app.state.services.items()
+    }
+
+
+startup.record("import:app", time.monotonic() - _import_start)
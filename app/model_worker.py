@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import base64
+import os
+import traceback
+from contextlib import aclosing
+
+from PIL import UnidentifiedImageError
+
+from app.models.admission import Overloaded
+from app.models.bucket_planner import InputTooLarge
+from app.models.infer_queue import DeadlineExceeded
+from app.models.ipc import (
+    read_message,
+    release_bytes,
+    send_message,
+    share_bytes,
+    take_bytes,
+)
+from app.models.progress import GenerationProgress
+
+# 模型工作进程：持有模型与全部攒批 / 推理队列 / 准入控制状态，
+# 通过 unix socket 为多个前端进程（uvicorn workers）服务。
+# 每个连接上的请求按 id 多路复用，各自在独立任务中执行，取消时撤回攒批名额
+#
+# 前端 -> 工作进程：
+#   {"id", "op": "txt2img", "prompt", "progress": bool, "size": [w, h] | null,
+#    "steps", "guidance_scale", "seed", "negative_prompt", "output_format",
+#    "preview_every", "priority", "timeout_ms"}（可选参数为 null 时取默认值）
+#   {"id", "op": "img2txt" | "img2txt_stream", "prompt", "image": 共享内存句柄,
+#    "max_new_tokens", "priority", "timeout_ms"}
+#   {"id", "op": "cancel"}，{"id", "op": "load", "service"}，{"id", "op": "metrics"}
+# 工作进程 -> 前端：
+#   {"id", "type": "progress", "phase", "step", "total_steps"}，
+#   有新的预览时附带 "preview_step" 与 "preview"（base64 编码的 WebP）
+#   {"id", "type": "chunk", "text"}（流式输出）
+#   {"id", "type": "result", "image": 共享内存句柄 | "text" | "load" | "metrics"}
+#   {"id", "type": "error", "kind": "overloaded" | "deadline" | "bad_image" |
+#    "too_large" | "error"}
+
+
+def _error_message(e: Exception) -> dict:
+    if isinstance(e, Overloaded):
+        return {
+            "kind": "overloaded",
+            "reason": e.reason,
+            "retry_after_s": e.retry_after_s,
+        }
+    if isinstance(e, DeadlineExceeded):
+        return {"kind": "deadline", "reason": e.reason, "waited_s": e.waited_s}
+    if isinstance(e, UnidentifiedImageError):
+        return {"kind": "bad_image", "message": str(e)}
+    if isinstance(e, InputTooLarge):
+        return {"kind": "too_large", "tokens": e.tokens, "max_tokens": e.max_tokens}
+    return {"kind": "error", "message": str(e)}
+
+
+class _Connection:
+    def __init__(self, worker: "ModelWorker", writer: asyncio.StreamWriter):
+        self.worker: ModelWorker = worker
+        self.writer: asyncio.StreamWriter = writer
+        self._send_lock: asyncio.Lock = asyncio.Lock()
+        self.tasks: dict[int, asyncio.Task] = {}
+
+    async def send(self, message: dict) -> None:
+        async with self._send_lock:
+            await send_message(self.writer, message)
+
+    async def _send_progress(
+        self, id: int, progress: GenerationProgress, preview_step: int = 0
+    ) -> int:
+        # 只在预览比 preview_step 新时附带，返回已发送的预览步数
+        message = {
+            "id": id,
+            "type": "progress",
+            "phase": progress.phase,
+            "step": progress.step,
+            "total_steps": progress.total_steps,
+        }
+        if progress.preview_step > preview_step:
+            message["preview_step"] = progress.preview_step
+            message["preview"] = base64.b64encode(progress.preview).decode("ascii")
+        await self.send(message)
+        return max(preview_step, progress.preview_step)
+
+    async def _forward_progress(self, id: int, progress: GenerationProgress) -> None:
+        preview_step = 0
+        while True:
+            await progress.wait_changed(timeout=1)
+            preview_step = await self._send_progress(id, progress, preview_step)
+
+    async def _txt2img(self, id: int, message: dict) -> dict:
+        progress = None
+        if message.get("progress"):
+            progress = GenerationProgress(message.get("preview_every") or 0)
+        forward = None
+        if progress is not None:
+            forward = asyncio.create_task(self._forward_progress(id, progress))
+        try:
+            size = message.get("size")
+            data = await self.worker.services["txt2img"].cached_generate(
+                message["prompt"],
+                progress,
+                tuple(size) if size else None,
+                steps=message.get("steps"),
+                guidance_scale=message.get("guidance_scale"),
+                seed=message.get("seed"),
+                negative_prompt=message.get("negative_prompt"),
+                output_format=message.get("output_format"),
+                priority=message.get("priority"),
+                timeout_ms=message.get("timeout_ms"),
+            )
+        finally:
+            if forward is not None:
+                forward.cancel()
+        if progress is not None:
+            # report 经 call_soon 生效，让出一次后发送最终状态
+            await asyncio.sleep(0)
+            await self._send_progress(id, progress)
+        return {"image": share_bytes(data)}
+
+    async def _img2txt(self, id: int, message: dict) -> dict:
+        service = self.worker.services["img2txt"]
+        image = message["image_bytes"]
+        params = {
+            "max_new_tokens": message.get("max_new_tokens"),
+            "priority": message.get("priority"),
+            "timeout_ms": message.get("timeout_ms"),
+        }
+        if message["op"] == "img2txt":
+            text = await service.queued_generate(image, message["prompt"], **params)
+            return {"text": text}
+        stream = service.stream_generate(image, message["prompt"], **params)
+        async with aclosing(stream) as texts:
+            async for text in texts:
+                await self.send({"id": id, "type": "chunk", "text": text})
+        return {}
+
+    async def handle(self, message: dict) -> None:
+        id = message["id"]
+        try:
+            op = message["op"]
+            if op == "txt2img":
+                result = await self._txt2img(id, message)
+            elif op in ("img2txt", "img2txt_stream"):
+                result = await self._img2txt(id, message)
+            elif op == "load":
+                service = self.worker.services[message["service"]]
+                result = {"load": service.admission.stats()}
+            elif op == "metrics":
+                from app.models.metrics import REGISTRY
+
+                result = {"metrics": REGISTRY.render()}
+            else:
+                raise ValueError(f"Unsupported op: {op}")
+        except Exception as e:
+            if not isinstance(e, (Overloaded, DeadlineExceeded)):
+                traceback.print_exc()
+            await self.send({"id": id, "type": "error", **_error_message(e)})
+        else:
+            try:
+                await self.send({"id": id, "type": "result", **result})
+            except ConnectionError:
+                # 前端已断开，结果无人读取
+                if "image" in result:
+                    release_bytes(result["image"])
+
+    def dispatch(self, message: dict) -> None:
+        if message["op"] == "cancel":
+            task = self.tasks.get(message["id"])
+            if task is not None:
+                task.cancel()
+            return
+        if "image" in message:
+            # 收到即取出，任务开始前被取消也不会遗留共享内存
+            message["image_bytes"] = take_bytes(message.pop("image"))
+        id = message["id"]
+        task = asyncio.create_task(self.handle(message))
+        task.add_done_callback(lambda _: self.tasks.pop(id, None))
+        self.tasks[id] = task
+
+    def close(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+
+
+class ModelWorker:
+    def __init__(self, services: dict):
+        # 服务名 -> 服务，service_mode="all" 时同时包含 txt2img 与 img2txt
+        self.services: dict = services
+
+    async def _serve_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        connection = _Connection(self, writer)
+        try:
+            while (message := await read_message(reader)) is not None:
+                connection.dispatch(message)
+        finally:
+            # 前端进程退出时撤回它的全部请求
+            connection.close()
+            writer.close()
+
+    async def serve(self, path: str) -> None:
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(self._serve_connection, path)
+        async with server:
+            await server.serve_forever()
+
+
+async def main(mode: str, path: str) -> None:
+    from app.config import settings
+    from app.models.startup import StartupTracker
+    from app.service.builder import build_services
+
+    startup = StartupTracker()
+    services = await build_services(mode, startup, settings.warmup)
+    startup.mark_ready()
+    print(f"Model worker ready: {startup.stats()}")
+    # 加载与预热完成后才开始监听，前端连接成功即表示工作进程就绪
+    try:
+        await ModelWorker(services).serve(path)
+    finally:
+        for service in services.values():
+            if hasattr(service, "shutdown"):
+                service.shutdown()
+
+
+if __name__ == "__main__":
+    from app.config import settings
+
+    parser = argparse.ArgumentParser(description="Model worker for multi-process mode")
+    parser.add_argument("--socket", required=True)
+    parser.add_argument("--mode", default=settings.service_mode)
+    args = parser.parse_args()
+    asyncio.run(main(args.mode, args.socket))
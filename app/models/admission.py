@@ -0,0 +1,106 @@
+import math
+import threading
+from contextlib import contextmanager
+
+from app.models.metrics import (
+    ADMISSION_ESTIMATE,
+    ADMISSION_IN_FLIGHT,
+    ADMISSION_REJECTED,
+)
+
+
+class Overloaded(Exception):
+    def __init__(self, reason: str, retry_after_s: int):
+        super().__init__(f"{reason}, retry after {retry_after_s}s")
+        self.reason: str = reason
+        self.retry_after_s: int = retry_after_s
+
+
+class AdmissionController:
+    # 限制已接收但未完成的请求数，并用最近批次耗时（EWMA）估计新请求的完成时间：
+    #   估计 = 一个批的耗时 + 已在排队的请求数 × 单个请求的平均耗时（没有排队请求时为 0）
+    # 超过上限时立即拒绝（Overloaded），而不是让请求无限排队
+    def __init__(
+        self,
+        max_queued: int,
+        max_queue_time_s: float,
+        alpha: float = 0.2,
+        name: str = "default",
+    ):
+        self.name: str = name
+        self.max_queued: int = max_queued
+        self.max_queue_time_s: float = max_queue_time_s
+        self._alpha: float = alpha
+        self._lock: threading.Lock = threading.Lock()
+        self.in_flight: int = 0
+        self.batch_s: float | None = None
+        self.per_request_s: float | None = None
+        self.rejected: int = 0
+
+    def observe_batch(self, duration_s: float, size: int) -> None:
+        # 可在推理线程中调用
+        with self._lock:
+            per_request = duration_s / max(1, size)
+            if self.batch_s is None:
+                self.batch_s, self.per_request_s = duration_s, per_request
+            else:
+                self.batch_s += self._alpha * (duration_s - self.batch_s)
+                self.per_request_s += self._alpha * (per_request - self.per_request_s)
+
+    def estimate_s(self) -> float:
+        # 还没有观测数据时返回 0，只按排队数限制；
+        # 空闲时新请求直接开始执行，不计批耗时，否则一个超长批会让空闲的服务一直拒绝请求
+        if self.batch_s is None or self.in_flight == 0:
+            return 0.0
+        return self.batch_s + self.in_flight * self.per_request_s
+
+    def check(self) -> None:
+        # 判断现在是否会接收一个新请求，不占用名额
+        if self.in_flight >= self.max_queued:
+            self._reject()
+            excess = self.in_flight - self.max_queued + 1
+            raise Overloaded(
+                "too many queued requests",
+                self._retry_after((self.per_request_s or 1.0) * excess),
+            )
+        estimate = self.estimate_s()
+        if estimate > self.max_queue_time_s:
+            self._reject()
+            raise Overloaded(
+                "estimated queue time too long",
+                self._retry_after(estimate - self.max_queue_time_s),
+            )
+
+    def _reject(self) -> None:
+        self.rejected += 1
+        ADMISSION_REJECTED.inc(service=self.name)
+
+    def _report(self) -> None:
+        ADMISSION_IN_FLIGHT.set(self.in_flight, service=self.name)
+        ADMISSION_ESTIMATE.set(self.estimate_s(), service=self.name)
+
+    @staticmethod
+    def _retry_after(seconds: float) -> int:
+        return max(1, math.ceil(seconds))
+
+    @contextmanager
+    def admit(self):
+        self.check()
+        self.in_flight += 1
+        self._report()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._report()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_queued": self.max_queued,
+            "estimated_ms": round(self.estimate_s() * 1000),
+            "max_queue_time_ms": round(self.max_queue_time_s * 1000),
+            "accepting": self.in_flight < self.max_queued
+            and self.estimate_s() <= self.max_queue_time_s,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,73 @@
+import time
+from typing import Protocol
+
+
+class BatchPolicy(Protocol):
+    # 决定一个未满的批还要再等多久；每个攒批队列（分桶）各自持有一个实例
+    def on_arrival(self) -> None:
+        # 每个请求加入攒批时调用
+        ...
+
+    def wait_s(self, pending: int, batch_size: int, waited_s: float) -> float:
+        # 返回再等待的秒数，<= 0 表示立即 flush
+        ...
+
+
+class FixedWindowPolicy:
+    # 第一个请求到达后固定等待 max_wait_ms
+    def __init__(self, max_wait_ms: int):
+        self.max_wait_s: float = max_wait_ms / 1000.0
+
+    def on_arrival(self) -> None:
+        pass
+
+    def wait_s(self, pending: int, batch_size: int, waited_s: float) -> float:
+        return self.max_wait_s - waited_s
+
+
+class ArrivalRatePolicy:
+    # 用 EWMA 估计请求到达间隔；预计在 max_wait_ms 内攒不满批时立即 flush，
+    # 否则等到下一个请求的预计到达时间再重新判断。
+    # 超过 max_wait_ms 的间隔视为空闲，不计入估计而是重新开始统计，
+    # 否则空闲后的高峰要等 EWMA 慢慢降下来，开头的一串请求都会单独 flush
+    def __init__(self, max_wait_ms: int, alpha: float = 0.2, min_wait_ms: float = 1.0):
+        self.max_wait_s: float = max_wait_ms / 1000.0
+        self._alpha: float = alpha
+        self._min_wait_s: float = min_wait_ms / 1000.0
+        self._last_arrival: float | None = None
+        self.gap_s: float | None = None
+
+    def on_arrival(self) -> None:
+        now = time.monotonic()
+        if self._last_arrival is not None:
+            gap = now - self._last_arrival
+            if gap > self.max_wait_s:
+                self.gap_s = None
+            elif self.gap_s is None:
+                self.gap_s = gap
+            else:
+                self.gap_s += self._alpha * (gap - self.gap_s)
+        self._last_arrival = now
+
+    def expected_gap_s(self) -> float | None:
+        # 距上次到达已经超过估计间隔时，说明到达率在下降，用实际间隔修正
+        if self.gap_s is None or self._last_arrival is None:
+            return None
+        return max(self.gap_s, time.monotonic() - self._last_arrival)
+
+    def wait_s(self, pending: int, batch_size: int, waited_s: float) -> float:
+        remaining_s = self.max_wait_s - waited_s
+        gap = self.expected_gap_s()
+        if gap is None or remaining_s <= 0:
+            return 0.0
+        if waited_s + (batch_size - pending) * gap > self.max_wait_s:
+            return 0.0
+        return max(self._min_wait_s, min(gap, remaining_s))
+
+
+def make_batch_policy(name: str, max_wait_ms: int) -> BatchPolicy:
+    if name == "fixed":
+        return FixedWindowPolicy(max_wait_ms)
+    if name == "arrival_rate":
+        return ArrivalRatePolicy(max_wait_ms)
+    raise ValueError(f"Unsupported batch policy: {name}")
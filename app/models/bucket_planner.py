@@ -0,0 +1,150 @@
+import math
+from collections import Counter, deque
+
+
+class InputTooLarge(Exception):
+    # 请求 token 数超过可接受的最大值，没有可以路由到的分桶
+    def __init__(self, tokens: int, max_tokens: int):
+        super().__init__(f"input too large: {tokens} tokens > {max_tokens}")
+        self.tokens: int = tokens
+        self.max_tokens: int = max_tokens
+
+
+class BucketPlanner:
+    # 按请求 token 数（视觉 token + 文本 token）分桶，批大小 = token 预算 // 桶上界
+    # 周期性地根据最近请求大小的直方图重新划分桶边界：在填充浪费不超过预算的前提下
+    # 尽量少分桶（每个桶更容易攒满），桶上界取组内观测到的最大值；
+    # 比观测值更大、但不超过可接受最大 token 数的请求进入额外的溢出桶
+    def __init__(
+        self,
+        edges: list[int],
+        token_budget: int,
+        max_waste: float = 0.2,
+        refit_every: int = 256,
+        history: int = 4096,
+        granularity: int = 256,
+    ):
+        assert edges == sorted(edges) and len(edges) > 0
+        self.max_buckets: int = len(edges)
+        # 拟合出的桶最多 max_buckets 个，再加一个上界为 max_tokens 的溢出桶
+        self.max_routes: int = len(edges) + 1
+        self.max_tokens: int = edges[-1]
+        self.edges: list[int] = list(edges)
+        self.token_budget: int = token_budget
+        self.max_waste: float = max_waste
+        self._refit_every: int = refit_every
+        self._granularity: int = granularity
+        self._history: deque[int] = deque(maxlen=history)
+        self._since_refit: int = 0
+        self.refits: int = 0
+
+    def route(self, tokens: int) -> int | None:
+        # 返回桶下标；超过最大桶上界时返回 None
+        for i, edge in enumerate(self.edges):
+            if tokens <= edge:
+                return i
+        return None
+
+    def batch_size(self, index: int) -> int:
+        return max(1, self.token_budget // self.edges[index])
+
+    def observe(self, tokens: int) -> bool:
+        # 记录一个请求大小，到达重划周期时重新划分；边界发生变化时返回 True
+        if tokens > self.max_tokens:
+            return False
+        self._history.append(tokens)
+        self._since_refit += 1
+        if self._since_refit < self._refit_every:
+            return False
+        self._since_refit = 0
+        edges = self.refit()
+        if edges == self.edges:
+            return False
+        self.edges = edges
+        self.refits += 1
+        return True
+
+    def _histogram(self) -> list[tuple[int, int]]:
+        # 按粒度向上取整后的 (大小, 次数)，升序
+        g = self._granularity
+        counts = Counter(
+            min(self.max_tokens, math.ceil(t / g) * g) for t in self._history
+        )
+        return sorted(counts.items())
+
+    def waste(self, edges: list[int] | None = None) -> float:
+        # 估计的填充浪费比例：每个请求填充到所在桶中出现过的最大值
+        edges = self.edges if edges is None else edges
+        groups: dict[int, list[tuple[int, int]]] = {}
+        for size, count in self._histogram():
+            index = next(i for i, edge in enumerate(edges) if size <= edge)
+            groups.setdefault(index, []).append((size, count))
+        padded = used = 0
+        for items in groups.values():
+            top = items[-1][0]
+            padded += sum(count * top for _, count in items)
+            used += sum(count * size for size, count in items)
+        return 1 - used / padded if padded else 0.0
+
+    def refit(self) -> list[int]:
+        hist = self._histogram()
+        if not hist:
+            return self.edges
+        sizes = [size for size, _ in hist]
+        counts = [count for _, count in hist]
+        m = len(hist)
+
+        # prefix[j] = 前 j 个取值的次数之和，weighted[j] = 前 j 个取值的 token 总数
+        prefix = [0] * (m + 1)
+        weighted = [0] * (m + 1)
+        for j in range(m):
+            prefix[j + 1] = prefix[j] + counts[j]
+            weighted[j + 1] = weighted[j] + counts[j] * sizes[j]
+
+        def cost(i: int, j: int) -> int:
+            # 取值 i..j 分为一组，全部填充到 sizes[j] 的浪费 token 数
+            return (prefix[j + 1] - prefix[i]) * sizes[j] - (
+                weighted[j + 1] - weighted[i]
+            )
+
+        total = weighted[m]
+        inf = float("inf")
+        # best[k][j]：前 j+1 个取值分成 k 组的最小浪费，cut 记录最后一组的起点
+        best = [[inf] * m for _ in range(self.max_buckets + 1)]
+        cut = [[0] * m for _ in range(self.max_buckets + 1)]
+        for j in range(m):
+            best[1][j] = cost(0, j)
+        chosen = 1
+        for k in range(1, self.max_buckets + 1):
+            if k > 1:
+                for j in range(k - 1, m):
+                    for i in range(k - 1, j + 1):
+                        value = best[k - 1][i - 1] + cost(i, j)
+                        if value < best[k][j]:
+                            best[k][j] = value
+                            cut[k][j] = i
+            chosen = k
+            if best[k][m - 1] <= self.max_waste * (best[k][m - 1] + total):
+                break
+            if k >= m:
+                break
+
+        edges = []
+        j = m - 1
+        for k in range(chosen, 0, -1):
+            edges.append(sizes[j])
+            j = cut[k][j] - 1
+        edges.reverse()
+        # 拟合的桶按观测到的最大值决定批大小；之前能接受的更大请求走溢出桶
+        if edges[-1] < self.max_tokens:
+            edges.append(self.max_tokens)
+        return edges
+
+    def stats(self) -> dict:
+        return {
+            "edges": list(self.edges),
+            "batch_sizes": [self.batch_size(i) for i in range(len(self.edges))],
+            "observed": len(self._history),
+            "refits": self.refits,
+            "waste": self.waste(),
+        }
@@ -0,0 +1,74 @@
+import os
+import time
+from contextlib import contextmanager
+
+from app.models.metrics import COMPILE_CACHE, COMPILE_WARMUP
+
+# torch.compile 产物的持久化缓存与预热报告。inductor 的 FX graph、autotune 结果
+# 与 triton kernel 都写在 TORCHINDUCTOR_CACHE_DIR 下，挂载持久卷后重启可直接复用；
+# CPU inductor 使用同一套缓存，便于在没有 GPU 的环境中测试
+
+
+def configure_compile_cache(cache_dir: str) -> None:
+    # 需要在第一次编译之前调用；cache_dir 为空时使用 torch 默认的临时目录
+    if not cache_dir:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(cache_dir, "triton"))
+
+    import torch._inductor.config as inductor_config
+
+    inductor_config.fx_graph_cache = True
+    inductor_config.autotune_local_cache = True
+
+
+def cache_counters() -> dict[str, int]:
+    # dynamo 进程内计数器中与编译缓存相关的项，如 inductor.fxgraph_cache_hit
+    from torch._dynamo.utils import counters
+
+    return {
+        f"{group}.{key}": value
+        for group in ("inductor", "aot_autograd")
+        for key, value in counters[group].items()
+        if "cache_hit" in key or "cache_miss" in key
+    }
+
+
+class CompileReport:
+    # 记录每个预热 shape 首次调用的耗时，以及期间编译缓存的命中 / 未命中次数
+    def __init__(self):
+        self.shapes: list[dict] = []
+
+    @contextmanager
+    def measure(self, shape: str):
+        before = cache_counters()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            after = cache_counters()
+            delta = {k: v - before.get(k, 0) for k, v in after.items()}
+            hits = sum(v for k, v in delta.items() if "cache_hit" in k)
+            misses = sum(v for k, v in delta.items() if "cache_miss" in k)
+            COMPILE_WARMUP.set(seconds, shape=shape)
+            COMPILE_CACHE.inc(hits, result="hit")
+            COMPILE_CACHE.inc(misses, result="miss")
+            self.shapes.append(
+                {
+                    "shape": shape,
+                    "seconds": round(seconds, 3),
+                    "cache_hits": hits,
+                    "cache_misses": misses,
+                }
+            )
+
+    def summary(self) -> dict:
+        return {
+            "seconds": round(sum(s["seconds"] for s in self.shapes), 3),
+            "cache_hits": sum(s["cache_hits"] for s in self.shapes),
+            "cache_misses": sum(s["cache_misses"] for s in self.shapes),
+            "cache_dir": os.environ.get("TORCHINDUCTOR_CACHE_DIR"),
+            "shapes": self.shapes,
+        }
@@ -0,0 +1,159 @@
+import asyncio
+from asyncio import Future
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Generic, Protocol, TypeVar
+
+from app.models.infer_queue import NORMAL, InferQueue
+
+S = TypeVar("S")
+
+
+class StepEngine(Protocol[S]):
+    # 以下方法均在 InferQueue 的推理线程中同步执行
+    def prefill(self, item: Any) -> S: ...
+
+    def step(self, states: list[S]) -> None: ...
+
+    def is_finished(self, state: S) -> bool: ...
+
+    def finish(self, state: S) -> Any: ...
+
+    def release(self, state: S) -> None: ...
+
+    def reset(self) -> None:
+        # step 失败、运行批整体作废后调用，丢弃引擎内部跨 step 保留的批状态
+        ...
+
+
+@dataclass
+class _Request(Generic[S]):
+    item: Any
+    future: Future
+    state: S | None = field(default=None)
+    priority: int = NORMAL
+    deadline: float | None = None
+
+
+class ContinuousBatcher(Generic[S]):
+    """迭代级批处理：每个 step 边界都可以加入新请求、移出已完成请求"""
+
+    def __init__(self, queue: InferQueue, engine: StepEngine[S], max_running: int):
+        self.queue: InferQueue = queue
+        self.engine: StepEngine[S] = engine
+        self._max_running: int = max_running
+        self._waiting: deque[_Request[S]] = deque()
+        self._running: list[_Request[S]] = []
+        self._is_running: bool = False
+
+    @property
+    def num_waiting(self) -> int:
+        return len(self._waiting)
+
+    @property
+    def num_running(self) -> int:
+        return len(self._running)
+
+    async def submit(
+        self, item: Any, priority: int = NORMAL, deadline: float | None = None
+    ) -> Any:
+        # deadline 只约束 prefill：到达推理线程前已过期的请求不再加入运行批；
+        # 运行批的每个 step 按批内最高的优先级排队
+        future: Future = asyncio.get_running_loop().create_future()
+        req = _Request(item, future, priority=priority, deadline=deadline)
+        self._waiting.append(req)
+        if not self._is_running:
+            self._is_running = True
+            asyncio.create_task(self._run_loop())
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # 还未 prefill 的直接移出等待队列；运行中的在下一个 step 边界移出
+            if req in self._waiting:
+                self._waiting.remove(req)
+            raise
+
+    def _prefill_sync(self, admitted: list[_Request[S]]) -> list[Any]:
+        # 单个请求 prefill 失败不影响同批其它请求
+        results: list[Any] = []
+        for req in admitted:
+            try:
+                results.append(self.engine.prefill(req.item))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def _admit(self) -> None:
+        admitted: list[_Request[S]] = []
+        while self._waiting and len(self._running) + len(admitted) < self._max_running:
+            admitted.append(self._waiting.popleft())
+        if not admitted:
+            return
+
+        deadlines = [req.deadline for req in admitted]
+        try:
+            states = await self.queue.submit(
+                lambda: self._prefill_sync(admitted),
+                priority=min(req.priority for req in admitted),
+                deadline=None if None in deadlines else max(deadlines),
+            )
+        except Exception as e:
+            states = [e] * len(admitted)
+        for req, state in zip(admitted, states):
+            if isinstance(state, Exception):
+                if not req.future.done():
+                    req.future.set_exception(state)
+            else:
+                req.state = state
+                self._running.append(req)
+
+    def _retire(self) -> None:
+        running: list[_Request[S]] = []
+        for req in self._running:
+            if req.future.cancelled():
+                self.engine.release(req.state)
+                continue
+            if not self.engine.is_finished(req.state):
+                running.append(req)
+                continue
+            try:
+                result = self.engine.finish(req.state)
+            except Exception as e:
+                if not req.future.done():
+                    req.future.set_exception(e)
+            else:
+                if not req.future.done():
+                    req.future.set_result(result)
+            finally:
+                self.engine.release(req.state)
+        self._running = running
+
+    def _fail_running(self, e: Exception) -> None:
+        for req in self._running:
+            if not req.future.done():
+                req.future.set_exception(e)
+            self.engine.release(req.state)
+        self._running = []
+        self.engine.reset()
+
+    async def _run_loop(self):
+        try:
+            while self._waiting or self._running:
+                await self._admit()
+                # prefill 可能已经生成了 EOS
+                self._retire()
+                if not self._running:
+                    continue
+
+                states = [req.state for req in self._running]
+                try:
+                    await self.queue.submit(
+                        lambda: self.engine.step(states),
+                        priority=min(req.priority for req in self._running),
+                    )
+                except Exception as e:
+                    self._fail_running(e)
+                    continue
+                self._retire()
+        finally:
+            self._is_running = False
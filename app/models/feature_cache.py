@@ -0,0 +1,72 @@
+import threading
+from typing import Any, Callable
+
+from app.models.metrics import CACHE_REQUESTS
+from app.models.result_cache import LRUCache
+
+
+class FeatureCache:
+    # 张量两级缓存（视觉特征、prompt embedding）：设备层（显存）LRU，
+    # 容量不足时淘汰的条目转存到主机层（内存）LRU，主机层命中时搬回设备层
+    def __init__(
+        self,
+        device_bytes: int,
+        host_bytes: int,
+        sizeof: Callable[[Any], int],
+        to_host: Callable[[Any], Any],
+        to_device: Callable[[Any], Any],
+        name: str = "features",
+    ):
+        self.name: str = name
+        self._lock: threading.Lock = threading.Lock()
+        self._to_host: Callable[[Any], Any] = to_host
+        self._to_device: Callable[[Any], Any] = to_device
+        self.host: LRUCache = LRUCache(host_bytes, sizeof=sizeof)
+        self.device: LRUCache = LRUCache(
+            device_bytes, sizeof=sizeof, on_evict=self._offload
+        )
+        self.device_hits: int = 0
+        self.host_hits: int = 0
+        self.misses: int = 0
+
+    def _offload(self, key: str, value: Any) -> None:
+        if self.host.max_bytes > 0:
+            self.host.put(key, self._to_host(value))
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            value = self.device.get(key)
+            if value is not None:
+                self.device_hits += 1
+                CACHE_REQUESTS.inc(cache=self.name, result="device_hit")
+                return value
+            value = self.host.pop(key)
+            if value is not None:
+                self.host_hits += 1
+                CACHE_REQUESTS.inc(cache=self.name, result="host_hit")
+                value = self._to_device(value)
+                self.device.put(key, value)
+                return value
+            self.misses += 1
+            CACHE_REQUESTS.inc(cache=self.name, result="miss")
+            return None
+
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self.host.pop(key)
+            self.device.put(key, value)
+
+    def stats(self) -> dict:
+        lookups = self.device_hits + self.host_hits + self.misses
+        return {
+            "device_hits": self.device_hits,
+            "host_hits": self.host_hits,
+            "misses": self.misses,
+            "hit_rate": (self.device_hits + self.host_hits) / lookups
+            if lookups
+            else 0.0,
+            "device_entries": len(self.device),
+            "device_bytes": self.device.total_bytes,
+            "host_entries": len(self.host),
+            "host_bytes": self.host.total_bytes,
+        }
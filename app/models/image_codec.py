@@ -0,0 +1,58 @@
+from io import BytesIO
+
+from PIL import features
+from PIL.Image import Image
+
+# 输出格式 -> MIME 类型，顺序即 Accept 中 q 值相同时的偏好
+MEDIA_TYPES: dict[str, str] = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "avif": "image/avif",
+}
+
+
+def supported_formats(formats: dict[str, int]) -> dict[str, int]:
+    # 去掉当前 Pillow 构建不能编码的格式（AVIF 需要带 libavif 的 Pillow >= 11.2），保持顺序
+    checks = {"webp": "webp", "jpeg": "jpg", "avif": "avif"}
+    return {
+        name: quality
+        for name, quality in formats.items()
+        if name in MEDIA_TYPES and (name not in checks or features.check(checks[name]))
+    }
+
+
+def encode_image(image: Image, format: str, quality: int) -> bytes:
+    # PNG 的 quality 为 zlib 压缩级别 0-9（无损，越小越快、越大越小），
+    # 其余格式为有损压缩质量 0-100
+    buffer = BytesIO()
+    if format == "png":
+        image.save(buffer, format="PNG", compress_level=quality)
+    else:
+        image.convert("RGB").save(buffer, format=format.upper(), quality=quality)
+    return buffer.getvalue()
+
+
+def negotiate(accept: str | None, formats: dict[str, int]) -> str | None:
+    # 按 Accept 头选出 formats 中 q 值最高的格式；只有通配符或没有可用格式时返回 None，
+    # 由调用方使用默认格式
+    if not accept:
+        return None
+    by_type = {media_type: name for name, media_type in MEDIA_TYPES.items()}
+    best, best_q = None, 0.0
+    for item in accept.split(","):
+        media_type, *options = [part.strip() for part in item.split(";")]
+        name = by_type.get(media_type.lower())
+        if name not in formats:
+            continue
+        q = 1.0
+        for option in options:
+            key, _, value = option.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = name, q
+    return best
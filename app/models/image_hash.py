@@ -0,0 +1,26 @@
+import hashlib
+
+from PIL import Image
+
+
+def content_hash(image: Image.Image) -> str:
+    # 对解码后的像素计算哈希，与文件编码方式、元数据无关
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{image.mode}:{image.width}x{image.height}".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def perceptual_hash(image: Image.Image, hash_size: int = 8) -> str:
+    # dHash：缩小为 (hash_size+1) x hash_size 灰度图，比较相邻像素亮度
+    # 缩放、重新编码后的同一张图片得到相同结果
+    small = image.convert("L").resize(
+        (hash_size + 1, hash_size), Image.Resampling.LANCZOS
+    )
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{bits:0{hash_size * hash_size // 4}x}"
@@ -1,36 +1,191 @@
 import asyncio
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
 from typing import Callable, TypeVar
 
+from app.models.metrics import INFERENCE, QUEUE_DEPTH, QUEUE_WAIT
+
 T = TypeVar("T")
 
+# 优先级：数值越小越先执行；过期后降级的任务进入 BEST_EFFORT
+HIGH = 0
+NORMAL = 1
+BEST_EFFORT = 2
+# 请求中可指定的优先级名称
+PRIORITIES: dict[str, int] = {
+    "high": HIGH,
+    "normal": NORMAL,
+    "best_effort": BEST_EFFORT,
+}
+
+
+def resolve_priority(priority: str | None) -> int:
+    # None 表示 NORMAL；未知名称抛出 ValueError
+    if priority is None:
+        return NORMAL
+    if priority not in PRIORITIES:
+        raise ValueError(
+            f"Unsupported priority {priority}, use one of {', '.join(PRIORITIES)}"
+        )
+    return PRIORITIES[priority]
+
+
+def resolve_deadline(timeout_ms: int | None, default_timeout_s: float) -> float | None:
+    # 请求指定的超时与服务默认超时（0 表示不限）取较小者，返回 time.monotonic() 的
+    # 绝对时间；都不限时返回 None
+    if timeout_ms is not None and timeout_ms <= 0:
+        raise ValueError("timeout_ms must be positive")
+    timeouts = [t for t in (default_timeout_s, (timeout_ms or 0) / 1000) if t > 0]
+    if not timeouts:
+        return None
+    return time.monotonic() + min(timeouts)
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, reason: str, waited_s: float):
+        super().__init__(f"{reason} after waiting {waited_s * 1000:.0f}ms")
+        self.reason: str = reason
+        self.waited_s: float = waited_s
+
+
+@dataclass
+class _Job:
+    infer_sync: Callable[[], object]
+    future: asyncio.Future
+    flow: str
+    priority: int
+    deadline: float | None
+    # 加权公平排队的虚拟完成时间
+    finish_tag: float
+    enqueued_at: float
+
 
 class InferQueue:
-    def __init__(self):
-        self._queue: asyncio.Queue = asyncio.Queue()
+    # 串行执行推理任务的调度器：
+    # - 先按优先级，同一优先级内按 flow（分桶 / 租户）做加权公平排队，
+    #   flow 内部 FIFO；cost 越大、权重越小的 flow 轮到得越少
+    # - 调用方已取消（await 被 cancel）的任务直接跳过，计入 dropped["cancelled"]
+    # - 任务在进入推理线程前检查 deadline，已过期的按 on_expired 丢弃
+    #   （调用方收到 DeadlineExceeded）或降级到 BEST_EFFORT，原因计入 dropped
+    def __init__(self, on_expired: str = "drop"):
+        assert on_expired in ("drop", "demote")
+        self._on_expired: str = on_expired
+        self._flows: dict[int, dict[str, deque[_Job]]] = {}
+        self._weights: dict[str, float] = {}
+        self._last_finish: dict[str, float] = {}
+        self._virtual_time: float = 0.0
         self._is_running = False
+        self.served: int = 0
+        self.demoted: int = 0
+        self.dropped: Counter[str] = Counter()
 
-    async def submit(self, infer_sync: Callable[[], T]) -> T:
+    def set_weight(self, flow: str, weight: float) -> None:
+        assert weight > 0
+        self._weights[flow] = weight
+
+    @property
+    def pending(self) -> int:
+        return sum(len(q) for flows in self._flows.values() for q in flows.values())
+
+    def _enqueue(self, job: _Job) -> None:
+        self._flows.setdefault(job.priority, {}).setdefault(job.flow, deque()).append(
+            job
+        )
+        QUEUE_DEPTH.set(self.pending, queue="infer")
+
+    async def submit(
+        self,
+        infer_sync: Callable[[], T],
+        flow: str = "default",
+        priority: int = NORMAL,
+        deadline: float | None = None,
+        cost: float = 1.0,
+    ) -> T:
+        # deadline 为 time.monotonic() 的绝对时间
         loop = asyncio.get_running_loop()
         future: asyncio.Future = loop.create_future()
-        await self._queue.put((infer_sync, future))
+        start = max(self._virtual_time, self._last_finish.get(flow, 0.0))
+        finish_tag = start + cost / self._weights.get(flow, 1.0)
+        self._last_finish[flow] = finish_tag
+        self._enqueue(
+            _Job(
+                infer_sync,
+                future,
+                flow,
+                priority,
+                deadline,
+                finish_tag,
+                time.monotonic(),
+            )
+        )
         if not self._is_running:
             self._is_running = True
             asyncio.create_task(self._run_loop())
         return await future
 
+    def _pop_next(self) -> _Job | None:
+        while self._flows:
+            priority = min(self._flows)
+            flows = self._flows[priority]
+            flow = min(flows, key=lambda name: flows[name][0].finish_tag)
+            job = flows[flow].popleft()
+            if not flows[flow]:
+                del flows[flow]
+            if not flows:
+                del self._flows[priority]
+            QUEUE_DEPTH.set(self.pending, queue="infer")
+
+            if job.future.cancelled():
+                self.dropped["cancelled"] += 1
+                continue
+            now = time.monotonic()
+            if job.deadline is not None and now >= job.deadline:
+                if self._on_expired == "demote" and job.priority != BEST_EFFORT:
+                    self.demoted += 1
+                    job.priority = BEST_EFFORT
+                    job.deadline = None
+                    self._enqueue(job)
+                    continue
+                self.dropped["deadline_expired"] += 1
+                job.future.set_exception(
+                    DeadlineExceeded("deadline_expired", now - job.enqueued_at)
+                )
+                continue
+            self._virtual_time = max(self._virtual_time, job.finish_tag)
+            QUEUE_WAIT.observe(now - job.enqueued_at, flow=job.flow)
+            return job
+        return None
+
     async def _run_loop(self):
         try:
             while True:
-                infer_sync, future = await self._queue.get()
+                job = self._pop_next()
+                if job is None:
+                    await asyncio.sleep(0)
+                    job = self._pop_next()
+                    if job is None:
+                        break
+                start = time.perf_counter()
                 try:
-                    result = await asyncio.to_thread(infer_sync)
+                    result = await asyncio.to_thread(job.infer_sync)
                 except Exception as e:
-                    future.set_exception(e)
+                    if not job.future.done():
+                        job.future.set_exception(e)
                 else:
-                    future.set_result(result)
-                if self._queue.empty():
-                    await asyncio.sleep(0)
-                    if self._queue.empty():
-                        break
+                    # 执行期间被取消时丢弃结果
+                    if not job.future.done():
+                        job.future.set_result(result)
+                finally:
+                    INFERENCE.observe(time.perf_counter() - start, flow=job.flow)
+                self.served += 1
         finally:
             self._is_running = False
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "served": self.served,
+            "demoted": self.demoted,
+            "dropped": dict(self.dropped),
+        }
@@ -0,0 +1,53 @@
+import asyncio
+import json
+import struct
+
+import numpy as np
+
+from app.models.preprocess_pool import (
+    SharedArray,
+    read_array,
+    release_array,
+    share_array,
+)
+
+# 前端进程与模型工作进程之间的消息协议（unix socket）：
+# 每条消息为 4 字节长度（大端）+ UTF-8 JSON；图片等大块数据放在共享内存中，
+# 消息里只带句柄，由接收方读取后释放
+
+_HEADER = struct.Struct(">I")
+
+
+async def send_message(writer: asyncio.StreamWriter, message: dict) -> None:
+    body = json.dumps(message, ensure_ascii=False).encode("utf-8")
+    writer.write(_HEADER.pack(len(body)) + body)
+    await writer.drain()
+
+
+async def read_message(reader: asyncio.StreamReader) -> dict | None:
+    # 对端关闭连接时返回 None
+    try:
+        head = await reader.readexactly(_HEADER.size)
+        (length,) = _HEADER.unpack(head)
+        body = await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return json.loads(body)
+
+
+def share_bytes(data: bytes) -> dict:
+    handle = share_array(np.frombuffer(data, dtype=np.uint8))
+    return {"name": handle.name, "size": len(data)}
+
+
+def _handle(payload: dict) -> SharedArray:
+    return SharedArray(payload["name"], (payload["size"],), np.dtype(np.uint8).str)
+
+
+def take_bytes(payload: dict) -> bytes:
+    # 读取后释放共享内存
+    return read_array(_handle(payload), unlink=True).tobytes()
+
+
+def release_bytes(payload: dict) -> None:
+    release_array(_handle(payload))
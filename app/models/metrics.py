@@ -0,0 +1,303 @@
+import math
+import threading
+from typing import Iterable
+
+# Prometheus 文本格式（0.0.4）的最小实现，不引入额外依赖。
+# 指标均在本模块定义并注册到 REGISTRY，可在推理线程中更新。
+# 吞吐（tokens/s、images/s）由 Prometheus 对计数器做 rate() 得到。
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind: str = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name: str = name
+        self.help: str = help
+        self.labelnames: tuple[str, ...] = labelnames
+        self._lock: threading.Lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        assert set(labels) == set(self.labelnames), (self.name, labels)
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, value: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}"
+            for key, v in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = _DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets: tuple[float, ...] = tuple(sorted(buckets)) + (math.inf,)
+        # key -> (每个桶的计数（非累计）, sum, count)
+        self._values: dict[tuple[str, ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels: str) -> int:
+        item = self._values.get(self._key(labels))
+        return item[2] if item else 0
+
+    def sum(self, **labels: str) -> float:
+        item = self._values.get(self._key(labels))
+        return item[1] if item else 0.0
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                labels = _format_labels(
+                    self.labelnames + ("le",), key + (_format_value(bound),)
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        assert metric.name not in self._metrics, metric.name
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+QUEUE_DEPTH = REGISTRY.register(
+    Gauge(
+        "vision_queue_depth",
+        "Requests waiting in a batching queue or jobs waiting in the InferQueue",
+        ("queue",),
+    )
+)
+BATCH_FLUSHES = REGISTRY.register(
+    Counter(
+        "vision_batch_flushes_total",
+        "Batches flushed, by reason (full or timer)",
+        ("queue", "reason"),
+    )
+)
+BATCH_FILL_RATIO = REGISTRY.register(
+    Histogram(
+        "vision_batch_fill_ratio",
+        "Flushed batch size divided by the configured batch size",
+        ("queue",),
+        buckets=(0.125, 0.25, 0.375, 0.5, 0.625, 0.75, 0.875, 1.0),
+    )
+)
+BATCH_WAIT = REGISTRY.register(
+    Histogram(
+        "vision_batch_wait_seconds",
+        "Time a request waited in a pending batch before the batch was flushed",
+        ("queue",),
+    )
+)
+QUEUE_WAIT = REGISTRY.register(
+    Histogram(
+        "vision_queue_wait_seconds",
+        "Time a job waited in the InferQueue before reaching the inference thread",
+        ("flow",),
+    )
+)
+INFERENCE = REGISTRY.register(
+    Histogram(
+        "vision_inference_seconds",
+        "Time spent in the inference thread per job",
+        ("flow",),
+    )
+)
+PREPROCESS = REGISTRY.register(
+    Histogram(
+        "vision_preprocess_seconds",
+        "Preprocessing pool run time per task",
+        ("pool", "task"),
+    )
+)
+PREPROCESS_WAIT = REGISTRY.register(
+    Histogram(
+        "vision_preprocess_wait_seconds",
+        "Time a task waited for a preprocessing worker",
+        ("pool",),
+    )
+)
+ENCODE = REGISTRY.register(
+    Histogram(
+        "vision_encode_seconds",
+        "Image encode time for txt2img results",
+        ("format",),
+    )
+)
+GENERATED_TOKENS = REGISTRY.register(
+    Counter("vision_generated_tokens_total", "Tokens generated by img2txt")
+)
+GENERATED_IMAGES = REGISTRY.register(
+    Counter("vision_generated_images_total", "Images generated by txt2img")
+)
+CACHE_REQUESTS = REGISTRY.register(
+    Counter(
+        "vision_cache_requests_total",
+        "Cache lookups by result (memory_hit, disk_hit, device_hit, host_hit, miss)",
+        ("cache", "result"),
+    )
+)
+BUCKET_EDGE = REGISTRY.register(
+    Gauge(
+        "vision_bucket_edge_tokens",
+        "Upper token bound of each img2txt bucket",
+        ("bucket",),
+    )
+)
+BUCKET_BATCH_SIZE = REGISTRY.register(
+    Gauge("vision_bucket_batch_size", "Batch size of each img2txt bucket", ("bucket",))
+)
+ADMISSION_ESTIMATE = REGISTRY.register(
+    Gauge(
+        "vision_admission_estimated_seconds",
+        "Estimated completion time for a newly admitted request",
+        ("service",),
+    )
+)
+ADMISSION_IN_FLIGHT = REGISTRY.register(
+    Gauge(
+        "vision_admission_in_flight",
+        "Requests admitted but not yet finished",
+        ("service",),
+    )
+)
+ADMISSION_REJECTED = REGISTRY.register(
+    Counter(
+        "vision_admission_rejected_total",
+        "Requests rejected by admission control",
+        ("service",),
+    )
+)
+MODEL_RESIDENCY = REGISTRY.register(
+    Gauge(
+        "vision_model_residency",
+        "Where a model currently lives: 0 unloaded, 1 host memory, 2 device",
+        ("model",),
+    )
+)
+MODEL_DEVICE_BYTES = REGISTRY.register(
+    Gauge(
+        "vision_model_device_bytes",
+        "Device memory attributed to a resident model",
+        ("model",),
+    )
+)
+MODEL_SWITCH = REGISTRY.register(
+    Histogram(
+        "vision_model_switch_seconds",
+        "Time spent moving a model (load, restore, offload, unload)",
+        ("model", "action"),
+    )
+)
+MODEL_SWITCH_WAIT = REGISTRY.register(
+    Histogram(
+        "vision_model_switch_wait_seconds",
+        "Time a request waited for its model to become resident",
+        ("model",),
+    )
+)
+STARTUP_PHASE = REGISTRY.register(
+    Gauge(
+        "vision_startup_phase_seconds",
+        "Duration of each startup phase (import, load, warmup)",
+        ("phase",),
+    )
+)
+COMPILE_WARMUP = REGISTRY.register(
+    Gauge(
+        "vision_compile_warmup_seconds",
+        "First-call time per warmup shape (compile or cache load plus one run)",
+        ("shape",),
+    )
+)
+COMPILE_CACHE = REGISTRY.register(
+    Counter(
+        "vision_compile_cache_total",
+        "torch.compile artifact cache lookups during warmup (hit or miss)",
+        ("result",),
+    )
+)
@@ -0,0 +1,160 @@
+import asyncio
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable
+
+import numpy as np
+
+from app.models.metrics import PREPROCESS, PREPROCESS_WAIT, QUEUE_DEPTH
+
+
+@dataclass(frozen=True)
+class SharedArray:
+    # 共享内存中数组的句柄，可在进程间传递
+    name: str
+    shape: tuple[int, ...]
+    dtype: str
+
+
+def share_array(array: np.ndarray) -> SharedArray:
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    view[...] = array
+    del view
+    handle = SharedArray(shm.name, tuple(array.shape), array.dtype.str)
+    shm.close()
+    return handle
+
+
+def read_array(handle: SharedArray, unlink: bool = False) -> np.ndarray:
+    # 拷贝出共享内存中的数组；unlink=True 时同时释放共享内存
+    shm = SharedMemory(name=handle.name)
+    try:
+        view = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf)
+        array = view.copy()
+        del view
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+    return array
+
+
+def release_array(handle: SharedArray) -> None:
+    # 可重复调用；已被释放时忽略
+    try:
+        shm = SharedMemory(name=handle.name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _timed_call(fn: Callable, args: tuple) -> tuple[Any, float]:
+    # 在工作进程中执行，返回结果与纯执行耗时
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def _discard_result(cf: Future, discard: Callable[[Any], None]) -> None:
+    if not cf.cancelled() and cf.exception() is None:
+        discard(cf.result()[0])
+
+
+class PreprocessPool:
+    # 独立的预处理进程池，不与推理共用默认线程池；workers=0 时退化为单个专用线程
+    # 记录排队深度、排队耗时与执行耗时
+    def __init__(
+        self,
+        workers: int,
+        initializer: Callable[..., None] | None = None,
+        initargs: tuple = (),
+        name: str = "preprocess",
+    ):
+        self.workers: int = workers
+        self.name: str = name
+        self._executor: Executor
+        if workers > 0:
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=initializer,
+                initargs=initargs,
+            )
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix=name,
+                initializer=initializer,
+                initargs=initargs,
+            )
+        self.pending: int = 0
+        self.completed: int = 0
+        self.failed: int = 0
+        self._wait_s: deque[float] = deque(maxlen=1024)
+        self._run_s: deque[float] = deque(maxlen=1024)
+
+    async def run(
+        self,
+        fn: Callable,
+        *args: Any,
+        discard: Callable[[Any], None] | None = None,
+    ) -> Any:
+        # 调用方在执行完成前被取消时，结果交给 discard 释放（例如共享内存）
+        self.pending += 1
+        QUEUE_DEPTH.set(self.pending, queue=self.name)
+        start = time.perf_counter()
+        cf = self._executor.submit(_timed_call, fn, args)
+        try:
+            result, run_s = await asyncio.wrap_future(cf)
+        except asyncio.CancelledError:
+            if discard is not None:
+                cf.add_done_callback(lambda f: _discard_result(f, discard))
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+            QUEUE_DEPTH.set(self.pending, queue=self.name)
+        self.completed += 1
+        wait_s = max(0.0, time.perf_counter() - start - run_s)
+        self._run_s.append(run_s)
+        self._wait_s.append(wait_s)
+        PREPROCESS.observe(run_s, pool=self.name, task=fn.__name__)
+        PREPROCESS_WAIT.observe(wait_s, pool=self.name)
+        return result
+
+    def stats(self) -> dict:
+        def percentile_ms(samples: deque[float], q: float) -> float:
+            if not samples:
+                return 0.0
+            ordered = sorted(samples)
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_p50_ms": percentile_ms(self._wait_s, 0.5),
+            "wait_p95_ms": percentile_ms(self._wait_s, 0.95),
+            "run_p50_ms": percentile_ms(self._run_s, 0.5),
+            "run_p95_ms": percentile_ms(self._run_s, 0.95),
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
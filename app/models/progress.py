@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+QUEUED = "queued"
+DENOISING = "denoising"
+DECODING = "decoding"
+DONE = "done"
+
+
+class GenerationProgress:
+    # 单个生成请求的进度：所处阶段、去噪步数以及各阶段耗时
+    # 推理线程通过 report 更新，事件循环侧通过 wait_changed 等待变化
+    def __init__(self, preview_every: int = 0):
+        self._loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        self._changed: asyncio.Event = asyncio.Event()
+        self.phase: str = QUEUED
+        self.step: int = 0
+        self.total_steps: int = 0
+        self._phase_start: float = time.monotonic()
+        self.durations: dict[str, float] = {}
+        # 每 preview_every 个去噪步由推理线程提交一张编码好的低分辨率预览（0 关闭），
+        # 只保留最新的一张
+        self.preview_every: int = preview_every
+        self.preview: bytes | None = None
+        self.preview_step: int = 0
+
+    def _update(self, phase: str, step: int | None, total_steps: int | None) -> None:
+        if phase != self.phase:
+            now = time.monotonic()
+            self.durations[self.phase] = (
+                self.durations.get(self.phase, 0.0) + now - self._phase_start
+            )
+            self.phase = phase
+            self._phase_start = now
+        if step is not None:
+            self.step = step
+        if total_steps is not None:
+            self.total_steps = total_steps
+        self._changed.set()
+
+    def report(
+        self, phase: str, step: int | None = None, total_steps: int | None = None
+    ) -> None:
+        # 可在任意线程调用
+        self._loop.call_soon_threadsafe(self._update, phase, step, total_steps)
+
+    def wants_preview(self, step: int, total_steps: int) -> bool:
+        # 最后一步之后直接解码出结果，不再预览
+        return (
+            self.preview_every > 0
+            and step % self.preview_every == 0
+            and step < total_steps
+        )
+
+    def _set_preview(self, step: int, data: bytes) -> None:
+        self.preview, self.preview_step = data, step
+        self._changed.set()
+
+    def report_preview(self, step: int, data: bytes) -> None:
+        # 可在任意线程调用
+        self._loop.call_soon_threadsafe(self._set_preview, step, data)
+
+    @property
+    def percent(self) -> int:
+        if self.phase == DONE:
+            return 100
+        if self.total_steps <= 0:
+            return 0
+        return min(99, self.step * 100 // self.total_steps)
+
+    def eta_s(self) -> float | None:
+        # 按当前去噪速度估计剩余去噪时间（不含 VAE 解码）
+        if self.phase != DENOISING or self.step <= 0:
+            return None
+        elapsed = time.monotonic() - self._phase_start
+        return elapsed / self.step * (self.total_steps - self.step)
+
+    def snapshot(self) -> dict:
+        eta = self.eta_s()
+        return {
+            "phase": self.phase,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "progress": self.percent,
+            "eta_ms": None if eta is None else round(eta * 1000),
+            "durations_ms": {k: round(v * 1000) for k, v in self.durations.items()},
+        }
+
+    async def wait_changed(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
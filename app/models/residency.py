@@ -0,0 +1,251 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+from app.models.metrics import (
+    MODEL_DEVICE_BYTES,
+    MODEL_RESIDENCY,
+    MODEL_SWITCH,
+    MODEL_SWITCH_WAIT,
+)
+
+# 模型所在位置
+UNLOADED = "unloaded"
+HOST = "host"
+DEVICE = "device"
+# 正在迁移，期间不接受新的使用者
+MOVING = "moving"
+
+_LEVELS = {UNLOADED: 0, HOST: 1, DEVICE: 2}
+
+
+def module_bytes(*modules) -> int:
+    # 模型参数与 buffer 占用的字节数
+    total = 0
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def weights_bytes(path: str) -> int:
+    # 首次加载前用权重文件大小估计显存占用
+    suffixes = {".safetensors", ".bin", ".pt", ".pth"}
+    root = Path(path)
+    if not root.exists():
+        return 0
+    return sum(p.stat().st_size for p in root.rglob("*") if p.suffix in suffixes)
+
+
+@dataclass
+class _Model:
+    name: str
+    # 以下回调都是同步的，在线程中执行
+    load: Callable[[], None]
+    offload: Callable[[], None]
+    restore: Callable[[], None]
+    unload: Callable[[], None]
+    size: Callable[[], int]
+    size_bytes: int
+    state: str = UNLOADED
+    in_use: int = 0
+    last_used: float = 0.0
+
+
+class ResidencyManager:
+    # 一个进程内多个模型共享设备时的驻留管理：
+    # - 模型首次使用时才加载，之后按 LRU 在显存预算内保留
+    # - 需要腾出显存时，把最久未使用且没有请求在用的模型按 idle_action
+    #   转移到主机内存（"offload"，再次使用时只需拷回）或直接卸载（"unload"）
+    # - 空闲超过 idle_timeout_s 的模型同样按 idle_action 处理
+    # - 常驻显存的缓存（视觉特征、prompt embedding 的设备层）按容量上限预留，
+    #   不随模型换出，从预算中扣除
+    # device_budget_bytes 为 0 表示不限制
+    def __init__(
+        self,
+        device_budget_bytes: int = 0,
+        idle_timeout_s: float = 0,
+        idle_action: str = "offload",
+        check_interval_s: float = 5.0,
+    ):
+        assert idle_action in ("offload", "unload")
+        self.device_budget_bytes: int = device_budget_bytes
+        self.idle_timeout_s: float = idle_timeout_s
+        self.idle_action: str = idle_action
+        self._check_interval_s: float = check_interval_s
+        self._models: dict[str, _Model] = {}
+        # 名称 -> 预留的显存字节数
+        self._reserved: dict[str, int] = {}
+        self._cond: asyncio.Condition = asyncio.Condition()
+        self._idle_task: asyncio.Task | None = None
+        self.switches: int = 0
+
+    def register(
+        self,
+        name: str,
+        load: Callable[[], None],
+        offload: Callable[[], None],
+        restore: Callable[[], None],
+        unload: Callable[[], None],
+        size: Callable[[], int],
+        estimate_bytes: int = 0,
+    ) -> None:
+        self._models[name] = _Model(
+            name, load, offload, restore, unload, size, estimate_bytes
+        )
+        MODEL_RESIDENCY.set(0, model=name)
+
+    def reserve(self, name: str, nbytes: int) -> None:
+        # 登记模型之外长期占用显存的部分，之后换入模型时按扣除后的预算判断
+        self._reserved[name] = nbytes
+
+    def state(self, name: str) -> str:
+        return self._models[name].state
+
+    def _device_bytes(self) -> int:
+        return sum(self._reserved.values()) + sum(
+            m.size_bytes for m in self._models.values() if m.state in (DEVICE, MOVING)
+        )
+
+    def _victims(self, model: _Model) -> list[_Model] | None:
+        # 按 LRU 选出要腾出的模型；显存不够且无法腾出时返回 None
+        if self.device_budget_bytes <= 0:
+            return []
+        need = self._device_bytes() + model.size_bytes - self.device_budget_bytes
+        victims = []
+        candidates = sorted(
+            (
+                m
+                for m in self._models.values()
+                if m is not model and m.state == DEVICE and m.in_use == 0
+            ),
+            key=lambda m: m.last_used,
+        )
+        for candidate in candidates:
+            if need <= 0:
+                break
+            victims.append(candidate)
+            need -= candidate.size_bytes
+        if need <= 0:
+            return victims
+        # 单个模型超过预算时，只要设备上没有别的模型仍然加载
+        if all(m.state != DEVICE for m in self._models.values() if m not in victims):
+            return victims
+        return None
+
+    async def _move(self, model: _Model, action: str) -> None:
+        target = {
+            "load": DEVICE,
+            "restore": DEVICE,
+            "offload": HOST,
+            "unload": UNLOADED,
+        }[action]
+        previous = model.state
+        model.state = MOVING
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(getattr(model, action))
+        except BaseException:
+            model.state = previous
+            raise
+        MODEL_SWITCH.observe(
+            time.perf_counter() - start, model=model.name, action=action
+        )
+        self.switches += 1
+        model.state = target
+        if target == DEVICE:
+            model.size_bytes = model.size() or model.size_bytes
+        MODEL_RESIDENCY.set(_LEVELS[target], model=model.name)
+        MODEL_DEVICE_BYTES.set(
+            model.size_bytes if target == DEVICE else 0, model=model.name
+        )
+
+    async def _evict(self, model: _Model) -> None:
+        await self._move(model, self.idle_action)
+
+    async def _ensure_resident(self, model: _Model) -> None:
+        # 调用时持有 self._cond
+        while model.state != DEVICE:
+            victims = self._victims(model)
+            if victims is None:
+                # 等其他模型的请求结束后再腾显存
+                await self._cond.wait()
+                continue
+            if victims:
+                # 一次换出一个再重新判断：换出期间其他模型可能又被请求占用
+                await self._evict(victims[0])
+                continue
+            await self._move(model, "restore" if model.state == HOST else "load")
+
+    @asynccontextmanager
+    async def use(self, name: str):
+        # 请求期间保持模型驻留在设备上，不会被换出
+        model = self._models[name]
+        if model.state != DEVICE:
+            start = time.perf_counter()
+            async with self._cond:
+                await self._ensure_resident(model)
+                model.in_use += 1
+            MODEL_SWITCH_WAIT.observe(time.perf_counter() - start, model=name)
+        else:
+            model.in_use += 1
+        model.last_used = time.monotonic()
+        try:
+            yield
+        finally:
+            model.in_use -= 1
+            model.last_used = time.monotonic()
+            async with self._cond:
+                self._cond.notify_all()
+
+    async def evict_idle(self) -> None:
+        if self.idle_timeout_s <= 0:
+            return
+        now = time.monotonic()
+        async with self._cond:
+            for model in self._models.values():
+                if (
+                    model.state == DEVICE
+                    and model.in_use == 0
+                    and now - model.last_used >= self.idle_timeout_s
+                ):
+                    await self._evict(model)
+            self._cond.notify_all()
+
+    async def _idle_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._check_interval_s)
+            try:
+                await self.evict_idle()
+            except Exception as e:
+                print(f"Residency idle check failed: {e}")
+
+    def start(self) -> None:
+        if self._idle_task is None:
+            self._idle_task = asyncio.create_task(self._idle_loop())
+
+    def stop(self) -> None:
+        if self._idle_task is not None:
+            self._idle_task.cancel()
+            self._idle_task = None
+
+    def stats(self) -> dict:
+        return {
+            "device_budget_mb": self.device_budget_bytes >> 20,
+            "device_mb": self._device_bytes() >> 20,
+            "reserved_mb": {
+                name: nbytes >> 20 for name, nbytes in self._reserved.items()
+            },
+            "switches": self.switches,
+            "models": {
+                name: {
+                    "state": m.state,
+                    "in_use": m.in_use,
+                    "size_mb": m.size_bytes >> 20,
+                }
+                for name, m in self._models.items()
+            },
+        }
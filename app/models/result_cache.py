@@ -0,0 +1,194 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+from app.models.metrics import CACHE_REQUESTS
+
+
+class LRUCache:
+    # 按总字节数限制容量的内存 LRU，可选 TTL（秒），过期条目在访问时移除
+    # on_evict 在因容量不足淘汰条目时调用
+    def __init__(
+        self,
+        max_bytes: int,
+        sizeof: Callable[[Any], int] = len,
+        ttl_s: float | None = None,
+        on_evict: Callable[[str, Any], None] | None = None,
+    ):
+        self.max_bytes: int = max_bytes
+        self._sizeof: Callable[[Any], int] = sizeof
+        self._ttl_s: float | None = ttl_s
+        self._on_evict: Callable[[str, Any], None] | None = on_evict
+        self._items: OrderedDict[str, tuple[Any, int, float | None]] = OrderedDict()
+        self.total_bytes: int = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._items
+
+    def get(self, key: str) -> Any | None:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at = item[2]
+        if expires_at is not None and time.monotonic() >= expires_at:
+            self.pop(key)
+            return None
+        self._items.move_to_end(key)
+        return item[0]
+
+    def put(self, key: str, value: Any) -> None:
+        size = self._sizeof(value)
+        self.pop(key)
+        # 单个条目超过总容量时不缓存
+        if size > self.max_bytes:
+            return
+        expires_at = None
+        if self._ttl_s is not None:
+            expires_at = time.monotonic() + self._ttl_s
+        self._items[key] = (value, size, expires_at)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            evicted_key, (evicted, evicted_size, _) = self._items.popitem(last=False)
+            self.total_bytes -= evicted_size
+            if self._on_evict is not None:
+                self._on_evict(evicted_key, evicted)
+
+    def pop(self, key: str) -> Any | None:
+        item = self._items.pop(key, None)
+        if item is None:
+            return None
+        self.total_bytes -= item[1]
+        return item[0]
+
+
+class DiskCache:
+    # 目录中每个 key 对应一个文件，总大小超过上限时按最近访问时间淘汰
+    # 启动时扫描目录恢复索引，因此重启后仍然有效
+    def __init__(self, directory: str, max_bytes: int, suffix: str = ".bin"):
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self._suffix: str = suffix
+        self._lock: threading.Lock = threading.Lock()
+        self._index: OrderedDict[str, int] = OrderedDict()
+        self.total_bytes: int = 0
+
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith(".tmp"):
+                # put 写入后、替换前进程中断留下的临时文件，启动时清掉
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+                continue
+            if not name.endswith(suffix):
+                continue
+            stat = os.stat(os.path.join(directory, name))
+            entries.append((stat.st_mtime, name[: -len(suffix)], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self._suffix)
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            # 用 mtime 记录最近访问时间，重启后据此恢复 LRU 顺序
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            with self._lock:
+                self.total_bytes -= self._index.pop(key, 0)
+            return None
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        # 先写临时文件再原子替换，避免进程中断留下不完整文件
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self.total_bytes -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self.total_bytes += len(data)
+            self._evict()
+
+
+class TieredCache:
+    # 内存 LRU + 可选磁盘层；磁盘命中会提升到内存层
+    def __init__(
+        self, memory: LRUCache, disk: DiskCache | None = None, name: str = "result"
+    ):
+        self.memory: LRUCache = memory
+        self.disk: DiskCache | None = disk
+        self.name: str = name
+        self.memory_hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+
+    async def get(self, key: str) -> Any | None:
+        data = self.memory.get(key)
+        if data is not None:
+            self.memory_hits += 1
+            CACHE_REQUESTS.inc(cache=self.name, result="memory_hit")
+            return data
+        if self.disk is not None:
+            data = await asyncio.to_thread(self.disk.get, key)
+            if data is not None:
+                self.disk_hits += 1
+                CACHE_REQUESTS.inc(cache=self.name, result="disk_hit")
+                self.memory.put(key, data)
+                return data
+        self.misses += 1
+        CACHE_REQUESTS.inc(cache=self.name, result="miss")
+        return None
+
+    async def put(self, key: str, data: Any) -> None:
+        self.memory.put(key, data)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.put, key, data)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups
+            if lookups
+            else 0.0,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory.total_bytes,
+            "disk_entries": len(self.disk) if self.disk is not None else 0,
+            "disk_bytes": self.disk.total_bytes if self.disk is not None else 0,
+        }
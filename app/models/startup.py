@@ -0,0 +1,52 @@
+import time
+from contextlib import contextmanager
+
+from app.models.metrics import STARTUP_PHASE
+
+
+class StartupTracker:
+    # 记录启动各阶段（导入、模型加载、预热）的耗时与就绪状态，供 /readyz 与日志使用
+    def __init__(self):
+        self._start: float = time.monotonic()
+        self.phases: dict[str, float] = {}
+        self.current: str | None = None
+        self.ready: bool = False
+        self.ready_after_s: float | None = None
+        self.error: str | None = None
+        # 各阶段附带的报告，如编译缓存命中情况
+        self.details: dict[str, dict] = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        self.phases[name] = seconds
+        STARTUP_PHASE.set(seconds, phase=name)
+
+    @contextmanager
+    def phase(self, name: str):
+        self.current = name
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+            self.current = None
+
+    def mark_ready(self) -> None:
+        self.ready = True
+        self.ready_after_s = time.monotonic() - self._start
+        STARTUP_PHASE.set(self.ready_after_s, phase="total")
+
+    def fail(self, error: BaseException) -> None:
+        self.error = f"{type(error).__name__}: {error}"
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "phase": self.current,
+            "error": self.error,
+            "uptime_ms": round((time.monotonic() - self._start) * 1000),
+            "ready_after_ms": None
+            if self.ready_after_s is None
+            else round(self.ready_after_s * 1000),
+            "phases_ms": {k: round(v * 1000) for k, v in self.phases.items()},
+            "details": self.details,
+        }
@@ -0,0 +1,58 @@
+import asyncio
+from typing import AsyncIterator, Callable
+
+_END = object()
+
+
+class TokenStream:
+    # 推理线程逐步写入增量文本，事件循环侧异步迭代读取
+    def __init__(self):
+        self._loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._closed: bool = False
+
+    def put(self, text: str) -> None:
+        if text:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, text)
+
+    def close(self, error: BaseException | None = None) -> None:
+        # 可重复调用，只有第一次生效
+        def _close():
+            if not self._closed:
+                self._closed = True
+                self._queue.put_nowait(_END if error is None else error)
+
+        self._loop.call_soon_threadsafe(_close)
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        while True:
+            item = await self._queue.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+
+class IncrementalDecoder:
+    # 每次追加 token 后重新解码，只输出新增的完整字符；
+    # 末尾是不完整 UTF-8 字节（解码为 �）时暂缓输出
+    def __init__(self, decode: Callable[[list[int]], str]):
+        self._decode: Callable[[list[int]], str] = decode
+        self._token_ids: list[int] = []
+        self._emitted: str = ""
+
+    def push(self, token_id: int) -> str:
+        self._token_ids.append(token_id)
+        text = self._decode(self._token_ids)
+        if text.endswith("�"):
+            return ""
+        delta = text[len(self._emitted) :]
+        self._emitted = text
+        return delta
+
+    def flush(self) -> str:
+        text = self._decode(self._token_ids)
+        delta = text[len(self._emitted) :]
+        self._emitted = text
+        return delta
@@ -0,0 +1,110 @@
+import importlib
+
+from app.config import settings
+from app.models.residency import ResidencyManager
+from app.models.startup import StartupTracker
+
+# 按配置构造模型服务；单进程模式下由 app.main 调用，多进程模式下由模型工作进程调用
+
+SERVICE_NAMES = ("txt2img", "img2txt")
+
+
+def service_names(mode: str) -> list[str]:
+    if mode == "all":
+        return list(SERVICE_NAMES)
+    if mode in SERVICE_NAMES:
+        return [mode]
+    raise ValueError(f"Unsupported service mode: {mode}")
+
+
+async def build_services(
+    mode: str, startup: StartupTracker | None = None, warmup: bool = False
+) -> dict:
+    # mode="all" 时两个服务共用一个驻留管理器，模型在首次请求时加载（不预热）
+    startup = startup or StartupTracker()
+    residency = None
+    if mode == "all":
+        residency = ResidencyManager(
+            settings.residency_device_budget_mb << 20,
+            settings.residency_idle_timeout_s,
+            settings.residency_idle_action,
+        )
+        residency.start()
+    services = {}
+    for name in service_names(mode):
+        with startup.phase(f"import:{name}"):
+            importlib.import_module(f"app.service.{name}_service")
+        with startup.phase(f"load:{name}"):
+            service = await build_service(name, residency)
+        if warmup and residency is None:
+            with startup.phase(f"warmup:{name}"):
+                await service.warmup()
+            if hasattr(service, "compile_report"):
+                startup.details[f"compile:{name}"] = service.compile_report.summary()
+        services[name] = service
+    return services
+
+
+async def build_service(mode: str, residency: ResidencyManager | None = None):
+    if mode == "txt2img":
+        from app.service.txt2img_service import Txt2ImgService
+
+        return await Txt2ImgService.build(
+            model=settings.hf_home + "/" + settings.txt2img_model,
+            batch_size=settings.txt2img_batch_size,
+            num_inference_steps=settings.txt2img_infer_steps,
+            max_wait_ms=settings.txt2img_max_wait_ms,
+            cache_memory_mb=settings.txt2img_cache_memory_mb,
+            cache_dir=settings.txt2img_cache_dir,
+            cache_disk_mb=settings.txt2img_cache_disk_mb,
+            cache_unseeded=settings.txt2img_cache_unseeded,
+            batch_policy=settings.batch_policy,
+            request_timeout_s=settings.request_timeout_s,
+            expired_policy=settings.expired_policy,
+            admission_max_queued=settings.txt2img_admission_max_queued,
+            admission_max_queue_time_s=settings.txt2img_admission_max_queue_time_s,
+            residency=residency,
+            compile_mode=settings.txt2img_compile_mode,
+            compile_cache_dir=settings.compile_cache_dir,
+            warmup_batch_sizes=settings.txt2img_warmup_batch_sizes,
+            warmup_steps=settings.txt2img_warmup_steps,
+            sizes=settings.txt2img_size_list,
+            guidance_scale=settings.txt2img_guidance_scale,
+            max_inference_steps=settings.txt2img_max_infer_steps,
+            continuous_batching=settings.txt2img_continuous_batching,
+            max_running=settings.txt2img_max_running,
+            prompt_cache_device_mb=settings.txt2img_prompt_cache_device_mb,
+            prompt_cache_host_mb=settings.txt2img_prompt_cache_host_mb,
+            output_formats=settings.txt2img_output_qualities,
+            encode_workers=settings.txt2img_encode_workers,
+            flow_weights=settings.infer_flow_weights,
+        )
+    if mode == "img2txt":
+        from app.service.img2txt_service import Img2TxtService
+
+        return await Img2TxtService.build(
+            model=settings.hf_home + "/" + settings.img2txt_model,
+            max_new_tokens=settings.img2txt_max_new_tokens,
+            max_new_tokens_limit=settings.img2txt_max_new_tokens_limit,
+            max_wait_ms=settings.img2txt_max_wait_ms,
+            continuous_batching=settings.img2txt_continuous_batching,
+            max_running=settings.img2txt_max_running,
+            cache_memory_mb=settings.img2txt_cache_memory_mb,
+            cache_ttl_s=settings.img2txt_cache_ttl_s,
+            perceptual_cache=settings.img2txt_cache_perceptual,
+            feature_cache_device_mb=settings.img2txt_feature_cache_device_mb,
+            feature_cache_host_mb=settings.img2txt_feature_cache_host_mb,
+            preprocess_workers=settings.img2txt_preprocess_workers,
+            bucket_edges=settings.img2txt_bucket_edges,
+            batch_token_budget=settings.img2txt_batch_token_budget,
+            bucket_max_waste=settings.img2txt_bucket_max_waste,
+            bucket_refit_every=settings.img2txt_bucket_refit_every,
+            batch_policy=settings.batch_policy,
+            request_timeout_s=settings.request_timeout_s,
+            expired_policy=settings.expired_policy,
+            admission_max_queued=settings.img2txt_admission_max_queued,
+            admission_max_queue_time_s=settings.img2txt_admission_max_queue_time_s,
+            residency=residency,
+            flow_weights=settings.infer_flow_weights,
+        )
+    raise ValueError(f"Unsupported service mode: {mode}")
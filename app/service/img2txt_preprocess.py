@@ -0,0 +1,75 @@
+from dataclasses import dataclass
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from app.models.image_hash import content_hash, perceptual_hash
+from app.models.preprocess_pool import SharedArray, read_array, share_array
+
+# 本模块的函数在预处理进程池的工作进程中执行，只依赖 PIL / numpy / processor，
+# 不加载模型；图片像素与 pixel_values 通过共享内存返回给主进程
+
+_processor = None
+
+
+def init_worker(model_path: str | None) -> None:
+    global _processor
+    if model_path:
+        from transformers import AutoProcessor
+
+        _processor = AutoProcessor.from_pretrained(model_path)
+
+
+@dataclass
+class DecodedImage:
+    # (H, W, 3) uint8 RGB 像素
+    pixels: SharedArray
+    content_hash: str | None
+    phash: str | None
+
+    @property
+    def width(self) -> int:
+        return self.pixels.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.pixels.shape[0]
+
+
+@dataclass
+class PreparedInputs:
+    input_ids: list[int]
+    pixel_values: SharedArray
+    image_grid_thw: list[list[int]]
+
+
+def decode_image(data: bytes, with_hash: bool, perceptual: bool) -> DecodedImage:
+    with Image.open(BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    phash = perceptual_hash(img) if with_hash and perceptual else None
+    return DecodedImage(
+        share_array(np.asarray(img)),
+        content_hash(img) if with_hash else None,
+        phash,
+    )
+
+
+def prepare_inputs(pixels: SharedArray, prompt: str) -> PreparedInputs:
+    # resize / normalize / patchify 与 tokenize（图片占位符按 patch 数展开）
+    image = Image.fromarray(read_array(pixels))
+    messages = [
+        {
+            "role": "user",
+            "content": [{"type": "image"}, {"type": "text", "text": prompt}],
+        }
+    ]
+    text = _processor.apply_chat_template(
+        messages, add_generation_prompt=True, tokenize=False
+    )
+    outputs = _processor(text=[text], images=[image], return_tensors="np")
+    return PreparedInputs(
+        outputs["input_ids"][0].tolist(),
+        share_array(outputs["pixel_values"]),
+        outputs["image_grid_thw"].tolist(),
+    )
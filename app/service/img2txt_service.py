@@ -1,40 +1,252 @@
-from transformers import AutoProcessor, AutoModelForVision2Seq
-from typing import ClassVar, Optional, Any
-from app.models.infer_queue import InferQueue
+from transformers import AutoProcessor, AutoModelForVision2Seq, DynamicCache
+from transformers.generation.stopping_criteria import (
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
+from transformers.generation.streamers import BaseStreamer
+from typing import AsyncIterator, ClassVar, Optional, Any
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from app.models.infer_queue import (
+    NORMAL,
+    InferQueue,
+    resolve_deadline,
+    resolve_priority,
+)
+from app.models.metrics import (
+    BATCH_FILL_RATIO,
+    BATCH_WAIT,
+    BATCH_FLUSHES,
+    BUCKET_BATCH_SIZE,
+    BUCKET_EDGE,
+    GENERATED_TOKENS,
+    QUEUE_DEPTH,
+)
+from app.models.admission import AdmissionController
+from app.models.batch_policy import BatchPolicy, make_batch_policy
+from app.models.bucket_planner import BucketPlanner, InputTooLarge
+from app.models.continuous_batcher import ContinuousBatcher
+from app.models.feature_cache import FeatureCache
+from app.models.preprocess_pool import PreprocessPool, read_array, release_array
+from app.models.residency import ResidencyManager, module_bytes, weights_bytes
+from app.models.result_cache import LRUCache, TieredCache
+from app.models.token_stream import IncrementalDecoder, TokenStream
+from app.service.img2txt_preprocess import (
+    DecodedImage,
+    PreparedInputs,
+    decode_image,
+    init_worker,
+    prepare_inputs,
+)
+from io import BytesIO
+from PIL import Image
 import asyncio
 from asyncio import Future
+import contextlib
+import gc
+import hashlib
+import json
+import threading
+import time
 import torch
-from PIL import Image
+import torch.nn.functional as F
+
+
+@dataclass
+class _Request:
+    # 预处理进程池输出的 input_ids 与 pixel_values（共享内存）
+    prepared: PreparedInputs
+    prompt: str
+    stream: TokenStream | None = None
+    # 解码后像素的内容哈希，用于视觉特征缓存
+    image_key: str | None = None
+    # continuous batching 路径下预处理好的模型输入
+    inputs: dict | None = None
+    # 超过该时间（time.monotonic）仍未开始推理则不再执行
+    deadline: float | None = None
+    # 分桶路径下每个请求单独的结果 future，以及所在批次的 flush 任务
+    future: Future | None = None
+    flush_task: asyncio.Task | None = None
+    # 本请求最多生成的 token 数，None 使用服务默认值；同一批中可以各不相同
+    max_new_tokens: int | None = None
+    # 推理队列中的优先级，批按其中最高的优先级排队
+    priority: int = NORMAL
+    # 加入攒批的时间（time.monotonic），flush 时记录在攒批中等待的时长
+    batched_at: float = 0.0
+
+
+def _collate(
+    prepared: list[PreparedInputs], pad_token_id: int, device
+) -> dict[str, torch.Tensor]:
+    # 把多个请求的预处理结果左填充拼成一个批，同时释放 pixel_values 的共享内存
+    max_len = max(len(p.input_ids) for p in prepared)
+    input_ids = torch.full((len(prepared), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(prepared), max_len), dtype=torch.long)
+    for i, p in enumerate(prepared):
+        input_ids[i, max_len - len(p.input_ids) :] = torch.tensor(p.input_ids)
+        attention_mask[i, max_len - len(p.input_ids) :] = 1
+    pixel_values = torch.cat(
+        [torch.from_numpy(read_array(p.pixel_values, unlink=True)) for p in prepared]
+    )
+    image_grid_thw = torch.tensor(
+        [grid for p in prepared for grid in p.image_grid_thw], dtype=torch.long
+    )
+    return {
+        "input_ids": input_ids.to(device, non_blocking=True),
+        "attention_mask": attention_mask.to(device, non_blocking=True),
+        "pixel_values": pixel_values.to(device, non_blocking=True),
+        "image_grid_thw": image_grid_thw.to(device, non_blocking=True),
+    }
+
+
+# 推理线程当前批次中每张图片的内容哈希，按顺序与 image_grid_thw 对应
+_vision_context = threading.local()
+
+
+@contextmanager
+def _image_keys(keys: list[str | None]):
+    _vision_context.keys = keys
+    try:
+        yield
+    finally:
+        _vision_context.keys = None
+
+
+def _install_feature_cache(model: AutoModelForVision2Seq, cache: FeatureCache) -> None:
+    # 替换 get_image_features：已缓存的图片直接取特征，只对未命中的图片运行视觉编码器
+    inner = getattr(model, "model", model)
+    encode = inner.get_image_features
+
+    def get_image_features(pixel_values, image_grid_thw=None):
+        keys = getattr(_vision_context, "keys", None)
+        if keys is None or image_grid_thw is None or len(keys) != len(image_grid_thw):
+            return encode(pixel_values, image_grid_thw)
+
+        offsets = [0]
+        for patches in image_grid_thw.prod(-1).tolist():
+            offsets.append(offsets[-1] + patches)
+        embeds = [cache.get(key) if key is not None else None for key in keys]
+        missing = [i for i, embed in enumerate(embeds) if embed is None]
+        if missing:
+            computed = encode(
+                torch.cat([pixel_values[offsets[i] : offsets[i + 1]] for i in missing]),
+                image_grid_thw[missing],
+            )
+            for i, embed in zip(missing, computed):
+                embeds[i] = embed
+                if keys[i] is not None:
+                    # embed 是整批输出的视图；复制出来，缓存条目不引用整批的存储
+                    cache.put(keys[i], embed.clone())
+        return tuple(embeds)
+
+    inner.get_image_features = get_image_features
+
+
+class _RowLimits(StoppingCriteria):
+    # 批内每行各自的 max_new_tokens：到达上限的行标记为结束，generate 之后只为它填充 pad，
+    # 整批在最长的行结束时停止
+    def __init__(self, input_len: int, limits: list[int]):
+        self._input_len: int = input_len
+        self._limits: list[int] = limits
+
+    def __call__(self, input_ids: torch.Tensor, scores, **kwargs) -> torch.BoolTensor:
+        limits = torch.tensor(self._limits, device=input_ids.device)
+        return input_ids.shape[-1] - self._input_len >= limits
+
+
+def _eos_token_ids(model: AutoModelForVision2Seq) -> set[int]:
+    eos = model.generation_config.eos_token_id
+    return set(eos if isinstance(eos, list) else [eos])
+
+
+def _make_decoder(processor: AutoProcessor) -> IncrementalDecoder:
+    return IncrementalDecoder(
+        lambda token_ids: processor.decode(token_ids, skip_special_tokens=True)
+    )
 
 
 class Img2TxtService:
     _lock: ClassVar[asyncio.Lock] = asyncio.Lock()
     _instance: ClassVar[Optional["Img2TxtService"]] = None
 
-    def __init__(self, model: str, max_new_tokens: int, max_wait_ms: int):
+    def __init__(
+        self,
+        model: str,
+        max_new_tokens: int,
+        max_wait_ms: int,
+        continuous_batching: bool = False,
+        max_running: int = 16,
+        cache: TieredCache | None = None,
+        perceptual_cache: bool = False,
+        feature_cache: FeatureCache | None = None,
+        preprocess_workers: int = 0,
+        planner: BucketPlanner | None = None,
+        batch_policy: str = "fixed",
+        request_timeout_s: float = 0,
+        expired_policy: str = "drop",
+        admission: AdmissionController | None = None,
+        residency: ResidencyManager | None = None,
+        max_new_tokens_limit: int = 1024,
+        flow_weights: dict[str, float] | None = None,
+    ):
         self._model_path = model
-        self.queue: InferQueue = InferQueue()
+        self.queue: InferQueue = InferQueue(expired_policy)
+        # 各分桶（flow 为 bucket-0、bucket-1 ...）在推理队列中的权重，默认均为 1
+        for flow, weight in (flow_weights or {}).items():
+            self.queue.set_weight(flow, weight)
         self.processor: AutoProcessor | None = None
         self.model: AutoModelForVision2Seq | None = None
+        self._max_new_tokens: int = max_new_tokens
+        # 请求可指定的 max_new_tokens 上限
+        self.max_new_tokens_limit: int = max_new_tokens_limit
+        self._continuous_batching: bool = continuous_batching
+        self._max_running: int = max_running
+        # 开启 continuous batching 时替代 Bucket 的攒批 flush 流程
+        self.batcher: ContinuousBatcher | None = None
+        # 按图片内容（或感知哈希）+ prompt + 生成参数缓存结果
+        self.cache: TieredCache | None = cache
+        self._perceptual_cache: bool = perceptual_cache
+        # 请求从到达起的截止时间（0 表示不限），过期的批在进入推理线程前被丢弃
+        self._request_timeout_s: float = request_timeout_s
+        # 限制排队请求数与预计排队时间，超限时拒绝新请求
+        self.admission: AdmissionController = admission or AdmissionController(
+            max_queued=256, max_queue_time_s=60.0, name="img2txt"
+        )
+        # 与其他模型共享设备时由驻留管理器按需加载 / 换出模型（processor 始终加载）
+        self.residency: ResidencyManager | None = residency
+        # 视觉编码器输出缓存，同一张图片的多次提问跳过视觉编码
+        self.feature_cache: FeatureCache | None = feature_cache
+        # 图片解码与 processor 预处理在独立的进程池中执行，不阻塞事件循环，
+        # 也不占用推理派发所用的默认线程池；在 _initialize 中创建
+        self._preprocess_workers: int = preprocess_workers
+        self.preprocess_pool: PreprocessPool | None = None
+        # 从共享内存取回 pixel_values 并拼批的专用线程
+        self.collate_executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="img2txt-collate"
+        )
         self.dtype: torch.dtype = (
             torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
         )
 
-        size_S = 1024 * 1024 + 1024
-        bucket_L: Bucket = Bucket(
-            self.queue, self.dtype, 2, max_new_tokens, max_wait_ms
-        )
-        bucket_M: Bucket = Bucket(
-            self.queue, self.dtype, 8, max_new_tokens, max_wait_ms
-        )
-        bucket_S: Bucket = Bucket(
-            self.queue, self.dtype, 32, max_new_tokens, max_wait_ms
+        # 按实际 token 数分桶，边界与批大小随请求分布周期性调整；
+        # Bucket 对象固定为最大路由数个（含溢出桶），边界变化时原地更新批大小
+        self.planner: BucketPlanner = planner or BucketPlanner(
+            [1536, 6144, 24576], token_budget=49152
         )
-        self.buckets: list[tuple[Bucket, int]] = [
-            (bucket_S, size_S),
-            (bucket_M, size_S * 4),
-            (bucket_L, size_S * 16),
+        self.buckets: list[Bucket] = [
+            Bucket(
+                self.queue,
+                self.dtype,
+                self.planner.batch_size(min(i, len(self.planner.edges) - 1)),
+                max_new_tokens,
+                make_batch_policy(batch_policy, max_wait_ms),
+                flow=f"bucket-{i}",
+                admission=self.admission,
+            )
+            for i in range(self.planner.max_routes)
         ]
+        self._apply_plan()
 
     @classmethod
     async def build(
@@ -42,54 +254,330 @@ class Img2TxtService:
         model: str,
         max_new_tokens: int = 100,
         max_wait_ms: int = 5 * 1000,
+        continuous_batching: bool = False,
+        max_running: int = 16,
+        cache_memory_mb: int = 0,
+        cache_ttl_s: float | None = None,
+        perceptual_cache: bool = False,
+        feature_cache_device_mb: int = 0,
+        feature_cache_host_mb: int = 0,
+        preprocess_workers: int = 0,
+        bucket_edges: list[int] | None = None,
+        batch_token_budget: int = 49152,
+        bucket_max_waste: float = 0.2,
+        bucket_refit_every: int = 256,
+        batch_policy: str = "fixed",
+        request_timeout_s: float = 0,
+        expired_policy: str = "drop",
+        admission_max_queued: int = 256,
+        admission_max_queue_time_s: float = 60.0,
+        residency: ResidencyManager | None = None,
+        max_new_tokens_limit: int = 1024,
+        flow_weights: dict[str, float] | None = None,
     ) -> "Img2TxtService":
         async with cls._lock:
             if cls._instance is None:
-                inst = cls(model, max_new_tokens, max_wait_ms)
+                cache = None
+                if cache_memory_mb > 0:
+                    cache = TieredCache(
+                        LRUCache(
+                            cache_memory_mb << 20,
+                            sizeof=lambda text: len(text.encode("utf-8")),
+                            ttl_s=cache_ttl_s,
+                        ),
+                        name="img2txt",
+                    )
+                feature_cache = None
+                if feature_cache_device_mb > 0:
+                    feature_cache = FeatureCache(
+                        feature_cache_device_mb << 20,
+                        feature_cache_host_mb << 20,
+                        sizeof=lambda t: t.numel() * t.element_size(),
+                        to_host=lambda t: t.to("cpu"),
+                        to_device=lambda t: t.to("cuda", non_blocking=True),
+                    )
+                inst = cls(
+                    model,
+                    max_new_tokens,
+                    max_wait_ms,
+                    continuous_batching,
+                    max_running,
+                    cache,
+                    perceptual_cache,
+                    feature_cache,
+                    preprocess_workers,
+                    BucketPlanner(
+                        bucket_edges or [1536, 6144, 24576],
+                        token_budget=batch_token_budget,
+                        max_waste=bucket_max_waste,
+                        refit_every=bucket_refit_every,
+                    ),
+                    batch_policy,
+                    request_timeout_s,
+                    expired_policy,
+                    AdmissionController(
+                        admission_max_queued,
+                        admission_max_queue_time_s,
+                        name="img2txt",
+                    ),
+                    residency,
+                    max_new_tokens_limit,
+                    flow_weights,
+                )
                 await inst._initialize()
                 cls._instance = inst
             return cls._instance
 
+    def _load_model(self) -> None:
+        self.model = AutoModelForVision2Seq.from_pretrained(
+            self._model_path,
+            device_map="cuda",
+            torch_dtype=self.dtype,
+        )
+        self._attach_model()
+
+    def _attach_model(self) -> None:
+        if self.feature_cache is not None:
+            _install_feature_cache(self.model, self.feature_cache)
+
+        for bucket in self.buckets:
+            bucket.processor = self.processor
+            bucket.model = self.model
+            bucket.collate_executor = self.collate_executor
+
+        if self._continuous_batching:
+            engine = QwenStepEngine(
+                self.model, self.processor, self.dtype, self._max_new_tokens
+            )
+            self.batcher = ContinuousBatcher(self.queue, engine, self._max_running)
+
+    def _unload_model(self) -> None:
+        self.model = None
+        self.batcher = None
+        for bucket in self.buckets:
+            bucket.model = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
     async def _initialize(
         self,
     ):
-        def load_model():
-            processor = AutoProcessor.from_pretrained(self._model_path)
-            self.processor = processor
-            model = AutoModelForVision2Seq.from_pretrained(
-                self._model_path,
-                device_map="cuda",
-                torch_dtype=self.dtype,
+        self.preprocess_pool = PreprocessPool(
+            self._preprocess_workers,
+            init_worker,
+            (self._model_path,),
+            name="img2txt-preprocess",
+        )
+        self.processor = await asyncio.to_thread(
+            AutoProcessor.from_pretrained, self._model_path
+        )
+        if self.residency is not None:
+            # 首次请求时才加载模型
+            self.residency.register(
+                "img2txt",
+                load=self._load_model,
+                offload=lambda: self.model.to("cpu"),
+                restore=lambda: self.model.to("cuda"),
+                unload=self._unload_model,
+                size=lambda: module_bytes(self.model),
+                estimate_bytes=weights_bytes(self._model_path),
             )
-            self.model = model
+            if self.feature_cache is not None:
+                # 视觉特征缓存的设备层不随模型换出，按上限占用显存
+                self.residency.reserve(
+                    "img2txt_feature_cache", self.feature_cache.device.max_bytes
+                )
+            return
+        await asyncio.to_thread(self._load_model)
 
-        await asyncio.to_thread(load_model)
+    async def warmup(self) -> None:
+        # 用一张小图走一遍预处理、拼批与 generate，预热进程池与 CUDA kernel
+        buffer = BytesIO()
+        Image.new("RGB", (64, 64)).save(buffer, format="PNG")
+        decoded = await self.preprocess_pool.run(
+            decode_image, buffer.getvalue(), False, False
+        )
+        try:
+            await self._generate(decoded, "warmup", None, None)
+        finally:
+            release_array(decoded.pixels)
 
-        for bucket, _ in self.buckets:
-            bucket.processor = self.processor
-            bucket.model = self.model
+    def _resident(self):
+        if self.residency is None:
+            return contextlib.nullcontext()
+        return self.residency.use("img2txt")
 
-    async def queued_generate(self, image_pth: str, prompt: str) -> str:
-        assert self.processor is not None and self.model is not None, (
-            "Model not initialized yet"
+    async def stream_generate(
+        self,
+        image: bytes,
+        prompt: str,
+        max_new_tokens: int | None = None,
+        priority: str | None = None,
+        timeout_ms: int | None = None,
+    ) -> AsyncIterator[str]:
+        stream = TokenStream()
+        task = asyncio.create_task(
+            self.queued_generate(
+                image,
+                prompt,
+                stream=stream,
+                max_new_tokens=max_new_tokens,
+                priority=priority,
+                timeout_ms=timeout_ms,
+            )
         )
+        task.add_done_callback(
+            lambda t: stream.close(None if t.cancelled() else t.exception())
+        )
+        streamed = False
+        try:
+            async for text in stream:
+                streamed = True
+                yield text
+            # 未经过模型（缓存命中或输入过大）时直接输出完整结果
+            if not streamed and task.result():
+                yield task.result()
+        finally:
+            if not task.done():
+                task.cancel()
 
-        with Image.open(image_pth) as img:
-            width, height = img.size
-            image_size = width * height
-        prompt_size = image_size + len(prompt)
+    def check_max_new_tokens(self, max_new_tokens: int | None) -> int:
+        # None 表示默认值；超出范围抛出 ValueError
+        if max_new_tokens is None:
+            return self._max_new_tokens
+        if not 1 <= max_new_tokens <= self.max_new_tokens_limit:
+            raise ValueError(
+                f"max_new_tokens must be between 1 and {self.max_new_tokens_limit}"
+            )
+        return max_new_tokens
 
-        # TODO: 处理异常
-        if prompt_size > self.buckets[2][1]:
-            return f"数据过大: {width}*{height}+{len(prompt)}={prompt_size}"
+    async def queued_generate(
+        self,
+        image: bytes,
+        prompt: str,
+        stream: TokenStream | None = None,
+        max_new_tokens: int | None = None,
+        priority: str | None = None,
+        timeout_ms: int | None = None,
+    ) -> str:
+        # priority 为 high / normal / best_effort；timeout_ms 为本请求的截止时间，
+        # 与服务默认的 request_timeout_s 取较小者
+        assert self.processor is not None and (
+            self.model is not None or self.residency is not None
+        ), "Model not initialized yet"
+        max_new_tokens = self.check_max_new_tokens(max_new_tokens)
+        level = resolve_priority(priority)
+        deadline = resolve_deadline(timeout_ms, self._request_timeout_s)
+        decoded = await self.preprocess_pool.run(
+            decode_image,
+            image,
+            self.cache is not None or self.feature_cache is not None,
+            self._perceptual_cache,
+            discard=lambda decoded: release_array(decoded.pixels),
+        )
+        try:
+            cache_key = None
+            # 在选择分桶之前检查缓存，命中时不占用批次名额
+            if self.cache is not None:
+                if decoded.phash:
+                    image_key = "p:" + decoded.phash
+                else:
+                    image_key = "c:" + decoded.content_hash
+                cache_key = self._cache_key(image_key, prompt, max_new_tokens)
+                text = await self.cache.get(cache_key)
+                if text is not None:
+                    return text
 
-        for bk, sz in self.buckets:
-            if prompt_size <= sz:
-                bucket = bk
-                print(f"DEBUG: use bucket_size: {sz}")
-                break
+            # 缓存未命中才占用排队名额；超过上限时在预处理之前拒绝
+            with self.admission.admit():
+                async with self._resident():
+                    text = await self._generate(
+                        decoded, prompt, stream, deadline, max_new_tokens, level
+                    )
+        finally:
+            release_array(decoded.pixels)
+
+        if cache_key is not None:
+            await self.cache.put(cache_key, text)
+        return text
+
+    async def _generate(
+        self,
+        decoded: DecodedImage,
+        prompt: str,
+        stream: TokenStream | None,
+        deadline: float | None,
+        max_new_tokens: int | None = None,
+        priority: int = NORMAL,
+    ) -> str:
+        prepared = await self.preprocess_pool.run(
+            prepare_inputs,
+            decoded.pixels,
+            prompt,
+            discard=lambda prepared: release_array(prepared.pixel_values),
+        )
+        release_array(decoded.pixels)
+        request = _Request(
+            prepared,
+            prompt,
+            stream,
+            decoded.content_hash,
+            deadline=deadline,
+            max_new_tokens=max_new_tokens,
+            priority=priority,
+        )
 
-        return await bucket.submit(image_pth, prompt)
+        # input_ids 中图片占位符已按 resize 后的 patch 数展开，长度即实际 token 数
+        tokens = len(prepared.input_ids)
+        index = self.planner.route(tokens)
+        if index is None:
+            release_array(prepared.pixel_values)
+            raise InputTooLarge(tokens, self.planner.max_tokens)
+        if self.planner.observe(tokens):
+            self._apply_plan()
+
+        if self.batcher is not None:
+            request.inputs = await asyncio.get_running_loop().run_in_executor(
+                self.collate_executor,
+                _collate,
+                [prepared],
+                self.processor.tokenizer.pad_token_id,
+                self.model.device,
+            )
+            return await self.batcher.submit(request, priority, deadline)
+        # 沿用重新划分前的路由结果：新边界只影响之后到达的请求
+        return await self.buckets[index].submit(request)
+
+    def _apply_plan(self) -> None:
+        # 新边界只影响之后到达的请求，已在攒批中的请求按原批次处理
+        for i, bucket in enumerate(self.buckets):
+            if i < len(self.planner.edges):
+                bucket.batch_size = self.planner.batch_size(i)
+                BUCKET_EDGE.set(self.planner.edges[i], bucket=bucket.flow)
+            else:
+                # 未启用的分桶
+                BUCKET_EDGE.set(0, bucket=bucket.flow)
+            BUCKET_BATCH_SIZE.set(bucket.batch_size, bucket=bucket.flow)
+
+    def shutdown(self) -> None:
+        if self.preprocess_pool is not None:
+            self.preprocess_pool.shutdown()
+        self.collate_executor.shutdown(wait=False)
+
+    def _cache_key(
+        self, image_key: str, prompt: str, max_new_tokens: int | None = None
+    ) -> str:
+        raw = json.dumps(
+            [
+                self._model_path,
+                image_key,
+                prompt,
+                max_new_tokens or self._max_new_tokens,
+            ],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
 
 class Bucket:
@@ -99,84 +587,412 @@ class Bucket:
         dtype: torch.dtype,
         batch_size: int,
         max_new_tokens: int,
-        max_wait_ms: int,
+        policy: BatchPolicy,
+        flow: str = "default",
+        admission: AdmissionController | None = None,
     ):
         self.queue: InferQueue = queue
+        # 记录批次耗时，用于估计排队时间
+        self.admission: AdmissionController | None = admission
+        # 在 InferQueue 中按分桶做加权公平调度
+        self.flow: str = flow
         self.dtype: torch.dtype = dtype
         self.processor: AutoProcessor | None = None
         self.model: AutoModelForVision2Seq | None = None
-        self._batch_size: int = batch_size
-        self._batch_messages: list = []
-        self._future_result: Future = asyncio.Future()
+        self.collate_executor: ThreadPoolExecutor | None = None
+        self.batch_size: int = batch_size
+        self._batch_requests: list[_Request] = []
+        # 已 flush、尚未完成的批：flush 任务 -> 批内请求
+        self._inflight: dict[asyncio.Task, list[_Request]] = {}
         self._max_new_tokens: int = max_new_tokens
-        self._max_wait_ms: int = max_wait_ms
+        # 决定未满的批何时 flush
+        self.policy: BatchPolicy = policy
         self._batch_id: int = 0
 
-    def _infer_sync(self, inputs: dict) -> Any:
-        with torch.amp.autocast("cuda", self.dtype):
-            return self.model.generate(**inputs, max_new_tokens=self._max_new_tokens)
-
-    async def _process_inputs(self, messages: list) -> dict:
-        def thread_process_inputs():
-            inputs = self.processor.apply_chat_template(
-                messages,
-                add_generation_prompt=True,
-                tokenize=True,
-                return_dict=True,
-                padding=True,
-                padding_side="left",
-                return_tensors="pt",
-            ).to(self.model.device, non_blocking=True)
-            return inputs
-
-        return await asyncio.to_thread(thread_process_inputs)
-
-    async def flush_batch(self) -> Future:
-        if len(self._batch_messages) == 0:
-            return self._future_result
-        batch_messages = self._batch_messages
-        future_result = self._future_result
+    def _limits(self, batch_requests: list[_Request]) -> list[int]:
+        return [r.max_new_tokens or self._max_new_tokens for r in batch_requests]
+
+    def _infer_sync(self, inputs: dict, batch_requests: list[_Request]) -> Any:
+        limits = self._limits(batch_requests)
+        streams = [request.stream for request in batch_requests]
+        streamer = None
+        if any(stream is not None for stream in streams):
+            streamer = _BatchStreamer(
+                self.processor, streams, _eos_token_ids(self.model), limits
+            )
+        # max_new_tokens 不同的请求共用一次 generate，按行单独停止
+        stopping_criteria = None
+        if len(set(limits)) > 1:
+            stopping_criteria = StoppingCriteriaList(
+                [_RowLimits(inputs["input_ids"].shape[-1], limits)]
+            )
+        with (
+            _image_keys([request.image_key for request in batch_requests]),
+            torch.amp.autocast("cuda", self.dtype),
+        ):
+            return self.model.generate(
+                **inputs,
+                max_new_tokens=max(limits),
+                stopping_criteria=stopping_criteria,
+                streamer=streamer,
+            )
+
+    def _timed_infer(self, inputs: dict, batch_requests: list[_Request]) -> Any:
+        start = time.perf_counter()
+        try:
+            return self._infer_sync(inputs, batch_requests)
+        finally:
+            if self.admission is not None:
+                self.admission.observe_batch(
+                    time.perf_counter() - start, len(batch_requests)
+                )
+
+    async def _process_inputs(self, batch_requests: list[_Request]) -> dict:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.collate_executor,
+            _collate,
+            [r.prepared for r in batch_requests],
+            self.processor.tokenizer.pad_token_id,
+            self.model.device,
+        )
+
+    async def flush_batch(self, reason: str = "full") -> None:
+        if len(self._batch_requests) == 0:
+            return
+        batch_requests = self._batch_requests
         self._batch_id += 1
-        self._batch_messages = []
-        self._future_result = asyncio.Future()
+        self._batch_requests = []
+        QUEUE_DEPTH.set(0, queue=self.flow)
+        BATCH_FLUSHES.inc(queue=self.flow, reason=reason)
+        BATCH_FILL_RATIO.observe(len(batch_requests) / self.batch_size, queue=self.flow)
+        now = time.monotonic()
+        for r in batch_requests:
+            BATCH_WAIT.observe(now - r.batched_at, queue=self.flow)
+        task = asyncio.current_task()
+        self._inflight[task] = batch_requests
+        for r in batch_requests:
+            r.flush_task = task
         try:
-            inputs = await self._process_inputs(batch_messages)
-            outputs = await self.queue.submit(lambda: self._infer_sync(inputs))
-            future_result.set_result((inputs, outputs))
+            inputs = await self._process_inputs(batch_requests)
+            # 批按其中最高的优先级排队，最晚的截止时间也已过去时整批丢弃；
+            # cost 按 token 数计
+            deadlines = [r.deadline for r in batch_requests]
+            outputs = await self.queue.submit(
+                lambda: self._timed_infer(inputs, batch_requests),
+                flow=self.flow,
+                priority=min(r.priority for r in batch_requests),
+                deadline=None if None in deadlines else max(deadlines),
+                cost=sum(len(r.prepared.input_ids) for r in batch_requests),
+            )
+        except asyncio.CancelledError:
+            # 批内请求全部取消，推理队列会跳过这个批
+            for r in batch_requests:
+                release_array(r.prepared.pixel_values)
+            raise
         except Exception as e:
-            future_result.set_exception(e)
+            for r in batch_requests:
+                if not r.future.done():
+                    r.future.set_exception(e)
+        else:
+            input_len = inputs["input_ids"].shape[-1]
+            # 每行只取到自己的 max_new_tokens 为止
+            rows = [
+                outputs[i][input_len : input_len + limit]
+                for i, limit in enumerate(self._limits(batch_requests))
+            ]
+            GENERATED_TOKENS.inc(
+                sum(
+                    int((row != self.processor.tokenizer.pad_token_id).sum())
+                    for row in rows
+                )
+            )
+            for r, row in zip(batch_requests, rows):
+                if not r.future.done():
+                    r.future.set_result(
+                        self.processor.decode(row, skip_special_tokens=True)
+                    )
         finally:
-            return future_result
+            self._inflight.pop(task, None)
 
     async def _flush_batch_later(self, batch_id: int):
-        await asyncio.sleep(self._max_wait_ms / 1000.0)
-        if batch_id == self._batch_id and len(self._batch_messages) > 0:
-            await self.flush_batch()
-
-    async def submit(self, image_pth: str, prompt: str) -> str:
-        result_id = len(self._batch_messages)
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image", "url": image_pth},
-                    {"type": "text", "text": prompt},
-                ],
-            }
-        ]
-        self._batch_messages.append(messages)
-        if len(self._batch_messages) >= self._batch_size:
-            future_result = await self.flush_batch()
-            (inputs, outputs) = await future_result
-            return self.processor.decode(
-                outputs[result_id][inputs["input_ids"].shape[-1] :],
-                skip_special_tokens=True,
+        start = time.monotonic()
+        while True:
+            delay = self.policy.wait_s(
+                len(self._batch_requests), self.batch_size, time.monotonic() - start
             )
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+            if batch_id != self._batch_id:
+                return
+        if batch_id == self._batch_id and len(self._batch_requests) > 0:
+            await self.flush_batch("timer")
+
+    def _cancel(self, request: _Request) -> None:
+        if request in self._batch_requests:
+            # 还在攒批：移出批次，空出的名额留给下一个请求
+            self._batch_requests.remove(request)
+            QUEUE_DEPTH.set(len(self._batch_requests), queue=self.flow)
+            release_array(request.prepared.pixel_values)
+            if not self._batch_requests:
+                # 批次清空后作废当前的 flush 定时器
+                self._batch_id += 1
+            return
+        batch = self._inflight.get(request.flush_task)
+        if batch is not None and all(r.future.done() for r in batch):
+            request.flush_task.cancel()
+
+    async def submit(self, request: _Request) -> str:
+        request.future = asyncio.get_running_loop().create_future()
+        request.batched_at = time.monotonic()
+        self._batch_requests.append(request)
+        QUEUE_DEPTH.set(len(self._batch_requests), queue=self.flow)
+        self.policy.on_arrival()
+        # flush 在独立任务中执行，单个请求取消不会中断整批
+        if len(self._batch_requests) >= self.batch_size:
+            asyncio.create_task(self.flush_batch())
+        elif len(self._batch_requests) == 1:
+            asyncio.create_task(self._flush_batch_later(self._batch_id))
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            self._cancel(request)
+            raise
+
+
+class _BatchStreamer(BaseStreamer):
+    # generate 每个 step 回调一次 put，按行增量解码后推送到对应请求的 TokenStream
+    def __init__(
+        self,
+        processor: AutoProcessor,
+        streams: list[TokenStream | None],
+        eos_ids: set[int],
+        limits: list[int] | None = None,
+    ):
+        self._streams: list[TokenStream | None] = streams
+        # 每行的 max_new_tokens，到达后该行不再输出（之后的 token 是 pad）
+        self._remaining: list[float] = list(limits or [float("inf")] * len(streams))
+        self._decoders: list[IncrementalDecoder | None] = [
+            _make_decoder(processor) if stream is not None else None
+            for stream in streams
+        ]
+        self._finished: list[bool] = [stream is None for stream in streams]
+        self._eos_ids: set[int] = eos_ids
+        self._prompt_seen: bool = False
+
+    def put(self, value: torch.Tensor) -> None:
+        # 第一次回调是 prompt 的 input_ids
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        for i, token in enumerate(value.tolist()):
+            if self._finished[i]:
+                continue
+            if token in self._eos_ids:
+                self._finished[i] = True
+                self._streams[i].put(self._decoders[i].flush())
+                continue
+            self._streams[i].put(self._decoders[i].push(token))
+            self._remaining[i] -= 1
+            if self._remaining[i] <= 0:
+                self._finished[i] = True
+                self._streams[i].put(self._decoders[i].flush())
+
+    def end(self) -> None:
+        for i, finished in enumerate(self._finished):
+            if not finished:
+                self._finished[i] = True
+                self._streams[i].put(self._decoders[i].flush())
+
+
+@dataclass
+class _Sequence:
+    prompt_ids: torch.Tensor
+    max_new_tokens: int
+    # 单条序列的 KV cache（legacy 格式，batch 维为 1），在运行批中时为 None
+    past_key_values: tuple | None
+    kv_len: int
+    # 下一个输入 token 的 mrope 位置（已包含 rope_deltas）
+    next_position: int
+    stream: TokenStream | None = None
+    decoder: IncrementalDecoder | None = None
+    token_ids: list[int] = field(default_factory=list)
+    finished: bool = False
+
+
+class QwenStepEngine:
+    # 每条序列独立维护 KV cache；运行批成员变化时左填充拼接成一个批，
+    # 成员不变时直接复用拼好的批 cache，逐步 decode
+    def __init__(
+        self,
+        model: AutoModelForVision2Seq,
+        processor: AutoProcessor,
+        dtype: torch.dtype,
+        max_new_tokens: int,
+    ):
+        self.model: AutoModelForVision2Seq = model
+        self.processor: AutoProcessor = processor
+        self.dtype: torch.dtype = dtype
+        self._max_new_tokens: int = max_new_tokens
+        self._eos_ids: set[int] = _eos_token_ids(model)
+        self._repetition_penalty: float = (
+            model.generation_config.repetition_penalty or 1.0
+        )
+        self._batch: list[_Sequence] = []
+        self._batch_pads: list[int] = []
+        self._batch_cache: DynamicCache | None = None
+        self._batch_mask: torch.Tensor | None = None
+
+    def _next_tokens(self, logits: torch.Tensor, seqs: list[_Sequence]) -> list[int]:
+        logits = logits.float()
+        if self._repetition_penalty != 1.0:
+            for i, seq in enumerate(seqs):
+                ids = torch.cat(
+                    [
+                        seq.prompt_ids,
+                        torch.tensor(
+                            seq.token_ids, dtype=torch.long, device=logits.device
+                        ),
+                    ]
+                )
+                score = logits[i].gather(0, ids)
+                score = torch.where(
+                    score < 0,
+                    score * self._repetition_penalty,
+                    score / self._repetition_penalty,
+                )
+                logits[i].scatter_(0, ids, score)
+        return logits.argmax(-1).tolist()
+
+    def _append(self, seq: _Sequence, token: int) -> None:
+        if token in self._eos_ids:
+            seq.finished = True
         else:
-            if len(self._batch_messages) == 1:
-                asyncio.create_task(self._flush_batch_later(self._batch_id))
-            (inputs, outputs) = await self._future_result
-            return self.processor.decode(
-                outputs[result_id][inputs["input_ids"].shape[-1] :],
-                skip_special_tokens=True,
+            seq.token_ids.append(token)
+            if seq.stream is not None:
+                seq.stream.put(seq.decoder.push(token))
+            if len(seq.token_ids) >= seq.max_new_tokens:
+                seq.finished = True
+        if seq.finished and seq.stream is not None:
+            seq.stream.put(seq.decoder.flush())
+
+    def _pack(self, seqs: list[_Sequence]) -> None:
+        max_len = max(seq.kv_len for seq in seqs)
+        pads = [max_len - seq.kv_len for seq in seqs]
+        layers = []
+        for layer_idx in range(len(seqs[0].past_key_values)):
+            keys = [
+                F.pad(seq.past_key_values[layer_idx][0], (0, 0, pad, 0))
+                for seq, pad in zip(seqs, pads)
+            ]
+            values = [
+                F.pad(seq.past_key_values[layer_idx][1], (0, 0, pad, 0))
+                for seq, pad in zip(seqs, pads)
+            ]
+            layers.append((torch.cat(keys), torch.cat(values)))
+        mask = torch.ones(
+            (len(seqs), max_len), dtype=torch.long, device=self.model.device
+        )
+        for i, pad in enumerate(pads):
+            mask[i, :pad] = 0
+        for seq in seqs:
+            seq.past_key_values = None
+
+        self._batch = list(seqs)
+        self._batch_pads = pads
+        self._batch_cache = DynamicCache.from_legacy_cache(tuple(layers))
+        self._batch_mask = mask
+
+    def _unpack(self) -> None:
+        if self._batch_cache is None:
+            return
+        layers = self._batch_cache.to_legacy_cache()
+        for i, (seq, pad) in enumerate(zip(self._batch, self._batch_pads)):
+            if seq.finished:
+                continue
+            seq.past_key_values = tuple(
+                (k[i : i + 1, :, pad:], v[i : i + 1, :, pad:]) for k, v in layers
+            )
+        self._batch = []
+        self._batch_pads = []
+        self._batch_cache = None
+        self._batch_mask = None
+
+    @torch.inference_mode()
+    def prefill(self, request: _Request) -> _Sequence:
+        inputs, stream = request.inputs, request.stream
+        input_ids = inputs["input_ids"]
+        with _image_keys([request.image_key]), torch.amp.autocast("cuda", self.dtype):
+            position_ids, rope_deltas = self.model.model.get_rope_index(
+                input_ids,
+                inputs.get("image_grid_thw"),
+                None,
+                attention_mask=inputs["attention_mask"],
+            )
+            outputs = self.model(
+                **inputs, position_ids=position_ids, use_cache=True, logits_to_keep=1
             )
+        seq_len = input_ids.shape[-1]
+        seq = _Sequence(
+            prompt_ids=input_ids[0],
+            max_new_tokens=request.max_new_tokens or self._max_new_tokens,
+            past_key_values=outputs.past_key_values.to_legacy_cache(),
+            kv_len=seq_len,
+            next_position=seq_len + int(rope_deltas[0]),
+            stream=stream,
+            decoder=_make_decoder(self.processor) if stream is not None else None,
+        )
+        self._append(seq, self._next_tokens(outputs.logits[:, -1, :], [seq])[0])
+        return seq
+
+    @torch.inference_mode()
+    def step(self, seqs: list[_Sequence]) -> None:
+        if [id(seq) for seq in seqs] != [id(seq) for seq in self._batch]:
+            self._unpack()
+            self._pack(seqs)
+
+        device = self.model.device
+        batch_len = self._batch_mask.shape[-1]
+        self._batch_mask = F.pad(self._batch_mask, (0, 1), value=1)
+        input_ids = torch.tensor(
+            [[seq.token_ids[-1]] for seq in seqs], dtype=torch.long, device=device
+        )
+        position_ids = (
+            torch.tensor([seq.next_position for seq in seqs], device=device)
+            .view(1, -1, 1)
+            .expand(3, -1, -1)
+        )
+        with torch.amp.autocast("cuda", self.dtype):
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=self._batch_mask,
+                position_ids=position_ids,
+                past_key_values=self._batch_cache,
+                cache_position=torch.tensor([batch_len], device=device),
+                use_cache=True,
+                logits_to_keep=1,
+            )
+        self._batch_cache = outputs.past_key_values
+
+        tokens = self._next_tokens(outputs.logits[:, -1, :], seqs)
+        for seq, token in zip(seqs, tokens):
+            seq.kv_len += 1
+            seq.next_position += 1
+            self._append(seq, token)
+
+    def is_finished(self, seq: _Sequence) -> bool:
+        return seq.finished
+
+    def finish(self, seq: _Sequence) -> str:
+        GENERATED_TOKENS.inc(len(seq.token_ids))
+        return self.processor.decode(seq.token_ids, skip_special_tokens=True)
+
+    def release(self, seq: _Sequence) -> None:
+        seq.past_key_values = None
+
+    def reset(self) -> None:
+        # 运行批作废时释放拼好的批 KV cache，不等到下次重新拼批
+        self._batch = []
+        self._batch_pads = []
+        self._batch_cache = None
+        self._batch_mask = None
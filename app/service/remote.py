@@ -0,0 +1,330 @@
+import asyncio
+import base64
+import itertools
+import time
+from contextlib import aclosing
+from typing import AsyncIterator
+
+from PIL import UnidentifiedImageError
+
+from app.config import settings
+from app.models.admission import Overloaded
+from app.models.bucket_planner import InputTooLarge
+from app.models.image_codec import supported_formats
+from app.models.infer_queue import DeadlineExceeded
+from app.models.ipc import (
+    read_message,
+    release_bytes,
+    send_message,
+    share_bytes,
+    take_bytes,
+)
+from app.models.progress import GenerationProgress
+from app.service.txt2img_params import Txt2ImgParams
+
+# 多进程模式下前端进程中的服务替身：接口与 Txt2ImgService / Img2TxtService
+# 在路由中用到的部分一致，实际请求通过 unix socket 转发给模型工作进程（app.model_worker）
+
+
+def _raise_error(message: dict) -> None:
+    kind = message["kind"]
+    if kind == "overloaded":
+        raise Overloaded(message["reason"], message["retry_after_s"])
+    if kind == "deadline":
+        raise DeadlineExceeded(message["reason"], message["waited_s"])
+    if kind == "bad_image":
+        raise UnidentifiedImageError(message["message"])
+    if kind == "too_large":
+        raise InputTooLarge(message["tokens"], message["max_tokens"])
+    raise RuntimeError(message["message"])
+
+
+class WorkerConnection:
+    # 到一个模型工作进程的连接，多个请求按 id 复用同一连接
+    def __init__(self, path: str):
+        self.path: str = path
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._send_lock: asyncio.Lock = asyncio.Lock()
+        self._ids = itertools.count()
+        self._pending: dict[int, asyncio.Queue] = {}
+        self._read_task: asyncio.Task | None = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def connect(self, timeout_s: float) -> None:
+        # 工作进程加载模型期间 socket 还不存在，重试直到超时
+        deadline = time.monotonic() + timeout_s
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(
+                    self.path
+                )
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    raise
+                await asyncio.sleep(0.5)
+        self._read_task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self) -> None:
+        try:
+            while (message := await read_message(self._reader)) is not None:
+                queue = self._pending.get(message["id"])
+                if queue is not None:
+                    queue.put_nowait(message)
+                elif "image" in message:
+                    # 请求已取消，丢弃迟到的结果
+                    release_bytes(message["image"])
+        finally:
+            # 连接断开：所有等待中的请求失败
+            for queue in self._pending.values():
+                queue.put_nowait(
+                    {"type": "error", "kind": "error", "message": "model worker gone"}
+                )
+
+    async def _send(self, message: dict) -> None:
+        async with self._send_lock:
+            await send_message(self._writer, message)
+
+    async def call(self, op: str, **fields) -> AsyncIterator[dict]:
+        # 逐条返回工作进程发来的消息，直到 result / error；中途退出时通知工作进程取消
+        id = next(self._ids)
+        queue: asyncio.Queue = asyncio.Queue()
+        self._pending[id] = queue
+        finished = False
+        try:
+            await self._send({"id": id, "op": op, **fields})
+            while True:
+                message = await queue.get()
+                if message["type"] in ("result", "error"):
+                    finished = True
+                    self._pending.pop(id, None)
+                if message["type"] == "error":
+                    _raise_error(message)
+                yield message
+                if finished:
+                    return
+        finally:
+            self._pending.pop(id, None)
+            if not finished:
+                asyncio.create_task(self._send({"id": id, "op": "cancel"}))
+
+    async def request(self, op: str, **fields) -> dict:
+        async with aclosing(self.call(op, **fields)) as messages:
+            async for message in messages:
+                if message["type"] == "result":
+                    return message
+        raise RuntimeError("model worker closed the request without a result")
+
+    def close(self) -> None:
+        if self._read_task is not None:
+            self._read_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+
+class RemoteAdmission:
+    # 准入控制在工作进程中执行；这里定期拉取负载快照，供 /load 与路由的预检查使用
+    def __init__(
+        self,
+        connections: list[WorkerConnection],
+        service: str,
+        interval_s: float = 1.0,
+    ):
+        self._connections: list[WorkerConnection] = connections
+        self._service: str = service
+        self._interval_s: float = interval_s
+        self._stats: list[dict] = []
+        self._task: asyncio.Task | None = None
+
+    async def refresh(self) -> None:
+        stats = []
+        for connection in self._connections:
+            message = await connection.request("load", service=self._service)
+            stats.append(message["load"])
+        self._stats = stats
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval_s)
+            try:
+                await self.refresh()
+            except Exception:
+                pass
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    def check(self) -> None:
+        # 所有工作进程都已饱和时，在把图片读入内存并转发给工作进程之前拒绝；
+        # 最终以工作进程的判断为准
+        if self._stats and not any(s["accepting"] for s in self._stats):
+            raise Overloaded("all model workers are saturated", 1)
+
+    def stats(self) -> dict:
+        if len(self._stats) == 1:
+            return self._stats[0]
+        return {"workers": self._stats}
+
+
+def _label_samples(text: str, worker: int) -> list[str]:
+    # 多个工作进程的指标合并时给样本行加上 worker 标签
+    lines = []
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, rest = line.partition(" ")
+        if "{" in name:
+            name = name.replace("{", f'{{worker="{worker}",', 1)
+        else:
+            name = f'{name}{{worker="{worker}"}}'
+        lines.append(f"{name} {rest}")
+    return lines
+
+
+class RemoteService:
+    name: str = ""
+
+    def __init__(self, connections: list[WorkerConnection]):
+        self.connections: list[WorkerConnection] = connections
+        self.admission: RemoteAdmission = RemoteAdmission(connections, self.name)
+
+    def _pick(self) -> WorkerConnection:
+        # 每个设备一个工作进程，请求发给当前未完成请求最少的那个
+        return min(self.connections, key=lambda c: c.pending)
+
+    async def render_metrics(self) -> str:
+        texts = [(await c.request("metrics"))["metrics"] for c in self.connections]
+        if len(texts) == 1:
+            return texts[0]
+        lines = [line for line in texts[0].splitlines() if line.startswith("#")]
+        for i, text in enumerate(texts):
+            lines.extend(_label_samples(text, i))
+        return "\n".join(lines) + "\n"
+
+    def shutdown(self) -> None:
+        self.admission.stop()
+        for connection in self.connections:
+            connection.close()
+
+
+class RemoteTxt2ImgService(RemoteService, Txt2ImgParams):
+    name = "txt2img"
+
+    # 前端与工作进程读取同一份配置，参数校验与工作进程中的服务一致
+    @property
+    def sizes(self) -> list[tuple[int, int]]:
+        return settings.txt2img_size_list
+
+    @property
+    def num_inference_steps(self) -> int:
+        return settings.txt2img_infer_steps
+
+    @property
+    def max_inference_steps(self) -> int:
+        return settings.txt2img_max_infer_steps
+
+    @property
+    def output_formats(self) -> dict[str, int]:
+        return supported_formats(settings.txt2img_output_qualities)
+
+    async def cached_generate(
+        self,
+        prompt: str,
+        progress: GenerationProgress | None = None,
+        size: tuple[int, int] | None = None,
+        **params,
+    ) -> bytes:
+        # params：steps / guidance_scale / seed / negative_prompt / output_format /
+        # priority / timeout_ms，原样转发
+        messages = self._pick().call(
+            "txt2img",
+            prompt=prompt,
+            progress=progress is not None,
+            preview_every=progress.preview_every if progress is not None else 0,
+            size=size,
+            **params,
+        )
+        async with aclosing(messages):
+            async for message in messages:
+                if message["type"] == "progress":
+                    progress.report(
+                        message["phase"], message["step"], message["total_steps"]
+                    )
+                    if "preview" in message:
+                        preview = base64.b64decode(message["preview"])
+                        progress.report_preview(message["preview_step"], preview)
+                elif message["type"] == "result":
+                    return take_bytes(message["image"])
+        raise RuntimeError("model worker closed the request without a result")
+
+
+class RemoteImg2TxtService(RemoteService):
+    name = "img2txt"
+
+    @property
+    def max_new_tokens_limit(self) -> int:
+        return settings.img2txt_max_new_tokens_limit
+
+    async def queued_generate(
+        self,
+        image: bytes,
+        prompt: str,
+        max_new_tokens: int | None = None,
+        priority: str | None = None,
+        timeout_ms: int | None = None,
+    ) -> str:
+        message = await self._pick().request(
+            "img2txt",
+            prompt=prompt,
+            image=share_bytes(image),
+            max_new_tokens=max_new_tokens,
+            priority=priority,
+            timeout_ms=timeout_ms,
+        )
+        return message["text"]
+
+    async def stream_generate(
+        self,
+        image: bytes,
+        prompt: str,
+        max_new_tokens: int | None = None,
+        priority: str | None = None,
+        timeout_ms: int | None = None,
+    ) -> AsyncIterator[str]:
+        messages = self._pick().call(
+            "img2txt_stream",
+            prompt=prompt,
+            image=share_bytes(image),
+            max_new_tokens=max_new_tokens,
+            priority=priority,
+            timeout_ms=timeout_ms,
+        )
+        async with aclosing(messages):
+            async for message in messages:
+                if message["type"] == "chunk":
+                    yield message["text"]
+
+
+async def connect_remote_services(
+    names: list[str], paths: list[str], timeout_s: float
+) -> dict[str, RemoteService]:
+    # 同一进程中的多个服务共用到各工作进程的连接
+    connections = [WorkerConnection(path) for path in paths]
+    for connection in connections:
+        await connection.connect(timeout_s)
+    classes = {"txt2img": RemoteTxt2ImgService, "img2txt": RemoteImg2TxtService}
+    services = {}
+    for name in names:
+        service = classes[name](connections)
+        await service.admission.refresh()
+        service.admission.start()
+        services[name] = service
+    return services
@@ -0,0 +1,49 @@
+# txt2img 生成参数的校验，Txt2ImgService 与多进程模式下前端的 RemoteTxt2ImgService 共用，
+# 路由与服务给出相同的错误；不导入 torch / diffusers
+
+
+class Txt2ImgParams:
+    # 依赖子类提供的支持分辨率（第一个为默认值）、默认与最大步数、可选输出格式
+    # （第一个为默认格式）；不合法时抛出 ValueError
+    sizes: list[tuple[int, int]]
+    num_inference_steps: int
+    max_inference_steps: int
+    output_formats: dict[str, int]
+
+    def check_size(self, size: tuple[int, int] | None) -> tuple[int, int]:
+        # None 表示默认分辨率
+        if size is None:
+            return self.sizes[0]
+        if tuple(size) not in self.sizes:
+            supported = ", ".join(f"{w}x{h}" for w, h in self.sizes)
+            raise ValueError(
+                f"Unsupported size {size[0]}x{size[1]}, use one of {supported}"
+            )
+        return tuple(size)
+
+    def check_format(self, output_format: str | None) -> str:
+        # None 表示默认格式；未启用的格式抛出 ValueError
+        if output_format is None:
+            return next(iter(self.output_formats))
+        if output_format not in self.output_formats:
+            supported = ", ".join(self.output_formats)
+            raise ValueError(
+                f"Unsupported format {output_format}, use one of {supported}"
+            )
+        return output_format
+
+    def check_steps(self, steps: int | None) -> int:
+        # None 表示默认步数
+        if steps is None:
+            return self.num_inference_steps
+        if not 1 <= steps <= self.max_inference_steps:
+            raise ValueError(f"steps must be between 1 and {self.max_inference_steps}")
+        return steps
+
+    def check_guidance_scale(self, guidance_scale: float | None) -> None:
+        if guidance_scale is not None and not 0 <= guidance_scale <= 30:
+            raise ValueError("guidance_scale must be between 0 and 30")
+
+    def check_seed(self, seed: int | None) -> None:
+        if seed is not None and not 0 <= seed < 2**63:
+            raise ValueError("seed must be between 0 and 2^63 - 1")
@@ -1,30 +1,475 @@
 from diffusers import DiffusionPipeline
-from app.models.infer_queue import InferQueue
+from diffusers.models.embeddings import get_2d_rotary_pos_embed
+from diffusers.pipelines.hunyuandit.pipeline_hunyuandit import (
+    get_resize_crop_region_for_grid,
+)
+from app.models.admission import AdmissionController
+from app.models.batch_policy import BatchPolicy, make_batch_policy
+from app.models.compile_cache import CompileReport, configure_compile_cache
+from app.models.continuous_batcher import ContinuousBatcher
+from app.models.feature_cache import FeatureCache
+from app.models.image_codec import encode_image, supported_formats
+from app.models.infer_queue import (
+    NORMAL,
+    InferQueue,
+    resolve_deadline,
+    resolve_priority,
+)
+from app.models.metrics import (
+    BATCH_FILL_RATIO,
+    BATCH_WAIT,
+    BATCH_FLUSHES,
+    ENCODE,
+    GENERATED_IMAGES,
+    QUEUE_DEPTH,
+)
+from app.models.preprocess_pool import PreprocessPool
+from app.models.progress import DECODING, DENOISING, DONE, GenerationProgress
+from app.models.residency import ResidencyManager, module_bytes, weights_bytes
+from app.models.result_cache import DiskCache, LRUCache, TieredCache
+from app.service.txt2img_params import Txt2ImgParams
 import asyncio
+import contextlib
+import copy
+import gc
+from dataclasses import dataclass, field
 from typing import ClassVar, Optional
 from PIL.Image import Image
 from asyncio import Future
 from typing import Any
+import PIL.Image
+import hashlib
+import json
+import random
+import time
 import torch
 
 
-class Txt2ImgService:
+@dataclass
+class _Request:
+    prompt: str
+    progress: GenerationProgress | None
+    deadline: float | None
+    # 攒批路径下的结果 future
+    future: Future | None
+    flush_task: asyncio.Task | None = None
+    width: int = 1024
+    height: int = 1024
+    steps: int = 50
+    guidance_scale: float = 5.0
+    seed: int | None = None
+    negative_prompt: str | None = None
+    # 攒批路径下所在的攒批组
+    batch: "_Batch | None" = None
+    # 推理队列中的优先级，批按其中最高的优先级排队
+    priority: int = NORMAL
+    # 加入攒批的时间（time.monotonic），flush 时记录在攒批中等待的时长
+    batched_at: float = 0.0
+
+
+@dataclass
+class _Batch:
+    # 一个攒批组的待 flush 批次。分辨率与步数决定 latent shape 与调度器时间步，
+    # guidance_scale 在 pipeline 中是整批共用的标量，三者相同的请求才能拼成一批；
+    # seed 与 negative prompt 按行传入，可以混在同一批中
+    width: int
+    height: int
+    steps: int
+    guidance_scale: float
+    policy: BatchPolicy
+    requests: list[_Request] = field(default_factory=list)
+    batch_id: int = 0
+
+    @property
+    def key(self) -> tuple:
+        return (self.width, self.height, self.steps, self.guidance_scale)
+
+
+def _generator(seed: int | None) -> torch.Generator:
+    # CPU generator：同一 seed 在不同设备、不同批中结果一致；未指定 seed 时随机取一个
+    return torch.Generator("cpu").manual_seed(
+        seed if seed is not None else random.getrandbits(63)
+    )
+
+
+def _guide(noise_pred: torch.Tensor, guidance: torch.Tensor) -> torch.Tensor:
+    # noise_pred 前一半为无条件、后一半为有条件预测；guidance 为每行的强度。
+    # guidance <= 1 的行与 pipeline 一致，只取有条件预测
+    uncond, text = noise_pred.chunk(2)
+    guidance = guidance.clamp(min=1.0).view(-1, *[1] * (text.dim() - 1))
+    return uncond + guidance.to(text.dtype) * (text - uncond)
+
+
+# latent -> RGB 的线性近似，用于去噪过程中的预览：HunyuanDiT 使用 SDXL 的 VAE，
+# 4 通道 latent 到 RGB 的系数与偏置为对 VAE 解码结果的最小二乘拟合
+_LATENT_RGB = torch.tensor(
+    [
+        [0.3651, 0.4232, 0.4341],
+        [-0.2533, -0.0042, 0.1068],
+        [0.1076, 0.1111, -0.0362],
+        [-0.3165, -0.2492, -0.2188],
+    ]
+)
+_LATENT_RGB_BIAS = torch.tensor([0.1084, -0.0175, -0.0011])
+_PREVIEW_QUALITY = 60
+
+
+def _latent_preview(latents: torch.Tensor) -> list[bytes]:
+    # 每行一张 WebP 预览，分辨率为输出的 1/8，不经过 VAE
+    rgb = torch.einsum("bchw,cr->bhwr", latents.float(), _LATENT_RGB.to(latents.device))
+    rgb = (rgb + _LATENT_RGB_BIAS.to(latents.device) + 1) / 2
+    pixels = rgb.clamp(0, 1).mul(255).byte().cpu().numpy()
+    return [
+        encode_image(PIL.Image.fromarray(row), "webp", _PREVIEW_QUALITY)
+        for row in pixels
+    ]
+
+
+def _report_previews(
+    latents: torch.Tensor,
+    progress: list[GenerationProgress | None],
+    step: int,
+    total_steps: int,
+) -> None:
+    # latents 的行与 progress 一一对应，只为到达预览间隔的行生成预览
+    rows = [
+        i
+        for i, p in enumerate(progress)
+        if p is not None and p.wants_preview(step, total_steps)
+    ]
+    if rows:
+        for i, data in zip(rows, _latent_preview(latents[rows])):
+            progress[i].report_preview(step, data)
+
+
+# (text_encoder_index, max_sequence_length)：CLIP 与 mT5
+_TEXT_ENCODERS = ((0, 77), (1, 256))
+
+
+def _text_key(index: int, text: str) -> str:
+    raw = json.dumps([index, text], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _encode_texts(
+    pipe: DiffusionPipeline, texts: list[str], cache: FeatureCache | None = None
+) -> list[tuple[torch.Tensor, torch.Tensor]]:
+    # 返回每个文本编码器的 (embeds, attention mask)，行顺序与 texts 一致。
+    # 有缓存时按 (编码器, 文本) 查找，只对未命中的文本去重后运行编码器；
+    # negative prompt（含空串）与 prompt 一样按文本编码，因此同样可以命中
+    device = pipe._execution_device
+    dtype = pipe.transformer.dtype
+    encoded = []
+    for index, max_length in _TEXT_ENCODERS:
+        rows: dict[str, tuple[torch.Tensor, torch.Tensor]] = {}
+        if cache is not None:
+            for text in dict.fromkeys(texts):
+                value = cache.get(_text_key(index, text))
+                if value is not None:
+                    rows[text] = value
+        missing = [text for text in dict.fromkeys(texts) if text not in rows]
+        if missing:
+            embeds, _, mask, _ = pipe.encode_prompt(
+                prompt=missing,
+                device=device,
+                dtype=dtype,
+                do_classifier_free_guidance=False,
+                max_sequence_length=max_length,
+                text_encoder_index=index,
+            )
+            for i, text in enumerate(missing):
+                # 复制出单行，缓存条目不引用整批的存储
+                rows[text] = (embeds[i : i + 1].clone(), mask[i : i + 1].clone())
+                if cache is not None:
+                    cache.put(_text_key(index, text), rows[text])
+        encoded.append(
+            (
+                torch.cat([rows[text][0] for text in texts]),
+                torch.cat([rows[text][1] for text in texts]),
+            )
+        )
+    return encoded
+
+
+@dataclass
+class _Sample:
+    # 运行批中的一个样本：独立的调度器副本与时间步，编码好的 prompt 与 negative prompt
+    request: _Request
+    scheduler: Any
+    timesteps: torch.Tensor
+    latents: torch.Tensor
+    generator: torch.Generator
+    # (CLIP embeds, CLIP mask, T5 embeds, T5 mask)，各含 [negative, prompt] 两项
+    text: tuple
+    time_ids: torch.Tensor
+    index: int = 0
+    image: Image | None = None
+
+
+class HunyuanStepEngine:
+    # 替代 pipeline 内部的去噪循环，配合 ContinuousBatcher 做 step 级批处理：
+    # - prefill 只做文本编码与初始噪声，样本可以在任意 step 边界加入运行批
+    # - 每个 step 把同分辨率的样本拼成一次 transformer 调用（含 CFG 的无条件分支），
+    #   每个样本用自己的调度器与时间步，步数与 guidance 逐行不同
+    # - 去噪完成的样本在同一推理线程中按分辨率成批做 VAE 解码，然后移出运行批
+    def __init__(
+        self,
+        pipe: DiffusionPipeline,
+        device_str: str,
+        prompt_cache: FeatureCache | None = None,
+    ):
+        self.pipe: DiffusionPipeline = pipe
+        self.device_str: str = device_str
+        self.prompt_cache: FeatureCache | None = prompt_cache
+        # (width, height) -> 旋转位置编码
+        self._rotary: dict[tuple[int, int], Any] = {}
+
+    def _rotary_emb(self, width: int, height: int) -> Any:
+        if (width, height) not in self._rotary:
+            transformer = self.pipe.transformer
+            patch = transformer.config.patch_size
+            grid = (height // 8 // patch, width // 8 // patch)
+            self._rotary[(width, height)] = get_2d_rotary_pos_embed(
+                transformer.inner_dim // transformer.num_heads,
+                get_resize_crop_region_for_grid(grid, 512 // 8 // patch),
+                grid,
+                device=self.pipe._execution_device,
+                output_type="pt",
+            )
+        return self._rotary[(width, height)]
+
+    def _encode(self, request: _Request) -> tuple:
+        # 未指定 negative prompt 时与 pipeline 一致，无条件分支编码空串
+        texts = [request.negative_prompt or "", request.prompt]
+        encoded = []
+        for embeds, mask in _encode_texts(self.pipe, texts, self.prompt_cache):
+            encoded += [(embeds[0:1], embeds[1:2]), (mask[0:1], mask[1:2])]
+        return tuple(encoded)
+
+    @torch.inference_mode()
+    def prefill(self, request: _Request) -> _Sample:
+        pipe = self.pipe
+        device = pipe._execution_device
+        with torch.amp.autocast(self.device_str, torch.float16):
+            text = self._encode(request)
+        scheduler = copy.deepcopy(pipe.scheduler)
+        scheduler.set_timesteps(request.steps, device=device)
+        generator = _generator(request.seed)
+        latents = pipe.prepare_latents(
+            1,
+            pipe.transformer.config.in_channels,
+            request.height,
+            request.width,
+            text[0][1].dtype,
+            device,
+            generator,
+        )
+        # 与 pipeline 默认值一致：original_size (1024, 1024)，target_size 为输出尺寸
+        time_ids = torch.tensor(
+            [[1024, 1024, request.height, request.width, 0, 0]],
+            dtype=latents.dtype,
+            device=device,
+        )
+        if request.progress is not None:
+            request.progress.report(DENOISING, 0, request.steps)
+        return _Sample(
+            request, scheduler, scheduler.timesteps, latents, generator, text, time_ids
+        )
+
+    def _denoise(self, samples: list[_Sample]) -> None:
+        # 一次 transformer 调用推进一组同分辨率的样本各一步
+        request = samples[0].request
+        latents = torch.cat(
+            [
+                s.scheduler.scale_model_input(s.latents, s.timesteps[s.index])
+                for s in samples
+            ]
+        )
+        timesteps = torch.stack([s.timesteps[s.index] for s in samples])
+
+        def both(i: int) -> torch.Tensor:
+            # 无条件分支在前、有条件分支在后，与 _guide 的约定一致
+            return torch.cat(
+                [s.text[i][0] for s in samples] + [s.text[i][1] for s in samples]
+            )
+
+        noise_pred = self.pipe.transformer(
+            torch.cat([latents, latents]),
+            torch.cat([timesteps, timesteps]).to(latents.dtype),
+            encoder_hidden_states=both(0),
+            text_embedding_mask=both(1),
+            encoder_hidden_states_t5=both(2),
+            text_embedding_mask_t5=both(3),
+            image_meta_size=torch.cat([s.time_ids for s in samples] * 2),
+            style=torch.zeros(
+                2 * len(samples), dtype=torch.long, device=latents.device
+            ),
+            image_rotary_emb=self._rotary_emb(request.width, request.height),
+            return_dict=False,
+        )[0]
+        # 输出通道后一半为学习到的方差，不参与采样
+        noise_pred, _ = noise_pred.chunk(2, dim=1)
+        noise_pred = _guide(
+            noise_pred,
+            torch.tensor(
+                [s.request.guidance_scale for s in samples], device=latents.device
+            ),
+        )
+        for i, s in enumerate(samples):
+            s.latents = s.scheduler.step(
+                noise_pred[i : i + 1],
+                s.timesteps[s.index],
+                s.latents,
+                generator=s.generator,
+                return_dict=False,
+            )[0]
+            s.index += 1
+            progress = s.request.progress
+            if progress is not None:
+                # 最后一步结束后进入 VAE 解码阶段
+                total = len(s.timesteps)
+                phase = DECODING if s.index >= total else DENOISING
+                progress.report(phase, s.index, total)
+                _report_previews(s.latents, [progress], s.index, total)
+
+    def _decode(self, samples: list[_Sample]) -> None:
+        pipe = self.pipe
+        latents = torch.cat([s.latents for s in samples])
+        image = pipe.vae.decode(
+            latents / pipe.vae.config.scaling_factor, return_dict=False
+        )[0]
+        image, nsfw = pipe.run_safety_checker(image, latents.device, latents.dtype)
+        images = pipe.image_processor.postprocess(
+            image,
+            output_type="pil",
+            do_denormalize=[True] * len(samples)
+            if nsfw is None
+            else [not flagged for flagged in nsfw],
+        )
+        for s, image in zip(samples, images):
+            s.image = image
+
+    @torch.inference_mode()
+    def step(self, samples: list[_Sample]) -> None:
+        groups: dict[tuple[int, int], list[_Sample]] = {}
+        for s in samples:
+            groups.setdefault((s.request.width, s.request.height), []).append(s)
+        with torch.amp.autocast(self.device_str, torch.float16):
+            for group in groups.values():
+                self._denoise(group)
+            for group in groups.values():
+                done = [s for s in group if s.index >= len(s.timesteps)]
+                if done:
+                    self._decode(done)
+
+    def is_finished(self, sample: _Sample) -> bool:
+        return sample.image is not None
+
+    def finish(self, sample: _Sample) -> Image:
+        GENERATED_IMAGES.inc()
+        return sample.image
+
+    def release(self, sample: _Sample) -> None:
+        sample.latents = None
+        sample.text = None
+
+    def reset(self) -> None:
+        # 样本状态都在 _Sample 中，step 之间没有保留批状态
+        pass
+
+
+class Txt2ImgService(Txt2ImgParams):
     _lock: ClassVar[asyncio.Lock] = asyncio.Lock()
     _instance: ClassVar[Optional["Txt2ImgService"]] = None
 
     def __init__(
-        self, model: str, batch_size: int, num_inference_steps: int, max_wait_ms: int
+        self,
+        model: str,
+        batch_size: int,
+        num_inference_steps: int,
+        max_wait_ms: int,
+        cache: TieredCache | None = None,
+        batch_policy: str = "fixed",
+        request_timeout_s: float = 0,
+        expired_policy: str = "drop",
+        admission: AdmissionController | None = None,
+        residency: ResidencyManager | None = None,
+        compile_mode: str = "max-autotune",
+        compile_cache_dir: str = "",
+        warmup_batch_sizes: list[int] | None = None,
+        warmup_steps: int = 2,
+        sizes: list[tuple[int, int]] | None = None,
+        guidance_scale: float = 5.0,
+        max_inference_steps: int = 100,
+        continuous_batching: bool = False,
+        max_running: int = 8,
+        prompt_cache: FeatureCache | None = None,
+        output_formats: dict[str, int] | None = None,
+        encode_workers: int = 0,
+        flow_weights: dict[str, float] | None = None,
+        cache_unseeded: bool = True,
     ):
         self._model = model
-        self.queue: InferQueue = InferQueue()
+        self.queue: InferQueue = InferQueue(expired_policy)
+        # 推理队列中各 flow（txt2img、warmup）的权重，默认均为 1
+        for flow, weight in (flow_weights or {}).items():
+            self.queue.set_weight(flow, weight)
         self.pipe: DiffusionPipeline | None = None
         self.batch_size: int = batch_size
         self.num_inference_steps: int = num_inference_steps
         self.max_wait_ms: int = max_wait_ms
-        self.batch_prompts: list = []
-        self._future_result: Future = Future()
-        self._batch_id: int = 0
+        # 请求未指定时使用的 guidance_scale，以及请求可指定的最大步数
+        self.guidance_scale: float = guidance_scale
+        self.max_inference_steps: int = max_inference_steps
+        # 支持的 (width, height)，第一个为默认分辨率
+        self.sizes: list[tuple[int, int]] = [tuple(s) for s in sizes or [(1024, 1024)]]
+        # 每个攒批组（分辨率, 步数, guidance）一个待 flush 批次，按需创建，flush 后移除；
+        # 决定未满的批何时 flush 的策略按分辨率持有，到达率统计不随批次重置
+        self._batches: dict[tuple, _Batch] = {}
+        self._policies: dict[tuple[int, int], BatchPolicy] = {
+            size: make_batch_policy(batch_policy, max_wait_ms) for size in self.sizes
+        }
+        # 已 flush、尚未完成的批：flush 任务 -> 批内请求
+        self._inflight: dict[asyncio.Task, list[_Request]] = {}
+        # 开启后用自定义去噪循环做 step 级批处理，替代上面的攒批 flush 流程；
+        # batcher 在 pipeline 加载后创建
+        self._continuous_batching: bool = continuous_batching
+        self._max_running: int = max_running
+        self.batcher: ContinuousBatcher | None = None
+        # 两个文本编码器输出的 embedding 与 attention mask 缓存，按 (编码器, 文本) 索引；
+        # 开启后以 embedding 代替文本传入 pipeline
+        self.prompt_cache: FeatureCache | None = prompt_cache
+        # 可选的输出格式 -> 质量（PNG 为压缩级别），第一个为默认格式；
+        # 编码在独立的线程 / 进程池中执行，不阻塞事件循环
+        self.output_formats: dict[str, int] = supported_formats(
+            output_formats or {"png": 6}
+        )
+        self.encode_pool: PreprocessPool = PreprocessPool(
+            encode_workers, name="txt2img-encode"
+        )
+        # 请求从到达起的截止时间（0 表示不限）
+        self._request_timeout_s: float = request_timeout_s
+        # 限制排队请求数与预计排队时间，超限时拒绝新请求
+        self.admission: AdmissionController = admission or AdmissionController(
+            max_queued=64, max_queue_time_s=300.0, name="txt2img"
+        )
         self.device_str: str = "cuda:0"
+        self.cache: TieredCache | None = cache
+        # 未指定 seed 的请求是否读写缓存（关闭时每次都得到新的随机结果）
+        self.cache_unseeded: bool = cache_unseeded
+        # 与其他模型共享设备时由驻留管理器按需加载 / 换出 pipeline
+        self.residency: ResidencyManager | None = residency
+        # transformer 的 torch.compile 模式（空字符串不编译）与持久化编译缓存目录
+        self._compile_mode: str = compile_mode
+        self._compile_cache_dir: str = compile_cache_dir
+        # 就绪前按每种分辨率 × 每个批大小预热一次（批大小默认 1..batch_size，
+        # step 级批处理时为 1..max_running；未满的批也是不同 shape），
+        # 每次只跑 warmup_steps 步
+        self.warmup_batch_sizes: list[int] = warmup_batch_sizes or list(
+            range(1, (max_running if continuous_batching else batch_size) + 1)
+        )
+        self._warmup_steps: int = warmup_steps
+        self.compile_report: CompileReport = CompileReport()
 
     @classmethod
     async def build(
@@ -33,65 +478,495 @@ class Txt2ImgService:
         batch_size: int = 1,
         num_inference_steps: int = 50,
         max_wait_ms: int = 5 * 1000,
+        cache_memory_mb: int = 0,
+        cache_dir: str = "",
+        cache_disk_mb: int = 0,
+        batch_policy: str = "fixed",
+        request_timeout_s: float = 0,
+        expired_policy: str = "drop",
+        admission_max_queued: int = 64,
+        admission_max_queue_time_s: float = 300.0,
+        residency: ResidencyManager | None = None,
+        compile_mode: str = "max-autotune",
+        compile_cache_dir: str = "",
+        warmup_batch_sizes: list[int] | None = None,
+        warmup_steps: int = 2,
+        sizes: list[tuple[int, int]] | None = None,
+        guidance_scale: float = 5.0,
+        max_inference_steps: int = 100,
+        continuous_batching: bool = False,
+        max_running: int = 8,
+        prompt_cache_device_mb: int = 0,
+        prompt_cache_host_mb: int = 0,
+        output_formats: dict[str, int] | None = None,
+        encode_workers: int = 0,
+        flow_weights: dict[str, float] | None = None,
+        cache_unseeded: bool = True,
     ) -> "Txt2ImgService":
         async with cls._lock:
             if cls._instance is None:
-                inst = cls(model, batch_size, num_inference_steps, max_wait_ms)
+                cache = None
+                if cache_memory_mb > 0 or cache_dir:
+                    disk = None
+                    if cache_dir and cache_disk_mb > 0:
+                        disk = DiskCache(cache_dir, cache_disk_mb << 20, suffix=".img")
+                    cache = TieredCache(
+                        LRUCache(cache_memory_mb << 20), disk, name="txt2img"
+                    )
+                prompt_cache = None
+                if prompt_cache_device_mb > 0:
+                    prompt_cache = FeatureCache(
+                        prompt_cache_device_mb << 20,
+                        prompt_cache_host_mb << 20,
+                        sizeof=lambda v: sum(t.numel() * t.element_size() for t in v),
+                        to_host=lambda v: tuple(t.to("cpu") for t in v),
+                        to_device=lambda v: tuple(
+                            t.to("cuda", non_blocking=True) for t in v
+                        ),
+                        name="prompt_embeds",
+                    )
+                inst = cls(
+                    model,
+                    batch_size,
+                    num_inference_steps,
+                    max_wait_ms,
+                    cache,
+                    batch_policy,
+                    request_timeout_s,
+                    expired_policy,
+                    AdmissionController(
+                        admission_max_queued,
+                        admission_max_queue_time_s,
+                        name="txt2img",
+                    ),
+                    residency,
+                    compile_mode,
+                    compile_cache_dir,
+                    warmup_batch_sizes,
+                    warmup_steps,
+                    sizes,
+                    guidance_scale,
+                    max_inference_steps,
+                    continuous_batching,
+                    max_running,
+                    prompt_cache,
+                    output_formats,
+                    encode_workers,
+                    flow_weights,
+                    cache_unseeded,
+                )
                 await inst._initialize()
                 cls._instance = inst
             return cls._instance
 
-    async def _initialize(self):
-        def load_pipe():
-            pipe = DiffusionPipeline.from_pretrained(
-                self._model, torch_dtype=torch.float16
-            )
-            pipe.to(self.device_str)
+    def _load_pipe(self) -> None:
+        pipe = DiffusionPipeline.from_pretrained(self._model, torch_dtype=torch.float16)
+        pipe.to(self.device_str)
+        if self._compile_mode:
+            configure_compile_cache(self._compile_cache_dir)
             pipe.transformer = torch.compile(
                 pipe.transformer,
-                mode="max-autotune",
+                mode=self._compile_mode,
+            )
+        self.pipe = pipe
+        if self._continuous_batching:
+            self.batcher = ContinuousBatcher(
+                self.queue,
+                HunyuanStepEngine(pipe, self.device_str, self.prompt_cache),
+                self._max_running,
+            )
+
+    def _unload_pipe(self) -> None:
+        self.pipe = None
+        self.batcher = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _pipe_bytes(self) -> int:
+        components = self.pipe.components.values()
+        return module_bytes(*(c for c in components if isinstance(c, torch.nn.Module)))
+
+    async def _initialize(self):
+        if self.residency is not None:
+            # 首次请求时才加载
+            self.residency.register(
+                "txt2img",
+                load=self._load_pipe,
+                offload=lambda: self.pipe.to("cpu"),
+                restore=lambda: self.pipe.to(self.device_str),
+                unload=self._unload_pipe,
+                size=self._pipe_bytes,
+                estimate_bytes=weights_bytes(self._model),
+            )
+            if self.prompt_cache is not None:
+                # prompt embedding 缓存的设备层不随 pipeline 换出，按上限占用显存
+                self.residency.reserve(
+                    "txt2img_prompt_cache", self.prompt_cache.device.max_bytes
+                )
+            return
+        await asyncio.to_thread(self._load_pipe)
+
+    async def warmup(self) -> None:
+        # 每个 (分辨率, 批大小) 的首次推理都会触发 torch.compile 编译或读取编译缓存，
+        # 放在就绪之前完成，耗时与缓存命中记录在 compile_report 中
+        for width, height in self.sizes:
+            for batch_size in self.warmup_batch_sizes:
+                with self.compile_report.measure(f"{batch_size}x{width}x{height}"):
+                    await self.queue.submit(
+                        lambda: self._infer_sync(
+                            ["warmup"] * batch_size,
+                            [None] * batch_size,
+                            width,
+                            height,
+                            self._warmup_steps,
+                        ),
+                        flow="warmup",
+                    )
+        print(f"Txt2img warmup: {self.compile_report.summary()}")
+
+    def _resident(self):
+        if self.residency is None:
+            return contextlib.nullcontext()
+        return self.residency.use("txt2img")
+
+    def _infer_sync(
+        self,
+        batch_prompts: list,
+        batch_progress: list[GenerationProgress | None],
+        width: int = 1024,
+        height: int = 1024,
+        num_inference_steps: int | None = None,
+        guidance_scale: float | None = None,
+        seeds: list[int | None] | None = None,
+        negative_prompts: list[str | None] | None = None,
+    ) -> Any:
+        trackers = [p for p in batch_progress if p is not None]
+        total_steps = num_inference_steps or self.num_inference_steps
+        for p in trackers:
+            p.report(DENOISING, 0, total_steps)
+
+        def on_step_end(pipe, step: int, timestep, callback_kwargs: dict) -> dict:
+            # 最后一步结束后进入 VAE 解码阶段
+            phase = DECODING if step + 1 >= total_steps else DENOISING
+            for p in trackers:
+                p.report(phase, step + 1, total_steps)
+            _report_previews(
+                callback_kwargs["latents"], batch_progress, step + 1, total_steps
             )
-            self.pipe = pipe
+            return callback_kwargs
 
-        await asyncio.to_thread(load_pipe)
+        if guidance_scale is None:
+            guidance_scale = self.guidance_scale
+        generator = None
+        if seeds is not None and any(seed is not None for seed in seeds):
+            # 每行一个 generator
+            generator = [_generator(seed) for seed in seeds]
+        negative_prompt = None
+        if negative_prompts is not None and any(negative_prompts):
+            # 与 pipeline 对未指定 negative prompt 的处理一致，缺省行用空串
+            negative_prompt = [n or "" for n in negative_prompts]
 
-    def _infer_sync(self, batch_prompts: list) -> Any:
         with torch.inference_mode(), torch.amp.autocast(self.device_str, torch.float16):
+            prompt, text = batch_prompts, {"negative_prompt": negative_prompt}
+            if self.prompt_cache is not None:
+                prompt, text = None, self._text_inputs(batch_prompts, negative_prompt)
             return self.pipe(
-                batch_prompts,
-                num_inference_steps=self.num_inference_steps,
-                width=1024,
-                height=1024,
+                prompt,
+                num_inference_steps=total_steps,
+                guidance_scale=guidance_scale,
+                **text,
+                generator=generator,
+                width=width,
+                height=height,
+                # 分辨率已由 sizes 限定，不让 pipeline 改成最接近的标准分辨率
+                use_resolution_binning=False,
+                callback_on_step_end=on_step_end if trackers else None,
             )
 
-    async def flush_batch(self) -> Future:
-        batch_prompts = self.batch_prompts
-        future_result = self._future_result
-        self._batch_id += 1
-        self.batch_prompts = []
-        self._future_result = Future()
+    def _text_inputs(
+        self, batch_prompts: list[str], negative_prompts: list[str] | None
+    ) -> dict:
+        # 经 prompt_cache 编码 prompt 与 negative prompt，以 embedding 参数传入 pipeline
+        n = len(batch_prompts)
+        texts = list(batch_prompts) + (negative_prompts or [""] * n)
+        (clip, clip_mask), (t5, t5_mask) = _encode_texts(
+            self.pipe, texts, self.prompt_cache
+        )
+        return {
+            "prompt_embeds": clip[:n],
+            "negative_prompt_embeds": clip[n:],
+            "prompt_attention_mask": clip_mask[:n],
+            "negative_prompt_attention_mask": clip_mask[n:],
+            "prompt_embeds_2": t5[:n],
+            "negative_prompt_embeds_2": t5[n:],
+            "prompt_attention_mask_2": t5_mask[:n],
+            "negative_prompt_attention_mask_2": t5_mask[n:],
+        }
 
+    def _timed_infer(
+        self,
+        batch_prompts: list,
+        batch_progress: list[GenerationProgress | None],
+        *args,
+    ) -> Any:
+        start = time.perf_counter()
         try:
-            result = await self.queue.submit(lambda: self._infer_sync(batch_prompts))
-            future_result.set_result(result)
-        except Exception as e:
-            future_result.set_exception(e)
+            return self._infer_sync(batch_prompts, batch_progress, *args)
         finally:
-            return future_result
-
-    async def _flush_batch_later(self, batch_id: int) -> None:
-        await asyncio.sleep(self.max_wait_ms / 1000.0)
-        if batch_id == self._batch_id and len(self.batch_prompts) > 0:
-            await self.flush_batch()
-
-    async def queued_generate(self, prompt: str) -> Image:
-        result_id = len(self.batch_prompts)
-        self.batch_prompts.append(prompt)
-        if len(self.batch_prompts) >= self.batch_size:
-            future_result = await self.flush_batch()
-            return (await future_result).images[result_id]
+            self.admission.observe_batch(
+                time.perf_counter() - start, len(batch_prompts)
+            )
+
+    @property
+    def batch_requests(self) -> list[_Request]:
+        # 所有攒批组中还在攒批的请求
+        return [r for batch in self._batches.values() for r in batch.requests]
+
+    def _report_depth(self) -> None:
+        QUEUE_DEPTH.set(
+            sum(len(batch.requests) for batch in self._batches.values()),
+            queue="txt2img",
+        )
+
+    def _detach(self, batch: _Batch) -> list[_Request]:
+        # 取出批内请求并作废当前的 flush 定时器；之后同组的请求进入新批次
+        batch_requests = batch.requests
+        batch.batch_id += 1
+        batch.requests = []
+        if self._batches.get(batch.key) is batch:
+            del self._batches[batch.key]
+        self._report_depth()
+        return batch_requests
+
+    async def flush_batch(self, batch: _Batch, reason: str = "full") -> None:
+        batch_requests = self._detach(batch)
+        if not batch_requests:
+            return
+        BATCH_FLUSHES.inc(queue="txt2img", reason=reason)
+        BATCH_FILL_RATIO.observe(len(batch_requests) / self.batch_size, queue="txt2img")
+        now = time.monotonic()
+        for r in batch_requests:
+            BATCH_WAIT.observe(now - r.batched_at, queue="txt2img")
+        task = asyncio.current_task()
+        self._inflight[task] = batch_requests
+        for r in batch_requests:
+            r.flush_task = task
+        batch_prompts = [r.prompt for r in batch_requests]
+        batch_progress = [r.progress for r in batch_requests]
+        seeds = [r.seed for r in batch_requests]
+        negative_prompts = [r.negative_prompt for r in batch_requests]
+        deadlines = [r.deadline for r in batch_requests]
+
+        try:
+            # cost 按像素数 × 步数折算：512x512 的批约为 1024x1024 的四分之一，
+            # 20 步约为默认 50 步的 40%
+            result = await self.queue.submit(
+                lambda: self._timed_infer(
+                    batch_prompts,
+                    batch_progress,
+                    batch.width,
+                    batch.height,
+                    batch.steps,
+                    batch.guidance_scale,
+                    seeds,
+                    negative_prompts,
+                ),
+                flow="txt2img",
+                priority=min(r.priority for r in batch_requests),
+                deadline=None if None in deadlines else max(deadlines),
+                cost=len(batch_prompts)
+                * batch.width
+                * batch.height
+                / (1024 * 1024)
+                * batch.steps
+                / self.num_inference_steps,
+            )
+        except Exception as e:
+            for r in batch_requests:
+                if not r.future.done():
+                    r.future.set_exception(e)
         else:
-            if len(self.batch_prompts) == 1:
-                asyncio.create_task(self._flush_batch_later(self._batch_id))
-            result = await self._future_result
-            return result.images[result_id]
+            GENERATED_IMAGES.inc(len(result.images))
+            for r, image in zip(batch_requests, result.images):
+                if not r.future.done():
+                    r.future.set_result(image)
+        finally:
+            self._inflight.pop(task, None)
+
+    async def _flush_batch_later(self, batch: _Batch, batch_id: int) -> None:
+        start = time.monotonic()
+        while True:
+            delay = batch.policy.wait_s(
+                len(batch.requests), self.batch_size, time.monotonic() - start
+            )
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+            if batch_id != batch.batch_id:
+                return
+        if batch_id == batch.batch_id and len(batch.requests) > 0:
+            await self.flush_batch(batch, "timer")
+
+    def _cancel(self, request: _Request) -> None:
+        batch = request.batch
+        if request in batch.requests:
+            # 还在攒批：移出批次，空出的名额留给下一个请求
+            batch.requests.remove(request)
+            if not batch.requests:
+                self._detach(batch)
+            self._report_depth()
+            return
+        # 已 flush 的批只有全部请求都取消时才放弃，推理队列会跳过它
+        inflight = self._inflight.get(request.flush_task)
+        if inflight is not None and all(r.future.done() for r in inflight):
+            request.flush_task.cancel()
+
+    async def queued_generate(
+        self,
+        prompt: str,
+        progress: GenerationProgress | None = None,
+        size: tuple[int, int] | None = None,
+        steps: int | None = None,
+        guidance_scale: float | None = None,
+        seed: int | None = None,
+        negative_prompt: str | None = None,
+        priority: str | None = None,
+        timeout_ms: int | None = None,
+    ) -> Image:
+        # priority 为 high / normal / best_effort；timeout_ms 为本请求的截止时间，
+        # 与服务默认的 request_timeout_s 取较小者
+        width, height = self.check_size(size)
+        request = _Request(
+            prompt,
+            progress,
+            resolve_deadline(timeout_ms, self._request_timeout_s),
+            None,
+            width=width,
+            height=height,
+            steps=self.check_steps(steps),
+            guidance_scale=float(
+                guidance_scale if guidance_scale is not None else self.guidance_scale
+            ),
+            seed=seed,
+            negative_prompt=negative_prompt,
+            priority=resolve_priority(priority),
+        )
+        if self.batcher is not None:
+            # step 级批处理：下一个 step 边界加入运行批，取消时由 batcher 移出
+            image = await self.batcher.submit(
+                request, request.priority, request.deadline
+            )
+            if progress is not None:
+                progress.report(DONE)
+            return image
+
+        key = (width, height, request.steps, request.guidance_scale)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch(*key, self._policies[(width, height)])
+        request.batch = batch
+        request.future = asyncio.get_running_loop().create_future()
+        request.batched_at = time.monotonic()
+        batch.requests.append(request)
+        self._report_depth()
+        batch.policy.on_arrival()
+        # flush 在独立任务中执行，单个请求取消不会中断整批
+        if len(batch.requests) >= self.batch_size:
+            asyncio.create_task(self.flush_batch(batch))
+        elif len(batch.requests) == 1:
+            asyncio.create_task(self._flush_batch_later(batch, batch.batch_id))
+        try:
+            image = await request.future
+        except asyncio.CancelledError:
+            self._cancel(request)
+            raise
+        if progress is not None:
+            progress.report(DONE)
+        return image
+
+    def _cache_key(
+        self,
+        prompt: str,
+        width: int = 1024,
+        height: int = 1024,
+        seed: int | None = None,
+        steps: int | None = None,
+        guidance_scale: float | None = None,
+        negative_prompt: str | None = None,
+        output_format: str | None = None,
+    ) -> str:
+        output_format = output_format or next(iter(self.output_formats))
+        raw = json.dumps(
+            [
+                self._model,
+                prompt,
+                steps or self.num_inference_steps,
+                width,
+                height,
+                seed,
+                guidance_scale if guidance_scale is not None else self.guidance_scale,
+                negative_prompt or "",
+                output_format,
+                self.output_formats.get(output_format),
+            ],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def cached_generate(
+        self,
+        prompt: str,
+        progress: GenerationProgress | None = None,
+        size: tuple[int, int] | None = None,
+        steps: int | None = None,
+        guidance_scale: float | None = None,
+        seed: int | None = None,
+        negative_prompt: str | None = None,
+        output_format: str | None = None,
+        priority: str | None = None,
+        timeout_ms: int | None = None,
+    ) -> bytes:
+        # 返回按 output_format 编码的结果；命中缓存时不进入攒批与推理队列。
+        # 未指定 seed 的请求按 cache_unseeded 决定是否读写缓存
+        size = self.check_size(size)
+        steps = self.check_steps(steps)
+        output_format = self.check_format(output_format)
+        self.check_guidance_scale(guidance_scale)
+        self.check_seed(seed)
+        key = self._cache_key(
+            prompt, *size, seed, steps, guidance_scale, negative_prompt, output_format
+        )
+        cache = self.cache if seed is not None or self.cache_unseeded else None
+        if cache is not None:
+            data = await cache.get(key)
+            if data is not None:
+                if progress is not None:
+                    progress.report(DONE)
+                return data
+
+        # 缓存未命中才占用排队名额
+        with self.admission.admit():
+            async with self._resident():
+                image = await self.queued_generate(
+                    prompt,
+                    progress,
+                    size,
+                    steps,
+                    guidance_scale,
+                    seed,
+                    negative_prompt,
+                    priority,
+                    timeout_ms,
+                )
+        start = time.perf_counter()
+        data = await self.encode_pool.run(
+            encode_image, image, output_format, self.output_formats[output_format]
+        )
+        ENCODE.observe(time.perf_counter() - start, format=output_format)
+        if cache is not None:
+            await cache.put(key, data)
+        return data
+
+    def shutdown(self) -> None:
+        self.encode_pool.shutdown()
@@ -0,0 +1 @@
+# 不依赖 GPU 的压测工具：用可配置耗时的替身模型驱动真实的路由、攒批与推理队列
@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+import json
+import warnings
+from dataclasses import asdict
+
+from bench.arrivals import parse_arrivals
+from bench.fake_models import LatencyModel
+from bench.harness import format_table, run_grid
+
+# 用法示例：
+#   python -m bench --mode txt2img --arrivals poisson:4 --requests 200 \
+#       --batch-sizes 1,2,4,8 --max-wait-ms 50,200,1000 --base-ms 400 --per-item-ms 150
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="GPU-free load test with fake models")
+    parser.add_argument("--mode", choices=["txt2img", "img2txt"], default="txt2img")
+    parser.add_argument(
+        "--arrivals",
+        default="poisson:4",
+        help="poisson:<rate> | bursty:<rate>:<burst>[:<spread_s>] | trace:<path>[:<speedup>]",
+    )
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-sizes", type=_int_list, default=[1, 2, 4])
+    parser.add_argument("--max-wait-ms", type=_int_list, default=[50, 200])
+    parser.add_argument("--batch-policy", default="fixed")
+    parser.add_argument("--base-ms", type=float, default=200.0)
+    parser.add_argument("--per-item-ms", type=float, default=50.0)
+    parser.add_argument("--sigma", type=float, default=0.0)
+    parser.add_argument("--preprocess-workers", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print one JSON per row")
+    args = parser.parse_args()
+    # 替身模型在 CPU 上运行，忽略 autocast 的提示
+    warnings.filterwarnings("ignore", message="CUDA is not available")
+
+    arrivals = parse_arrivals(args.arrivals, args.requests, args.seed)
+    reports = asyncio.run(
+        run_grid(
+            args.mode,
+            args.batch_sizes,
+            args.max_wait_ms,
+            arrivals,
+            LatencyModel(args.base_ms, args.per_item_ms, args.sigma, args.seed),
+            batch_policy=args.batch_policy,
+            preprocess_workers=args.preprocess_workers,
+        )
+    )
+    if args.json:
+        for report in reports:
+            print(json.dumps(asdict(report)))
+    else:
+        print(format_table(reports))
+
+
+if __name__ == "__main__":
+    main()
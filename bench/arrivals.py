@@ -0,0 +1,64 @@
+import json
+import random
+from pathlib import Path
+
+# 到达过程：返回相对压测开始时间的到达时刻（秒，升序）
+
+
+def poisson(rate: float, count: int, seed: int = 0) -> list[float]:
+    # 到达间隔服从指数分布，平均每秒 rate 个请求
+    rng = random.Random(seed)
+    t = 0.0
+    times = []
+    for _ in range(count):
+        t += rng.expovariate(rate)
+        times.append(t)
+    return times
+
+
+def bursty(
+    rate: float, count: int, burst_size: int, spread_s: float = 0.0, seed: int = 0
+) -> list[float]:
+    # 请求成簇到达：簇之间按泊松过程间隔，簇内 burst_size 个请求在 spread_s 内到达，
+    # 平均速率仍为 rate
+    rng = random.Random(seed)
+    t = 0.0
+    times = []
+    while len(times) < count:
+        t += rng.expovariate(rate / burst_size)
+        for _ in range(min(burst_size, count - len(times))):
+            times.append(t + rng.uniform(0.0, spread_s))
+    return sorted(times)
+
+
+def trace(path: str, speedup: float = 1.0, limit: int | None = None) -> list[float]:
+    # 回放记录下来的到达时间：每行一个时间戳（秒），或带 "t" 字段的 JSON 对象；
+    # 以第一个时间戳为起点，speedup > 1 时按比例压缩间隔
+    stamps = []
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        stamps.append(float(json.loads(line)["t"] if line[0] == "{" else line))
+    stamps.sort()
+    if limit is not None:
+        stamps = stamps[:limit]
+    if not stamps:
+        return []
+    return [(t - stamps[0]) / speedup for t in stamps]
+
+
+def parse_arrivals(spec: str, count: int, seed: int = 0) -> list[float]:
+    # 命令行格式：poisson:<rate> | bursty:<rate>:<burst_size>[:<spread_s>]
+    #            | trace:<path>[:<speedup>]
+    kind, _, rest = spec.partition(":")
+    args = rest.split(":") if rest else []
+    if kind == "poisson" and len(args) == 1:
+        return poisson(float(args[0]), count, seed)
+    if kind == "bursty" and len(args) in (2, 3):
+        spread = float(args[2]) if len(args) == 3 else 0.0
+        return bursty(float(args[0]), count, int(args[1]), spread, seed)
+    if kind == "trace" and len(args) in (1, 2):
+        speedup = float(args[1]) if len(args) == 2 else 1.0
+        return trace(args[0], speedup, count)
+    raise ValueError(f"Unsupported arrival spec: {spec}")
@@ -0,0 +1,140 @@
+import hashlib
+import math
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from PIL import Image
+
+from app.service import img2txt_preprocess
+
+# 替身模型：只模拟每批推理的耗时与输出形状，接口与服务实际调用的部分一致
+
+
+class LatencyModel:
+    # 每批耗时 = base + per_item × 批大小；sigma > 0 时乘以均值为 1 的对数正态抖动
+    def __init__(
+        self,
+        base_ms: float,
+        per_item_ms: float = 0.0,
+        sigma: float = 0.0,
+        seed: int = 0,
+    ):
+        self.base_ms: float = base_ms
+        self.per_item_ms: float = per_item_ms
+        self.sigma: float = sigma
+        self._rng: random.Random = random.Random(seed)
+        self._lock: threading.Lock = threading.Lock()
+
+    def sample(self, batch_size: int) -> float:
+        mean_s = (self.base_ms + self.per_item_ms * batch_size) / 1000.0
+        if self.sigma <= 0:
+            return mean_s
+        with self._lock:
+            factor = self._rng.lognormvariate(-(self.sigma**2) / 2, self.sigma)
+        return mean_s * factor
+
+
+class FakeDiffusionPipeline:
+    # 代替 DiffusionPipeline：按步数均分耗时并回调 callback_on_step_end，
+    # 输出 image_size 见方的小图（忽略 width / height，避免编码耗时干扰测量；
+    # guidance_scale / negative_prompt / generator 等参数同样忽略）
+    def __init__(self, latency: LatencyModel, image_size: int = 64):
+        self.latency: LatencyModel = latency
+        self.image_size: int = image_size
+        self.batches: list[int] = []
+
+    def __call__(
+        self,
+        prompts: list[str],
+        num_inference_steps: int,
+        width: int,
+        height: int,
+        callback_on_step_end=None,
+        **kwargs,
+    ) -> SimpleNamespace:
+        self.batches.append(len(prompts))
+        step_s = self.latency.sample(len(prompts)) / num_inference_steps
+        for step in range(num_inference_steps):
+            time.sleep(step_s)
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, None, {})
+        images = []
+        for prompt in prompts:
+            color = tuple(hashlib.sha256(prompt.encode("utf-8")).digest()[:3])
+            images.append(Image.new("RGB", (self.image_size, self.image_size), color))
+        return SimpleNamespace(images=images)
+
+
+class FakeProcessor:
+    # 代替 AutoProcessor：图片按 patch_size 切块，每块一个视觉 token，
+    # 文本按空格切分，每个词一个 token
+    def __init__(self, patch_size: int = 28, pad_token_id: int = 0):
+        self.patch_size: int = patch_size
+        self.tokenizer: SimpleNamespace = SimpleNamespace(pad_token_id=pad_token_id)
+
+    def apply_chat_template(self, messages, add_generation_prompt, tokenize) -> str:
+        return " ".join(
+            item["text"]
+            for message in messages
+            for item in message["content"]
+            if item["type"] == "text"
+        )
+
+    def __call__(self, text: list[str], images: list[Image.Image], return_tensors):
+        grid_h = math.ceil(images[0].height / self.patch_size)
+        grid_w = math.ceil(images[0].width / self.patch_size)
+        tokens = grid_h * grid_w + len(text[0].split()) + 1
+        return {
+            "input_ids": np.arange(1, tokens + 1, dtype=np.int64)[None, :],
+            "pixel_values": np.zeros((grid_h * grid_w, 8), dtype=np.float32),
+            "image_grid_thw": np.array([[1, grid_h, grid_w]], dtype=np.int64),
+        }
+
+    def decode(self, token_ids, skip_special_tokens: bool = True) -> str:
+        ids = token_ids.tolist() if hasattr(token_ids, "tolist") else list(token_ids)
+        return " ".join(f"t{i}" for i in ids if i != self.tokenizer.pad_token_id)
+
+
+def init_fake_worker(patch_size: int = 28) -> None:
+    # 预处理进程池的 initializer：用 FakeProcessor 代替从模型目录加载的 processor
+    img2txt_preprocess._processor = FakeProcessor(patch_size)
+
+
+class FakeVisionLanguageModel:
+    # 代替 AutoModelForVision2Seq.generate：每批固定生成 max_new_tokens 个 token，
+    # 耗时按 token 均分，传入 streamer 时逐 token 回调
+    def __init__(self, latency: LatencyModel, eos_token_id: int = 2, seed: int = 0):
+        self.latency: LatencyModel = latency
+        self.device: torch.device = torch.device("cpu")
+        self.generation_config: SimpleNamespace = SimpleNamespace(
+            eos_token_id=eos_token_id
+        )
+        self._generator: torch.Generator = torch.Generator().manual_seed(seed)
+        self.batches: list[int] = []
+
+    def generate(
+        self,
+        input_ids: torch.Tensor,
+        max_new_tokens: int,
+        streamer=None,
+        **inputs,
+    ) -> torch.Tensor:
+        batch = input_ids.shape[0]
+        self.batches.append(batch)
+        generated = torch.randint(
+            3, 1000, (batch, max_new_tokens), generator=self._generator
+        )
+        step_s = self.latency.sample(batch) / max_new_tokens
+        if streamer is not None:
+            streamer.put(input_ids)
+        for step in range(max_new_tokens):
+            time.sleep(step_s)
+            if streamer is not None:
+                streamer.put(generated[:, step])
+        if streamer is not None:
+            streamer.end()
+        return torch.cat([input_ids, generated], dim=1)
@@ -0,0 +1,262 @@
+import asyncio
+import random
+import time
+from dataclasses import asdict, dataclass
+from io import BytesIO
+
+import httpx
+from fastapi import FastAPI
+from PIL import Image
+
+from app.models.admission import AdmissionController
+from app.models.bucket_planner import BucketPlanner
+from app.models.preprocess_pool import PreprocessPool
+from bench.fake_models import (
+    FakeDiffusionPipeline,
+    FakeProcessor,
+    FakeVisionLanguageModel,
+    LatencyModel,
+    init_fake_worker,
+)
+
+# 用替身模型构造真实的服务对象（攒批、推理队列、准入控制、预处理池都是实际代码），
+# 通过 ASGI 直接请求路由，不经过网络；每个网格点使用新的服务实例
+
+
+@dataclass
+class Scenario:
+    mode: str
+    batch_size: int
+    max_wait_ms: int
+    latency: LatencyModel
+    batch_policy: str = "fixed"
+    # txt2img 的去噪步数 / img2txt 的生成 token 数，只影响回调次数
+    steps: int = 4
+    max_new_tokens: int = 16
+    preprocess_workers: int = 0
+    # img2txt 只用一个分桶，批大小 = token_budget // max_tokens
+    max_tokens: int = 4096
+    admission_max_queued: int = 1024
+    admission_max_queue_time_s: float = 600.0
+
+
+@dataclass
+class Report:
+    mode: str
+    batch_size: int
+    max_wait_ms: int
+    requests: int
+    ok: int
+    rejected: int
+    failed: int
+    duration_s: float
+    throughput: float
+    mean_batch: float
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    max_ms: float
+
+
+def build_service(scenario: Scenario):
+    admission = AdmissionController(
+        scenario.admission_max_queued,
+        scenario.admission_max_queue_time_s,
+        name=scenario.mode,
+    )
+    if scenario.mode == "txt2img":
+        from app.service.txt2img_service import Txt2ImgService
+
+        service = Txt2ImgService(
+            "bench",
+            scenario.batch_size,
+            scenario.steps,
+            scenario.max_wait_ms,
+            batch_policy=scenario.batch_policy,
+            admission=admission,
+        )
+        service.pipe = FakeDiffusionPipeline(scenario.latency)
+        service.device_str = "cpu"
+        return service
+    if scenario.mode == "img2txt":
+        from app.service.img2txt_service import Img2TxtService
+
+        service = Img2TxtService(
+            "bench",
+            scenario.max_new_tokens,
+            scenario.max_wait_ms,
+            planner=BucketPlanner(
+                [scenario.max_tokens],
+                token_budget=scenario.max_tokens * scenario.batch_size,
+                refit_every=1 << 30,
+            ),
+            batch_policy=scenario.batch_policy,
+            admission=admission,
+        )
+        # 与 _initialize 相同的装配，只是换成替身
+        service.processor = FakeProcessor()
+        service.model = FakeVisionLanguageModel(scenario.latency)
+        service.preprocess_pool = PreprocessPool(
+            scenario.preprocess_workers, init_fake_worker, name="img2txt-preprocess"
+        )
+        for bucket in service.buckets:
+            bucket.processor = service.processor
+            bucket.model = service.model
+            bucket.collate_executor = service.collate_executor
+        return service
+    raise ValueError(f"Unsupported service mode: {scenario.mode}")
+
+
+def build_app(mode: str, service) -> FastAPI:
+    if mode == "txt2img":
+        from app.api.routes_txt2img import router
+    else:
+        from app.api.routes_img2txt import router
+    app = FastAPI()
+    app.state.services = {mode: service}
+    app.include_router(router)
+    return app
+
+
+def _sample_images(count: int = 8, seed: int = 0) -> list[bytes]:
+    # img2txt 的上传图片：几种不同尺寸，使 token 数有差异
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        size = (rng.randint(112, 448), rng.randint(112, 448))
+        buffer = BytesIO()
+        Image.new("RGB", size, (rng.randrange(256), 0, 0)).save(buffer, format="PNG")
+        images.append(buffer.getvalue())
+    return images
+
+
+async def _send(client: httpx.AsyncClient, mode: str, index: int, images: list[bytes]):
+    if mode == "txt2img":
+        return await client.post(
+            "/txt2img/generate", json={"prompt": f"bench prompt {index}"}
+        )
+    return await client.post(
+        "/img2txt/generate",
+        data={"prompt": f"describe image {index}"},
+        files={"image": ("bench.png", images[index % len(images)], "image/png")},
+    )
+
+
+async def run_load(
+    app: FastAPI, mode: str, arrivals: list[float], timeout_s: float = 600.0
+) -> tuple[list[tuple[int, float]], float]:
+    # 按到达时刻发出请求（开环，不等待前一个请求完成），返回 [(状态码, 耗时秒)] 与总时长
+    images = _sample_images() if mode == "img2txt" else []
+    results: list[tuple[int, float]] = []
+
+    async def one(client: httpx.AsyncClient, index: int) -> None:
+        start = time.perf_counter()
+        try:
+            response = await _send(client, mode, index, images)
+            status = response.status_code
+        except httpx.HTTPError:
+            status = 0
+        results.append((status, time.perf_counter() - start))
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=timeout_s
+    ) as client:
+        start = time.perf_counter()
+        tasks = []
+        for index, at in enumerate(arrivals):
+            delay = at - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(one(client, index)))
+        await asyncio.gather(*tasks)
+        duration = time.perf_counter() - start
+    return results, duration
+
+
+def _percentile_ms(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+
+def summarize(
+    scenario: Scenario,
+    results: list[tuple[int, float]],
+    duration_s: float,
+    batches: int,
+) -> Report:
+    ok = [elapsed for status, elapsed in results if status == 200]
+    rejected = sum(1 for status, _ in results if status == 429)
+    return Report(
+        mode=scenario.mode,
+        batch_size=scenario.batch_size,
+        max_wait_ms=scenario.max_wait_ms,
+        requests=len(results),
+        ok=len(ok),
+        rejected=rejected,
+        failed=len(results) - len(ok) - rejected,
+        duration_s=round(duration_s, 3),
+        throughput=round(len(ok) / duration_s, 2) if duration_s > 0 else 0.0,
+        mean_batch=round(len(ok) / batches, 2) if batches else 0.0,
+        p50_ms=round(_percentile_ms(ok, 0.5), 1),
+        p90_ms=round(_percentile_ms(ok, 0.9), 1),
+        p99_ms=round(_percentile_ms(ok, 0.99), 1),
+        max_ms=round(max(ok) * 1000, 1) if ok else 0.0,
+    )
+
+
+async def run_scenario(scenario: Scenario, arrivals: list[float]) -> Report:
+    service = build_service(scenario)
+    try:
+        results, duration = await run_load(
+            build_app(scenario.mode, service), scenario.mode, arrivals
+        )
+    finally:
+        if hasattr(service, "shutdown"):
+            service.shutdown()
+    batches = (
+        service.pipe.batches if scenario.mode == "txt2img" else service.model.batches
+    )
+    return summarize(scenario, results, duration, len(batches))
+
+
+async def run_grid(
+    mode: str,
+    batch_sizes: list[int],
+    max_waits_ms: list[int],
+    arrivals: list[float],
+    latency: LatencyModel,
+    **options,
+) -> list[Report]:
+    # batch_size × max_wait 网格，每个点使用相同的到达序列
+    reports = []
+    for batch_size in batch_sizes:
+        for max_wait_ms in max_waits_ms:
+            scenario = Scenario(mode, batch_size, max_wait_ms, latency, **options)
+            reports.append(await run_scenario(scenario, arrivals))
+    return reports
+
+
+def format_table(reports: list[Report]) -> str:
+    columns = [
+        "batch_size",
+        "max_wait_ms",
+        "ok",
+        "rejected",
+        "failed",
+        "throughput",
+        "mean_batch",
+        "p50_ms",
+        "p90_ms",
+        "p99_ms",
+        "max_ms",
+    ]
+    rows = [[str(asdict(r)[c]) for c in columns] for r in reports]
+    widths = [
+        max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)
+    ]
+    lines = ["  ".join(c.rjust(w) for c, w in zip(columns, widths))]
+    lines.extend("  ".join(v.rjust(w) for v, w in zip(row, widths)) for row in rows)
+    return "\n".join(lines)
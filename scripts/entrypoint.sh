@@ -1,2 +1,27 @@
 #!/usr/bin/env bash
-uv run uvicorn app.main:app --host 0.0.0.0 --port $SERVICE_PORT
\ No newline at end of file
+# FRONTEND_WORKERS > 1 时进入多进程模式：每个设备（MODEL_DEVICES，逗号分隔）启动一个
+# 持有模型的工作进程，再启动 FRONTEND_WORKERS 个 uvicorn 前端进程，经 unix socket 转发请求
+FRONTEND_WORKERS=${FRONTEND_WORKERS:-1}
+
+if [ "$FRONTEND_WORKERS" -le 1 ]; then
+    exec uv run uvicorn app.main:app --host 0.0.0.0 --port $SERVICE_PORT
+fi
+
+MODEL_DEVICES=${MODEL_DEVICES:-0}
+SOCKET_DIR=${SOCKET_DIR:-/tmp/vision-service}
+mkdir -p "$SOCKET_DIR"
+
+trap 'kill 0' EXIT
+
+sockets=()
+for device in ${MODEL_DEVICES//,/ }; do
+    socket="$SOCKET_DIR/worker-$device.sock"
+    CUDA_VISIBLE_DEVICES=$device uv run python -m app.model_worker --socket "$socket" &
+    sockets+=("\"$socket\"")
+done
+
+export MODEL_WORKER_SOCKETS="[$(IFS=,; echo "${sockets[*]}")]"
+uv run uvicorn app.main:app --host 0.0.0.0 --port $SERVICE_PORT --workers $FRONTEND_WORKERS &
+
+# 任一进程退出时整体退出，由容器重启
+wait -n
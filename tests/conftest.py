@@ -5,33 +5,83 @@ from fastapi.testclient import TestClient
 from PIL import Image
 import asyncio
 
+from app.models.admission import AdmissionController
+from app.models.image_codec import encode_image
+from app.service.txt2img_params import Txt2ImgParams
+
 
 # -------- Fake Services --------
-class FakeTxt2ImgService:
-    async def queued_generate(self, prompt: str):
-        await asyncio.sleep(2)
+class FakeTxt2ImgService(Txt2ImgParams):
+    def __init__(self):
+        self.admission = AdmissionController(max_queued=8, max_queue_time_s=60)
+        self.sizes = [(1024, 1024), (512, 512)]
+        self.num_inference_steps = 50
+        self.max_inference_steps = 100
+        self.output_formats = {"png": 6, "webp": 90, "jpeg": 90}
+        # 最近一次请求的生成参数
+        self.params = None
+
+    async def queued_generate(self, prompt: str, progress=None, size=None, **params):
+        from app.models.progress import DECODING, DENOISING, DONE
+
+        # 模拟 4 步去噪 + 解码，共约 2s
+        for step in range(4):
+            await asyncio.sleep(0.4)
+            if progress is not None:
+                progress.report(DENOISING, step + 1, 4)
+                if progress.wants_preview(step + 1, 4):
+                    preview = Image.new("RGB", (1, 1), color=(step, 0, 0))
+                    progress.report_preview(step + 1, encode_image(preview, "webp", 60))
+        if progress is not None:
+            progress.report(DECODING)
+        await asyncio.sleep(0.4)
         # 返回一个 2x2 的简单 PNG 图像
         img = Image.new("RGB", (2, 2), color=(255, 0, 0))
+        if progress is not None:
+            progress.report(DONE)
         return img
 
+    async def cached_generate(self, prompt: str, progress=None, size=None, **params):
+        self.params = {"size": size, **params}
+        with self.admission.admit():
+            img = await self.queued_generate(prompt, progress, size)
+        output_format = params.get("output_format") or "png"
+        return encode_image(img, output_format, self.output_formats[output_format])
+
 
 class FakeTxt2ImgServiceError(FakeTxt2ImgService):
-    async def queued_generate(self, prompt: str):
+    async def queued_generate(self, prompt: str, progress=None, size=None, **params):
         await asyncio.sleep(2)
         raise RuntimeError("simulate generation failure")
 
 
 class FakeImg2TxtService:
-    async def queued_generate(self, image_path: str, prompt: str):
-        await asyncio.sleep(2)
+    def __init__(self):
+        self.admission = AdmissionController(max_queued=8, max_queue_time_s=60)
+        self.max_new_tokens_limit = 1024
+
+    async def queued_generate(self, image: bytes, prompt: str, **params):
+        with self.admission.admit():
+            await asyncio.sleep(2)
         return f"TEXT({prompt})"
 
+    async def stream_generate(self, image: bytes, prompt: str, **params):
+        # 分三段输出，拼接后与 queued_generate 结果一致
+        for text in ("TEXT(", prompt, ")"):
+            await asyncio.sleep(0.1)
+            yield text
+
 
 class FakeImg2TxtServiceError(FakeImg2TxtService):
-    async def queued_generate(self, image_path: str, prompt: str):
+    async def queued_generate(self, image: bytes, prompt: str, **params):
         await asyncio.sleep(2)
         raise RuntimeError("simulate img2txt failure")
 
+    async def stream_generate(self, image: bytes, prompt: str, **params):
+        await asyncio.sleep(0.1)
+        raise RuntimeError("simulate img2txt failure")
+        yield
+
 
 # -------- Fixtures: Routers Only (Not full app.main) --------
 @pytest.fixture
@@ -0,0 +1,51 @@
+import pytest
+
+from app.models.admission import AdmissionController, Overloaded
+
+
+# 按排队数限制；名额在请求完成后释放
+def test_max_queued():
+    admission = AdmissionController(max_queued=2, max_queue_time_s=60)
+    with admission.admit(), admission.admit():
+        assert admission.in_flight == 2
+        with pytest.raises(Overloaded) as e:
+            with admission.admit():
+                pass
+        assert e.value.retry_after_s >= 1
+    assert admission.in_flight == 0
+    assert admission.stats()["rejected"] == 1
+    assert admission.stats()["accepting"] is True
+
+
+# 按最近批次耗时估计排队时间，超过上限时拒绝
+def test_estimated_queue_time():
+    admission = AdmissionController(max_queued=100, max_queue_time_s=10)
+    assert admission.estimate_s() == 0.0
+    admission.observe_batch(4.0, 2)
+    assert admission.estimate_s() == 0.0
+
+    with admission.admit(), admission.admit():
+        assert admission.estimate_s() == pytest.approx(8.0)
+        admission.check()
+        with admission.admit():
+            # 4 + 3 * 2 = 10 已到上限，再加一个请求就超过
+            assert admission.estimate_s() == pytest.approx(10.0)
+            admission.check()
+            with admission.admit():
+                with pytest.raises(Overloaded) as e:
+                    admission.check()
+                assert e.value.retry_after_s == 2
+    assert admission.stats()["estimated_ms"] == 0
+
+
+# 一个超过上限的慢批之后，空闲的服务仍然接收请求
+def test_idle_after_slow_batch():
+    admission = AdmissionController(max_queued=100, max_queue_time_s=60)
+    admission.observe_batch(61.0, 2)
+    assert admission.stats()["accepting"] is True
+    with admission.admit():
+        assert admission.in_flight == 1
+        # 已有请求在执行时仍按批耗时估计
+        with pytest.raises(Overloaded):
+            admission.check()
+    assert admission.stats()["accepting"] is True
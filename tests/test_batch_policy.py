@@ -0,0 +1,75 @@
+import pytest
+
+from app.models import batch_policy
+from app.models.batch_policy import (
+    ArrivalRatePolicy,
+    FixedWindowPolicy,
+    make_batch_policy,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+# 固定窗口：只按已等待时间计算
+def test_fixed_window():
+    policy = FixedWindowPolicy(5000)
+    assert policy.wait_s(1, 4, 0.0) == 5.0
+    assert policy.wait_s(3, 4, 4.0) == pytest.approx(1.0)
+    assert policy.wait_s(3, 4, 5.0) <= 0
+
+
+# 到达率：没有到达历史或预计攒不满时立即 flush，高峰时等待下一个请求
+def test_arrival_rate(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(batch_policy.time, "monotonic", clock)
+    policy = ArrivalRatePolicy(1000)
+
+    policy.on_arrival()
+    assert policy.wait_s(1, 8, 0.0) == 0.0
+
+    # 每 50ms 一个请求：剩余 7 个约 350ms，可以在 1s 内攒满
+    for _ in range(10):
+        clock.now += 0.05
+        policy.on_arrival()
+    assert policy.gap_s == pytest.approx(0.05)
+    assert policy.wait_s(1, 8, 0.0) == pytest.approx(0.05)
+    # 已等待 800ms，剩余 7 个来不及
+    assert policy.wait_s(1, 8, 0.8) == 0.0
+
+    # 长时间没有新请求时，估计间隔随之变大
+    clock.now += 0.5
+    assert policy.expected_gap_s() == pytest.approx(0.5)
+    assert policy.wait_s(5, 8, 0.0) == 0.0
+
+
+# 空闲之后的高峰：长间隔不计入估计，第二个请求到达后就开始攒批
+def test_arrival_rate_burst_after_idle(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(batch_policy.time, "monotonic", clock)
+    policy = ArrivalRatePolicy(1000)
+    for _ in range(5):
+        clock.now += 0.05
+        policy.on_arrival()
+
+    clock.now += 60
+    policy.on_arrival()
+    assert policy.gap_s is None
+    assert policy.wait_s(1, 8, 0.0) == 0.0
+
+    clock.now += 0.05
+    policy.on_arrival()
+    assert policy.gap_s == pytest.approx(0.05)
+    assert policy.wait_s(1, 8, 0.0) == pytest.approx(0.05)
+
+
+def test_make_batch_policy():
+    assert isinstance(make_batch_policy("fixed", 10), FixedWindowPolicy)
+    assert isinstance(make_batch_policy("arrival_rate", 10), ArrivalRatePolicy)
+    with pytest.raises(ValueError):
+        make_batch_policy("unknown", 10)
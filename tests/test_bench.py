@@ -0,0 +1,68 @@
+import pytest
+
+from bench.arrivals import bursty, parse_arrivals, poisson, trace
+from bench.fake_models import LatencyModel
+from bench.harness import Scenario, format_table, run_grid, run_scenario
+
+
+# 泊松到达：时刻递增，平均速率接近设定值
+def test_poisson_arrivals_rate():
+    times = poisson(rate=50, count=2000, seed=1)
+    assert times == sorted(times)
+    assert 40 < len(times) / times[-1] < 60
+
+
+# 成簇到达：spread 为 0 时每簇 burst_size 个请求同时到达
+def test_bursty_arrivals_grouped():
+    times = bursty(rate=10, count=10, burst_size=4)
+    assert len(times) == 10
+    assert len(set(times)) == 3
+    assert times.count(times[0]) == 4
+
+
+# 回放：支持纯时间戳与 JSON 行，以第一个时间戳为起点并按 speedup 压缩
+def test_trace_arrivals(tmp_path):
+    path = tmp_path / "trace.txt"
+    path.write_text('# comment\n100.0\n{"t": 101.0}\n100.5\n', encoding="utf-8")
+    assert trace(str(path)) == [0.0, 0.5, 1.0]
+    assert trace(str(path), speedup=2.0) == [0.0, 0.25, 0.5]
+    assert parse_arrivals(f"trace:{path}:2", count=2) == [0.0, 0.25]
+    with pytest.raises(ValueError):
+        parse_arrivals("uniform:3", count=2)
+
+
+# 抖动的均值保持不变
+def test_latency_model_jitter_mean():
+    latency = LatencyModel(base_ms=10, per_item_ms=5, sigma=0.5, seed=3)
+    samples = [latency.sample(2) for _ in range(4000)]
+    assert LatencyModel(10, 5).sample(2) == pytest.approx(0.02)
+    assert sum(samples) / len(samples) == pytest.approx(0.02, rel=0.1)
+
+
+# 成簇到达时，批大小 4 的配置能攒出多于一个请求的批
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["txt2img", "img2txt"])
+async def test_grid_batches_bursts(mode):
+    arrivals = bursty(rate=80, count=12, burst_size=4)
+    reports = await run_grid(
+        mode, [1, 4], [20], arrivals, LatencyModel(base_ms=5, per_item_ms=1)
+    )
+    assert [r.batch_size for r in reports] == [1, 4]
+    assert all(r.ok == 12 and r.failed == 0 for r in reports)
+    assert reports[1].mean_batch > 1
+    assert "p99_ms" in format_table(reports)
+
+
+# 准入上限很小时超出的请求返回 429，计入 rejected
+@pytest.mark.asyncio
+async def test_scenario_counts_rejections():
+    scenario = Scenario(
+        "txt2img",
+        batch_size=1,
+        max_wait_ms=10,
+        latency=LatencyModel(base_ms=50),
+        admission_max_queued=1,
+    )
+    report = await run_scenario(scenario, [0.0] * 4)
+    assert report.rejected > 0
+    assert report.ok + report.rejected == 4
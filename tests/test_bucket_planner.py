@@ -0,0 +1,57 @@
+from app.models.bucket_planner import BucketPlanner
+
+
+# 初始边界对应的批大小，超过最大边界时不路由
+def test_route_and_batch_size():
+    planner = BucketPlanner([1536, 6144, 24576], token_budget=49152)
+    assert [planner.batch_size(i) for i in range(3)] == [32, 8, 2]
+    assert planner.route(1000) == 0
+    assert planner.route(1536) == 0
+    assert planner.route(5000) == 1
+    assert planner.route(24576) == 2
+    assert planner.route(24577) is None
+
+
+# 请求集中在两个大小附近时，边界收缩到对应位置，减少填充浪费
+def test_refit_follows_distribution():
+    planner = BucketPlanner(
+        [1536, 6144, 24576], token_budget=49152, max_waste=0.05, refit_every=100
+    )
+    changed = False
+    for i in range(100):
+        changed |= planner.observe(700 if i % 2 else 3000)
+    assert changed and planner.refits == 1
+    assert planner.edges == [768, 3072, 24576]
+    assert [planner.batch_size(i) for i in range(3)] == [64, 16, 2]
+    assert planner.waste() <= 0.05
+
+
+# 浪费预算宽松时使用更少的桶，严格时用满最大桶数
+def test_waste_budget_controls_bucket_count():
+    sizes = [300, 900, 2000, 5000, 9000]
+    loose = BucketPlanner([1536, 6144, 24576], 49152, max_waste=0.9, refit_every=10**6)
+    strict = BucketPlanner([1536, 6144, 24576], 49152, max_waste=0.0, refit_every=10**6)
+    for planner in (loose, strict):
+        for size in sizes * 20:
+            planner.observe(size)
+    assert loose.refit() == [9216, 24576]
+    edges = strict.refit()
+    assert len(edges) == 4 and edges[-1] == 24576
+    assert strict.waste(edges) < strict.waste([24576])
+
+
+# 重新划分后，观测到的每种请求大小的批大小都不小于划分前；
+# 只划分出一个桶时也按观测到的最大值决定批大小
+def test_refit_does_not_shrink_batches():
+    for sizes in ([700, 3000], [1000, 5000, 20000], [4000]):
+        planner = BucketPlanner(
+            [1536, 6144, 24576], token_budget=49152, max_waste=0.05, refit_every=60
+        )
+        before = {s: planner.batch_size(planner.route(s)) for s in sizes}
+        for i in range(60):
+            planner.observe(sizes[i % len(sizes)])
+        assert planner.refits == 1
+        for size in sizes:
+            assert planner.batch_size(planner.route(size)) >= before[size]
+        assert planner.route(24576) == len(planner.edges) - 1
+    assert planner.edges == [4096, 24576] and planner.batch_size(0) == 12
@@ -0,0 +1,32 @@
+import torch
+
+from app.models.compile_cache import CompileReport, configure_compile_cache
+
+
+# CPU inductor：首次编译写入缓存目录，重置 dynamo 后再次编译命中缓存
+def test_compile_cache_hit_after_reset(tmp_path, monkeypatch):
+    monkeypatch.setenv("TORCHINDUCTOR_CACHE_DIR", "")
+    monkeypatch.setenv("TRITON_CACHE_DIR", "")
+    cache_dir = tmp_path / "inductor"
+    configure_compile_cache(str(cache_dir))
+    module = torch.nn.Sequential(torch.nn.Linear(8, 8), torch.nn.ReLU())
+    x = torch.randn(2, 8)
+    expected = module(x)
+
+    report = CompileReport()
+    torch._dynamo.reset()
+    # 与服务中的推理一样在 inference_mode 下编译
+    with torch.inference_mode(), report.measure("cold"):
+        assert torch.allclose(torch.compile(module)(x), expected, atol=1e-6)
+    torch._dynamo.reset()
+    with torch.inference_mode(), report.measure("warm"):
+        assert torch.allclose(torch.compile(module)(x), expected, atol=1e-6)
+    torch._dynamo.reset()
+
+    cold, warm = report.shapes
+    assert cold["cache_misses"] > 0
+    assert warm["cache_hits"] > 0 and warm["cache_misses"] == 0
+    assert any(cache_dir.iterdir())
+    summary = report.summary()
+    assert summary["cache_dir"] == str(cache_dir)
+    assert summary["cache_hits"] == warm["cache_hits"]
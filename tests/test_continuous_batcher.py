@@ -0,0 +1,143 @@
+import asyncio
+from dataclasses import dataclass, field
+
+import pytest
+
+from app.models.continuous_batcher import ContinuousBatcher
+from app.models.infer_queue import InferQueue
+
+
+@dataclass
+class FakeSeq:
+    name: str
+    length: int
+    generated: list[str] = field(default_factory=list)
+
+
+class FakeEngine:
+    # item 为 (name, length)，每个 step 为运行中的每条序列生成一个 token
+    def __init__(self):
+        self.step_batches: list[list[str]] = []
+        self.released: list[str] = []
+        self.resets: int = 0
+
+    def prefill(self, item):
+        name, length = item
+        if length < 0:
+            raise ValueError(f"bad item {name}")
+        seq = FakeSeq(name, length)
+        if length > 0:
+            seq.generated.append(f"{name}0")
+        return seq
+
+    def step(self, states):
+        self.step_batches.append([s.name for s in states])
+        for s in states:
+            s.generated.append(f"{s.name}{len(s.generated)}")
+
+    def is_finished(self, state):
+        return len(state.generated) >= state.length
+
+    def finish(self, state):
+        return "".join(state.generated)
+
+    def release(self, state):
+        self.released.append(state.name)
+
+    def reset(self):
+        self.resets += 1
+
+
+# 单个请求完整生成
+@pytest.mark.asyncio
+async def test_single_request():
+    engine = FakeEngine()
+    batcher = ContinuousBatcher(InferQueue(), engine, max_running=4)
+
+    result = await batcher.submit(("a", 3))
+    assert result == "a0a1a2"
+    assert engine.step_batches == [["a"], ["a"]]
+    assert engine.released == ["a"]
+
+
+# 短序列先完成并退出运行批，不等待长序列
+@pytest.mark.asyncio
+async def test_short_sequence_retires_early():
+    engine = FakeEngine()
+    batcher = ContinuousBatcher(InferQueue(), engine, max_running=4)
+
+    finished: list[str] = []
+
+    async def run(name, length):
+        result = await batcher.submit((name, length))
+        finished.append(name)
+        return result
+
+    results = await asyncio.gather(run("long", 6), run("short", 2))
+    assert results == ["long0long1long2long3long4long5", "short0short1"]
+    assert finished == ["short", "long"]
+    assert ["long", "short"] in engine.step_batches
+    assert engine.step_batches[-1] == ["long"]
+
+
+# 运行中到达的新请求在 step 边界加入运行批
+@pytest.mark.asyncio
+async def test_new_request_joins_running_batch():
+    engine = FakeEngine()
+    batcher = ContinuousBatcher(InferQueue(), engine, max_running=4)
+
+    long_task = asyncio.create_task(batcher.submit(("a", 20)))
+    while len(engine.step_batches) < 3:
+        await asyncio.sleep(0)
+    assert batcher.num_running == 1
+
+    assert await batcher.submit(("b", 2)) == "b0b1"
+    assert ["a", "b"] in engine.step_batches
+    assert not long_task.done()
+    assert await long_task == "".join(f"a{i}" for i in range(20))
+
+
+# 运行批不超过 max_running，多出的请求排队等待空位
+@pytest.mark.asyncio
+async def test_max_running_limit():
+    engine = FakeEngine()
+    batcher = ContinuousBatcher(InferQueue(), engine, max_running=2)
+
+    await asyncio.gather(*(batcher.submit((f"s{i}", 3)) for i in range(5)))
+    assert max(len(batch) for batch in engine.step_batches) == 2
+    assert batcher.num_running == 0
+    assert batcher.num_waiting == 0
+
+
+# prefill 失败只影响对应请求
+@pytest.mark.asyncio
+async def test_prefill_error_isolated():
+    engine = FakeEngine()
+    batcher = ContinuousBatcher(InferQueue(), engine, max_running=4)
+
+    results = await asyncio.gather(
+        batcher.submit(("ok", 2)),
+        batcher.submit(("bad", -1)),
+        return_exceptions=True,
+    )
+    assert results[0] == "ok0ok1"
+    assert isinstance(results[1], ValueError)
+
+
+# step 失败时运行批中的请求都收到异常，引擎的批状态被重置，之后的请求不受影响
+@pytest.mark.asyncio
+async def test_step_failure_resets_engine():
+    class FailingEngine(FakeEngine):
+        def step(self, states):
+            if any(s.name == "boom" for s in states):
+                raise RuntimeError("step failed")
+            super().step(states)
+
+    engine = FailingEngine()
+    batcher = ContinuousBatcher(InferQueue(), engine, max_running=4)
+    results = await asyncio.gather(
+        batcher.submit(("boom", 3)), batcher.submit(("a", 3)), return_exceptions=True
+    )
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert engine.resets == 1 and sorted(engine.released) == ["a", "boom"]
+    assert await batcher.submit(("b", 2)) == "b0b1"
@@ -0,0 +1,39 @@
+from app.models.feature_cache import FeatureCache
+
+
+def make_cache(device_bytes: int, host_bytes: int) -> FeatureCache:
+    # 用 (位置, 数据) 元组模拟设备/主机上的张量
+    return FeatureCache(
+        device_bytes,
+        host_bytes,
+        sizeof=lambda v: len(v[1]),
+        to_host=lambda v: ("host", v[1]),
+        to_device=lambda v: ("device", v[1]),
+    )
+
+
+# 设备层容量不足时淘汰到主机层，主机层命中后搬回设备层
+def test_device_eviction_offloads_to_host():
+    cache = make_cache(device_bytes=8, host_bytes=100)
+    cache.put("a", ("device", b"aaaa"))
+    cache.put("b", ("device", b"bbbb"))
+    cache.put("c", ("device", b"cccc"))
+
+    assert "a" not in cache.device
+    assert cache.host.get("a") == ("host", b"aaaa")
+
+    assert cache.get("a") == ("device", b"aaaa")
+    assert "a" not in cache.host
+    assert cache.get("c") == ("device", b"cccc")
+    assert cache.get("missing") is None
+    stats = cache.stats()
+    assert (stats["device_hits"], stats["host_hits"], stats["misses"]) == (1, 1, 1)
+
+
+# 主机层容量为 0 时淘汰即丢弃
+def test_no_host_tier():
+    cache = make_cache(device_bytes=4, host_bytes=0)
+    cache.put("a", ("device", b"aaaa"))
+    cache.put("b", ("device", b"bbbb"))
+    assert cache.get("a") is None
+    assert len(cache.host) == 0
@@ -0,0 +1,42 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from app.models.image_codec import encode_image, negotiate, supported_formats
+
+FORMATS = {"png": 6, "webp": 90, "jpeg": 90}
+
+
+# 按 q 值选择已启用的格式；q 相同时取先出现的；通配符与未启用的格式不参与选择
+def test_negotiate_accept():
+    assert negotiate("image/webp,image/png", FORMATS) == "webp"
+    assert negotiate("image/png;q=0.5, image/jpeg;q=0.8", FORMATS) == "jpeg"
+    assert negotiate("image/avif,image/webp;q=0.9", FORMATS) == "webp"
+    assert negotiate("image/webp;q=0", FORMATS) is None
+    assert negotiate("text/html,*/*;q=0.8", FORMATS) is None
+    assert negotiate(None, FORMATS) is None
+
+
+# PNG 任意压缩级别都无损，有损格式的质量影响输出大小
+def test_encode_image_formats():
+    image = Image.effect_noise((64, 64), 64).convert("RGB")
+    for level in (1, 9):
+        data = encode_image(image, "png", level)
+        assert Image.open(BytesIO(data)).tobytes() == image.tobytes()
+
+    high = encode_image(image, "jpeg", 95)
+    low = encode_image(image, "jpeg", 30)
+    assert high.startswith(b"\xff\xd8") and len(low) < len(high)
+    assert encode_image(image, "webp", 80)[8:12] == b"WEBP"
+    assert list(supported_formats({"webp": 80, "bmp": 1, "png": 6})) == ["webp", "png"]
+
+
+# 默认格式不区分大小写，不支持的格式给出可选值
+def test_settings_output_format():
+    from app.config import Settings
+
+    qualities = Settings(txt2img_output_format="WebP").txt2img_output_qualities
+    assert list(qualities) == ["webp", "png", "jpeg", "avif"]
+    with pytest.raises(ValueError, match="png, webp, jpeg, avif"):
+        Settings(txt2img_output_format="gif").txt2img_output_qualities
@@ -0,0 +1,39 @@
+import io
+
+from PIL import Image, ImageDraw
+
+from app.models.image_hash import content_hash, perceptual_hash
+
+
+def make_image(size=(256, 192)) -> Image.Image:
+    img = Image.new("RGB", size, (30, 60, 90))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((20, 20, 120, 150), fill=(240, 200, 40))
+    draw.ellipse((140, 40, 230, 170), fill=(200, 30, 30))
+    return img
+
+
+def reencode(img: Image.Image, fmt: str, **kwargs) -> Image.Image:
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **kwargs)
+    buf.seek(0)
+    return Image.open(buf).convert("RGB")
+
+
+# 内容哈希只取决于像素：无损重新编码后相同，像素变化后不同
+def test_content_hash_depends_on_pixels():
+    img = make_image()
+    assert content_hash(img) == content_hash(reencode(img, "PNG"))
+    other = img.copy()
+    other.putpixel((0, 0), (0, 0, 0))
+    assert content_hash(img) != content_hash(other)
+
+
+# 感知哈希：缩放、有损重新编码后仍然相同，不同图片不同
+def test_perceptual_hash_robust_to_resize_and_jpeg():
+    img = make_image()
+    phash = perceptual_hash(img)
+    assert len(phash) == 16
+    assert perceptual_hash(img.resize((128, 96))) == phash
+    assert perceptual_hash(reencode(img, "JPEG", quality=80)) == phash
+    assert perceptual_hash(img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)) != phash
@@ -0,0 +1,433 @@
+import io
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.models.preprocess_pool import (
+    PreprocessPool,
+    read_array,
+    release_array,
+    share_array,
+)
+from app.models.result_cache import LRUCache, TieredCache
+from app.service import img2txt_service
+from app.service.img2txt_preprocess import PreparedInputs
+from app.service.img2txt_service import Img2TxtService
+
+
+def fake_prepare_inputs(pixels, prompt):
+    # 不加载 processor：把像素均值当作 pixel_values，prompt 长度当作 input_ids
+    image = read_array(pixels)
+    return PreparedInputs(
+        list(range(len(prompt))),
+        share_array(image.reshape(-1, 3).astype(np.float32)),
+        [[1, image.shape[0], image.shape[1]]],
+    )
+
+
+def make_service(monkeypatch, perceptual: bool = False):
+    # 不加载模型，用假的 Bucket.submit 代替推理
+    monkeypatch.setattr(img2txt_service, "prepare_inputs", fake_prepare_inputs)
+    cache = TieredCache(LRUCache(1 << 20, ttl_s=60))
+    service = Img2TxtService(
+        "fake-model", 10, 50, cache=cache, perceptual_cache=perceptual
+    )
+    service.processor = object()
+    service.model = object()
+    service.preprocess_pool = PreprocessPool(0)
+    calls = []
+
+    async def fake_submit(request):
+        calls.append(request.prompt)
+        return f"TEXT({request.prompt})"
+
+    for bucket in service.buckets:
+        bucket.submit = fake_submit
+    return service, calls
+
+
+def encode(img: Image.Image, fmt: str = "PNG") -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def sample_image(size=(64, 48)) -> Image.Image:
+    img = Image.new("RGB", size, (10, 20, 30))
+    img.paste((250, 250, 0), (5, 5, 30, 40))
+    return img
+
+
+# 相同像素 + 相同 prompt 命中缓存，不再进入分桶
+@pytest.mark.asyncio
+async def test_cache_hit_skips_bucket(monkeypatch):
+    service, calls = make_service(monkeypatch)
+    img = sample_image()
+    png = encode(img)
+    bmp = encode(img, "BMP")
+
+    assert await service.queued_generate(png, "describe") == "TEXT(describe)"
+    assert await service.queued_generate(bmp, "describe") == "TEXT(describe)"
+    assert calls == ["describe"]
+
+    await service.queued_generate(png, "other prompt")
+    assert calls == ["describe", "other prompt"]
+
+
+# 感知哈希模式下缩放后的图片也命中
+@pytest.mark.asyncio
+async def test_perceptual_cache_hit_on_resized_copy(monkeypatch):
+    service, calls = make_service(monkeypatch, perceptual=True)
+    img = sample_image((256, 192))
+    first = encode(img)
+    small = encode(img.resize((128, 96)), "JPEG")
+
+    await service.queued_generate(first, "describe")
+    await service.queued_generate(small, "describe")
+    assert calls == ["describe"]
+
+
+# 流式接口命中缓存时一次性输出完整结果
+@pytest.mark.asyncio
+async def test_stream_generate_cache_hit(monkeypatch):
+    service, calls = make_service(monkeypatch)
+    png = encode(sample_image())
+    await service.queued_generate(png, "describe")
+
+    chunks = [text async for text in service.stream_generate(png, "describe")]
+    assert chunks == ["TEXT(describe)"]
+    assert calls == ["describe"]
+
+
+# 视觉特征缓存：批次中已缓存的图片不再经过视觉编码器
+def test_feature_cache_hook_encodes_only_missing_images():
+    import torch
+
+    from app.models.feature_cache import FeatureCache
+    from app.service.img2txt_service import _image_keys, _install_feature_cache
+
+    class FakeVisionModel:
+        def __init__(self):
+            self.encoded_patches = []
+
+        def get_image_features(self, pixel_values, image_grid_thw=None):
+            # 每 4 个 patch 合并为一个特征向量
+            self.encoded_patches.append(pixel_values.shape[0])
+            merged = pixel_values.view(-1, 4, pixel_values.shape[-1]).sum(1)
+            return torch.split(merged, (image_grid_thw.prod(-1) // 4).tolist())
+
+    class FakeModel:
+        def __init__(self):
+            self.model = FakeVisionModel()
+
+    model = FakeModel()
+    cache = FeatureCache(
+        1 << 20,
+        0,
+        sizeof=lambda t: t.numel() * t.element_size(),
+        to_host=lambda t: t,
+        to_device=lambda t: t,
+    )
+    _install_feature_cache(model, cache)
+
+    grid = torch.tensor([[1, 2, 2], [1, 2, 4]])
+    pixels = torch.arange(12 * 3, dtype=torch.float32).view(12, 3)
+    expected = FakeVisionModel().get_image_features(pixels, grid)
+
+    with _image_keys(["img-a", "img-b"]):
+        first = model.model.get_image_features(pixels, grid)
+    assert model.model.encoded_patches == [12]
+    # 缓存条目不与整批输出共享存储，字节预算按实际占用计算
+    cached = cache.get("img-b")
+    assert cached.untyped_storage().nbytes() == cached.numel() * cached.element_size()
+    assert cached.data_ptr() != first[1].data_ptr()
+
+    pixels_b_a = torch.cat([pixels[4:], pixels[:4]])
+    with _image_keys(["img-b", "img-a"]):
+        second = model.model.get_image_features(pixels_b_a, grid[[1, 0]])
+    assert model.model.encoded_patches == [12]
+    assert torch.equal(second[0], expected[1]) and torch.equal(second[1], expected[0])
+    assert all(torch.equal(a, b) for a, b in zip(first, expected))
+
+    # 混合批次：只编码未命中的图片
+    with _image_keys(["img-c", "img-a"]):
+        model.model.get_image_features(pixels[:8], grid[[0, 0]])
+    assert model.model.encoded_patches == [12, 4]
+
+    # 没有设置图片 key 时直接走原始编码
+    model.model.get_image_features(pixels, grid)
+    assert model.model.encoded_patches == [12, 4, 12]
+
+
+# 上传的字节在预处理池中解码与预处理，Bucket 收到共享内存中的 pixel_values
+@pytest.mark.asyncio
+async def test_image_preprocessed_in_pool(monkeypatch):
+    service, _ = make_service(monkeypatch)
+    received = []
+
+    async def fake_submit(request):
+        received.append(request)
+        return "ok"
+
+    for bucket in service.buckets:
+        bucket.submit = fake_submit
+
+    img = sample_image().convert("RGBA")
+    await service.queued_generate(encode(img), "describe")
+    prepared = received[0].prepared
+    assert prepared.image_grid_thw == [[1, img.height, img.width]]
+    assert read_array(prepared.pixel_values, unlink=True).shape == (
+        img.width * img.height,
+        3,
+    )
+    assert received[0].image_key is not None
+    assert service.preprocess_pool.stats()["completed"] == 2
+
+    with pytest.raises(Exception, match="cannot identify image"):
+        await service.queued_generate(b"not an image", "describe")
+    assert service.preprocess_pool.stats()["failed"] == 1
+
+
+# 多个请求左填充拼批，pixel_values 按顺序拼接
+def test_collate_left_pads_batch():
+    import torch
+
+    from app.service.img2txt_service import _collate
+
+    a = PreparedInputs([5, 6, 7], share_array(np.ones((4, 2), np.float32)), [[1, 2, 2]])
+    b = PreparedInputs([8], share_array(np.zeros((8, 2), np.float32)), [[1, 2, 4]])
+    inputs = _collate([a, b], pad_token_id=0, device="cpu")
+    assert inputs["input_ids"].tolist() == [[5, 6, 7], [0, 0, 8]]
+    assert inputs["attention_mask"].tolist() == [[1, 1, 1], [0, 0, 1]]
+    assert inputs["pixel_values"].shape == (12, 2)
+    assert torch.equal(inputs["image_grid_thw"], torch.tensor([[1, 2, 2], [1, 2, 4]]))
+
+
+# 按 input_ids 长度（已展开的视觉 token + 文本 token）路由到分桶
+@pytest.mark.asyncio
+async def test_routes_by_token_count(monkeypatch):
+    service, _ = make_service(monkeypatch)
+    service.cache = None
+    routed = []
+    for index, bucket in enumerate(service.buckets):
+
+        async def fake_submit(request, index=index):
+            routed.append(index)
+            return "ok"
+
+        bucket.submit = fake_submit
+
+    png = encode(sample_image())
+    await service.queued_generate(png, "x" * 100)
+    await service.queued_generate(png, "x" * 2000)
+    await service.queued_generate(png, "x" * 10000)
+    assert routed == [0, 1, 2]
+    assert routed == [0, 1, 2]
+
+
+# 请求的 priority / timeout_ms 写入分桶请求；分桶权重来自服务配置
+@pytest.mark.asyncio
+async def test_priority_and_deadline_reach_bucket(monkeypatch):
+    import time
+
+    from app.models.infer_queue import BEST_EFFORT, NORMAL
+
+    service, _ = make_service(monkeypatch)
+    service.cache = None
+    submitted = []
+    for bucket in service.buckets:
+
+        async def fake_submit(request):
+            submitted.append(request)
+            return "ok"
+
+        bucket.submit = fake_submit
+
+    png = encode(sample_image())
+    before = time.monotonic()
+    await service.queued_generate(png, "a", priority="best_effort", timeout_ms=5000)
+    await service.queued_generate(png, "b")
+    assert [r.priority for r in submitted] == [BEST_EFFORT, NORMAL]
+    assert before + 4 < submitted[0].deadline <= time.monotonic() + 5
+    assert submitted[1].deadline is None
+    with pytest.raises(ValueError):
+        await service.queued_generate(png, "c", timeout_ms=0)
+
+    weighted = Img2TxtService("fake-model", 10, 50, flow_weights={"bucket-2": 4.0})
+    assert weighted.queue._weights == {"bucket-2": 4.0}
+
+
+# 超过最大 token 数的请求抛出 InputTooLarge，且不写入结果缓存
+@pytest.mark.asyncio
+async def test_too_large_input_not_cached(monkeypatch):
+    from app.models.bucket_planner import InputTooLarge
+
+    service, calls = make_service(monkeypatch)
+    png = encode(sample_image())
+    for _ in range(2):
+        with pytest.raises(InputTooLarge) as e:
+            await service.queued_generate(png, "x" * 30000)
+        assert e.value.max_tokens == service.planner.max_tokens
+    assert calls == []
+    assert len(service.cache.memory) == 0
+
+
+# 分桶攒批中的请求取消后移出批次并释放共享内存
+@pytest.mark.asyncio
+async def test_bucket_cancel_removes_pending_request(monkeypatch):
+    import asyncio
+
+    import torch
+
+    from app.models.metrics import BATCH_WAIT
+    from app.service.img2txt_service import _Request
+
+    service, _ = make_service(monkeypatch)
+    bucket = service.buckets[0]
+    # 恢复真实的 submit
+    del bucket.submit
+    bucket.batch_size = 2
+    batches = []
+
+    async def fake_process_inputs(batch_requests):
+        for r in batch_requests:
+            release_array(r.prepared.pixel_values)
+        return {"input_ids": torch.zeros((len(batch_requests), 1), dtype=torch.long)}
+
+    def fake_infer(inputs, batch_requests):
+        batches.append([r.prompt for r in batch_requests])
+        return torch.tensor([[0, len(r.prompt)] for r in batch_requests])
+
+    class FakeProcessor:
+        tokenizer = SimpleNamespace(pad_token_id=0)
+
+        def decode(self, token_ids, skip_special_tokens=True):
+            return f"len={token_ids.tolist()}"
+
+    bucket._process_inputs = fake_process_inputs
+    bucket._timed_infer = fake_infer
+    bucket.processor = FakeProcessor()
+
+    def request(prompt):
+        pixels = share_array(np.zeros((2, 2, 3), np.uint8))
+        prepared = fake_prepare_inputs(pixels, prompt)
+        release_array(pixels)
+        return _Request(prepared, prompt)
+
+    first = request("a")
+    a = asyncio.create_task(bucket.submit(first))
+    await asyncio.sleep(0)
+    a.cancel()
+    await asyncio.sleep(0)
+    assert bucket._batch_requests == []
+    with pytest.raises(FileNotFoundError):
+        read_array(first.prepared.pixel_values)
+
+    waits = BATCH_WAIT.count(queue=bucket.flow)
+    results = await asyncio.gather(
+        bucket.submit(request("bb")), bucket.submit(request("ccc"))
+    )
+    assert results == ["len=[2]", "len=[3]"]
+    assert batches == [["bb", "ccc"]]
+    # 取消的请求不计入攒批等待
+    assert BATCH_WAIT.count(queue=bucket.flow) == waits + 2
+
+
+# 同一批中 max_new_tokens 不同：按最长的生成，逐行停止并截断到各自的上限
+def test_bucket_mixed_max_new_tokens():
+    import torch
+
+    from app.models.batch_policy import FixedWindowPolicy
+    from app.service.img2txt_service import Bucket, _Request, _RowLimits
+
+    bucket = Bucket(None, torch.float32, 2, 4, FixedWindowPolicy(0))
+    calls = []
+
+    class FakeModel:
+        generation_config = SimpleNamespace(eos_token_id=0)
+
+        def generate(self, input_ids, max_new_tokens, stopping_criteria, **kwargs):
+            calls.append((max_new_tokens, stopping_criteria))
+            return torch.ones((len(input_ids), 3 + max_new_tokens), dtype=torch.long)
+
+    bucket.model = FakeModel()
+    requests = [_Request(None, "a", max_new_tokens=2), _Request(None, "b")]
+    inputs = {"input_ids": torch.zeros((2, 3), dtype=torch.long)}
+    bucket._infer_sync(inputs, requests)
+    max_new_tokens, criteria = calls[-1]
+    assert max_new_tokens == 4
+    (limits,) = criteria
+    assert isinstance(limits, _RowLimits)
+    done = limits(torch.zeros((2, 5), dtype=torch.long), None)
+    assert done.tolist() == [True, False]
+    assert bucket._limits(requests) == [2, 4]
+
+    # 上限相同时不加 stopping criteria
+    bucket._infer_sync(inputs, [_Request(None, "c"), _Request(None, "d")])
+    assert calls[-1] == (4, None)
+
+
+# 用随机初始化的小号 Qwen2.5-VL 逐 step 解码：中途加入的序列与单独 greedy generate 结果一致，
+# reset 后批 KV cache 被释放
+def test_qwen_step_engine_matches_generate():
+    import torch
+    from transformers import Qwen2_5_VLConfig, Qwen2_5_VLForConditionalGeneration
+
+    from app.service.img2txt_service import QwenStepEngine, _Request
+
+    torch.manual_seed(0)
+    text = dict(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        rope_scaling={"type": "mrope", "mrope_section": [1, 1, 2]},
+    )
+    config = Qwen2_5_VLConfig(
+        text_config=text,
+        vision_config=dict(
+            depth=1,
+            hidden_size=16,
+            intermediate_size=32,
+            num_heads=2,
+            out_hidden_size=32,
+            fullatt_block_indexes=[0],
+        ),
+        image_token_id=60,
+        video_token_id=61,
+        vision_start_token_id=62,
+        eos_token_id=63,
+        **text,
+    )
+    model = Qwen2_5_VLForConditionalGeneration(config).eval()
+    model.generation_config.eos_token_id = 63
+    processor = SimpleNamespace(decode=lambda ids, **kwargs: " ".join(map(str, ids)))
+    engine = QwenStepEngine(model, processor, torch.float32, 6)
+
+    def prefill(ids):
+        input_ids = torch.tensor([ids])
+        inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        return engine.prefill(_Request(None, "", inputs=inputs))
+
+    prompts = [[1, 2, 3, 4, 5], [7, 8]]
+    a = prefill(prompts[0])
+    engine.step([a])
+    engine.step([a])
+    b = prefill(prompts[1])
+    while live := [s for s in (a, b) if not engine.is_finished(s)]:
+        engine.step(live)
+
+    for seq, ids in zip((a, b), prompts):
+        expected = model.generate(
+            torch.tensor([ids]), max_new_tokens=6, do_sample=False
+        )
+        assert seq.token_ids == expected[0, len(ids) :].tolist()
+
+    assert engine._batch_cache is not None
+    engine.reset()
+    assert engine._batch_cache is None and engine._batch == []
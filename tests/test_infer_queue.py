@@ -115,3 +115,97 @@ async def test_exception_does_not_block_subsequent_tasks():
 
     await asyncio.sleep(0.05)
     assert q._is_running is False
+
+
+# 高优先级任务先于普通任务执行
+@pytest.mark.asyncio
+async def test_priority_classes():
+    from app.models.infer_queue import HIGH, NORMAL
+
+    q = InferQueue()
+    order = []
+    results = await asyncio.gather(
+        q.submit(lambda: order.append("n1")),
+        q.submit(lambda: order.append("n2"), priority=NORMAL),
+        q.submit(lambda: order.append("h"), priority=HIGH),
+    )
+    assert results == [None, None, None]
+    assert order == ["h", "n1", "n2"]
+
+
+# 加权公平：权重 2:1 的两个 flow 积压时按约 2:1 交替执行，不会被突发流量饿死
+@pytest.mark.asyncio
+async def test_weighted_fair_flows():
+    q = InferQueue()
+    q.set_weight("a", 2)
+    order = []
+    jobs = [q.submit(lambda: order.append("a"), flow="a") for _ in range(8)]
+    jobs += [q.submit(lambda: order.append("b"), flow="b") for _ in range(4)]
+    await asyncio.gather(*jobs)
+    assert order == ["a", "a", "b"] * 4
+
+
+# 过期任务在执行前被丢弃并记录原因；demote 模式下降级执行
+@pytest.mark.asyncio
+async def test_deadline_drop_and_demote():
+    from app.models.infer_queue import DeadlineExceeded
+
+    q = InferQueue()
+    executed = []
+    blocker = q.submit(lambda: time.sleep(0.05))
+    expired = q.submit(
+        lambda: executed.append("late"), deadline=time.monotonic() + 0.01
+    )
+    ok = q.submit(lambda: executed.append("ok"), deadline=time.monotonic() + 5)
+    results = await asyncio.gather(blocker, expired, ok, return_exceptions=True)
+    assert isinstance(results[1], DeadlineExceeded)
+    assert results[1].reason == "deadline_expired"
+    assert executed == ["ok"]
+    assert q.stats()["dropped"] == {"deadline_expired": 1}
+
+    q = InferQueue(on_expired="demote")
+    order = []
+    blocker = q.submit(lambda: time.sleep(0.05))
+    expired = q.submit(lambda: order.append("late"), deadline=time.monotonic() + 0.01)
+    normal = q.submit(lambda: order.append("normal"))
+    await asyncio.gather(blocker, expired, normal)
+    assert order == ["normal", "late"]
+    assert q.stats()["demoted"] == 1
+
+
+# 调用方取消后，排队中的任务被跳过
+@pytest.mark.asyncio
+async def test_cancelled_job_skipped():
+    q = InferQueue()
+    executed = []
+    blocker = asyncio.create_task(q.submit(lambda: time.sleep(0.05)))
+    job = asyncio.create_task(q.submit(lambda: executed.append("x")))
+    await asyncio.sleep(0.01)
+    job.cancel()
+    await blocker
+    await asyncio.sleep(0.01)
+    assert executed == []
+    assert q.stats()["dropped"] == {"cancelled": 1}
+
+
+# 请求中的优先级名称与超时转换为队列参数；超时与服务默认值取较小者
+def test_resolve_priority_and_deadline():
+    from app.models.infer_queue import (
+        BEST_EFFORT,
+        NORMAL,
+        resolve_deadline,
+        resolve_priority,
+    )
+
+    assert resolve_priority(None) == NORMAL
+    assert resolve_priority("best_effort") == BEST_EFFORT
+    with pytest.raises(ValueError):
+        resolve_priority("urgent")
+
+    assert resolve_deadline(None, 0) is None
+    now = time.monotonic()
+    assert now + 1 < resolve_deadline(None, 2) <= time.monotonic() + 2
+    assert now + 0.4 < resolve_deadline(500, 2) <= time.monotonic() + 0.5
+    assert now + 1 < resolve_deadline(5000, 2) <= time.monotonic() + 2
+    with pytest.raises(ValueError):
+        resolve_deadline(0, 2)
@@ -0,0 +1,28 @@
+from app.models.metrics import Counter, Gauge, Histogram, Registry
+
+
+# 文本格式：HELP / TYPE 行、标签转义、直方图累计桶与 +Inf
+def test_render_text_format():
+    registry = Registry()
+    requests = registry.register(Counter("t_requests_total", "Requests", ("path",)))
+    depth = registry.register(Gauge("t_depth", "Depth"))
+    latency = registry.register(
+        Histogram("t_latency_seconds", "Latency", ("flow",), buckets=(0.1, 1))
+    )
+
+    requests.inc(path='/a"b')
+    requests.inc(2, path='/a"b')
+    depth.set(3)
+    for value in (0.05, 0.5, 0.7, 5):
+        latency.observe(value, flow="x")
+
+    text = registry.render()
+    assert "# HELP t_requests_total Requests\n# TYPE t_requests_total counter" in text
+    assert 't_requests_total{path="/a\\"b"} 3' in text
+    assert "t_depth 3" in text
+    assert 't_latency_seconds_bucket{flow="x",le="0.1"} 1' in text
+    assert 't_latency_seconds_bucket{flow="x",le="1"} 3' in text
+    assert 't_latency_seconds_bucket{flow="x",le="+Inf"} 4' in text
+    assert 't_latency_seconds_sum{flow="x"} 6.25' in text
+    assert 't_latency_seconds_count{flow="x"} 4' in text
+    assert text.endswith("\n")
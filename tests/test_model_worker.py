@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+from PIL import UnidentifiedImageError
+
+from app.model_worker import ModelWorker
+from app.models.admission import AdmissionController, Overloaded
+from app.models.progress import DENOISING, DONE
+from app.service.remote import connect_remote_services
+
+
+class EchoService:
+    def __init__(self, max_queued: int = 8):
+        self.admission = AdmissionController(max_queued, 60)
+        self.cancelled = 0
+        self.sizes = []
+        self.params = []
+
+    async def cached_generate(self, prompt: str, progress=None, size=None, **params):
+        self.sizes.append(size)
+        self.params.append(params)
+        with self.admission.admit():
+            for step in range(2):
+                await asyncio.sleep(0.05)
+                if progress is not None:
+                    progress.report(DENOISING, step + 1, 2)
+                    if progress.wants_preview(step + 1, 3):
+                        progress.report_preview(step + 1, b"preview%d" % (step + 1))
+            if prompt == "slow":
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    self.cancelled += 1
+                    raise
+        if progress is not None:
+            progress.report(DONE)
+        return prompt.encode("utf-8") * 1000
+
+    async def queued_generate(self, image: bytes, prompt: str, **params):
+        if not image:
+            raise UnidentifiedImageError("empty")
+        with self.admission.admit():
+            return f"{prompt}:{len(image)}"
+
+    async def stream_generate(self, image: bytes, prompt: str, **params):
+        for text in (prompt, ":", str(len(image))):
+            yield text
+
+
+async def start_worker(tmp_path, mode: str, service):
+    path = str(tmp_path / "worker.sock")
+    server = asyncio.create_task(ModelWorker({mode: service}).serve(path))
+    remote = await connect_remote_services([mode], [path], timeout_s=5)
+    return server, remote[mode]
+
+
+# 图片经共享内存返回，进度转发到前端的 GenerationProgress
+@pytest.mark.asyncio
+async def test_remote_txt2img_result_and_progress(tmp_path):
+    from app.models.progress import GenerationProgress
+
+    service = EchoService()
+    server, remote = await start_worker(tmp_path, "txt2img", service)
+    try:
+        progress = GenerationProgress()
+        data = await remote.cached_generate("cat", progress)
+        assert data == b"cat" * 1000
+        previews = GenerationProgress(preview_every=1)
+        await remote.cached_generate("cat", previews)
+        await asyncio.sleep(0.05)
+        assert (previews.preview_step, previews.preview) == (2, b"preview2")
+        await remote.cached_generate("cat", size=(512, 512), steps=20, seed=7)
+        assert service.sizes == [None, None, (512, 512)]
+        assert service.params[-1] == {
+            "steps": 20,
+            "guidance_scale": None,
+            "seed": 7,
+            "negative_prompt": None,
+            "output_format": None,
+            "priority": None,
+            "timeout_ms": None,
+        }
+        await asyncio.sleep(0.05)
+        assert progress.step == 2 and progress.total_steps == 2
+        assert remote.admission.stats()["max_queued"] == 8
+    finally:
+        remote.shutdown()
+        server.cancel()
+
+
+# 前端取消请求时工作进程中的生成任务也被取消
+@pytest.mark.asyncio
+async def test_remote_cancel_propagates(tmp_path):
+    service = EchoService()
+    server, remote = await start_worker(tmp_path, "txt2img", service)
+    try:
+        task = asyncio.create_task(remote.cached_generate("slow"))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.1)
+        assert service.cancelled == 1
+        assert service.admission.in_flight == 0
+    finally:
+        remote.shutdown()
+        server.cancel()
+
+
+# 上传图片经共享内存交给工作进程，流式输出逐段转发；异常类型在前端还原
+@pytest.mark.asyncio
+async def test_remote_img2txt(tmp_path):
+    server, remote = await start_worker(tmp_path, "img2txt", EchoService(max_queued=0))
+    try:
+        assert [t async for t in remote.stream_generate(b"x" * 10, "hi")] == [
+            "hi",
+            ":",
+            "10",
+        ]
+        with pytest.raises(Overloaded):
+            await remote.queued_generate(b"x" * 10, "hi")
+        with pytest.raises(UnidentifiedImageError):
+            await remote.queued_generate(b"", "hi")
+        # 工作进程已饱和时前端预检查直接拒绝
+        with pytest.raises(Overloaded):
+            remote.admission.check()
+    finally:
+        remote.shutdown()
+        server.cancel()
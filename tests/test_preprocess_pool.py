@@ -0,0 +1,53 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.models.preprocess_pool import (
+    PreprocessPool,
+    read_array,
+    release_array,
+    share_array,
+)
+from app.service.img2txt_preprocess import decode_image
+
+
+def png_bytes(size=(40, 30)) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGBA", size, (1, 2, 3, 4)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+# 数组经共享内存往返后内容不变，unlink 后不能再读取
+def test_share_array_roundtrip():
+    array = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+    handle = share_array(array)
+    assert np.array_equal(read_array(handle), array)
+    assert np.array_equal(read_array(handle, unlink=True), array)
+    with pytest.raises(FileNotFoundError):
+        read_array(handle)
+    # 重复释放不报错
+    release_array(handle)
+
+
+# 单线程模式与进程池模式都能解码图片，并统计完成数与耗时
+@pytest.mark.asyncio
+@pytest.mark.parametrize("workers", [0, 1])
+async def test_pool_decodes_image(workers):
+    pool = PreprocessPool(workers)
+    try:
+        decoded = await pool.run(decode_image, png_bytes(), True, True)
+        assert (decoded.width, decoded.height) == (40, 30)
+        assert decoded.content_hash is not None and decoded.phash is not None
+        pixels = read_array(decoded.pixels, unlink=True)
+        assert pixels.shape == (30, 40, 3) and pixels[0, 0].tolist() == [1, 2, 3]
+
+        with pytest.raises(Exception):
+            await pool.run(decode_image, b"broken", False, False)
+        stats = pool.stats()
+        assert stats["workers"] == workers
+        assert stats["completed"] == 1 and stats["failed"] == 1
+        assert stats["pending"] == 0 and stats["run_p50_ms"] > 0
+    finally:
+        pool.shutdown()
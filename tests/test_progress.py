@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+import pytest
+
+from app.models.progress import (
+    DECODING,
+    DENOISING,
+    DONE,
+    QUEUED,
+    GenerationProgress,
+)
+
+
+# 推理线程上报的步数与阶段在事件循环侧可见，并记录各阶段耗时
+@pytest.mark.asyncio
+async def test_report_from_thread():
+    progress = GenerationProgress()
+    assert progress.phase == QUEUED
+    assert progress.percent == 0
+
+    def run():
+        for step in range(1, 5):
+            progress.report(DENOISING, step, 10)
+
+    await asyncio.to_thread(run)
+    await progress.wait_changed(timeout=1)
+    assert progress.phase == DENOISING
+    assert progress.step == 4
+    assert progress.percent == 40
+    assert progress.eta_s() is not None
+    assert "queued" in progress.durations
+
+
+# 未完成时进度不超过 99，完成后为 100
+@pytest.mark.asyncio
+async def test_percent_capped_until_done():
+    progress = GenerationProgress()
+    progress.report(DECODING, 10, 10)
+    await asyncio.sleep(0)
+    assert progress.percent == 99
+    assert progress.eta_s() is None
+
+    progress.report(DONE)
+    await asyncio.sleep(0)
+    snapshot = progress.snapshot()
+    assert snapshot["progress"] == 100
+    assert set(snapshot["durations_ms"]) == {QUEUED, DECODING}
+
+
+# 没有变化时 wait_changed 在超时后返回
+@pytest.mark.asyncio
+async def test_wait_changed_timeout():
+    progress = GenerationProgress()
+    start = time.monotonic()
+    await progress.wait_changed(timeout=0.05)
+    assert time.monotonic() - start >= 0.05
+    assert progress.phase == QUEUED
+
+
+# 按间隔请求预览，最后一步不预览；推理线程提交的预览在事件循环侧可见
+@pytest.mark.asyncio
+async def test_preview_from_thread():
+    assert not GenerationProgress().wants_preview(2, 10)
+    progress = GenerationProgress(preview_every=2)
+    assert [s for s in range(1, 11) if progress.wants_preview(s, 10)] == [2, 4, 6, 8]
+
+    await asyncio.to_thread(progress.report_preview, 4, b"webp")
+    await progress.wait_changed(timeout=1)
+    assert (progress.preview_step, progress.preview) == (4, b"webp")
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from app.models.residency import DEVICE, HOST, UNLOADED, ResidencyManager
+
+
+def make_manager(budget: int = 100, idle_timeout_s: float = 0, action="offload"):
+    manager = ResidencyManager(budget, idle_timeout_s, action)
+    calls = []
+    for name, size in (("a", 60), ("b", 60), ("c", 30)):
+        manager.register(
+            name,
+            load=lambda name=name: calls.append(("load", name)),
+            offload=lambda name=name: calls.append(("offload", name)),
+            restore=lambda name=name: calls.append(("restore", name)),
+            unload=lambda name=name: calls.append(("unload", name)),
+            size=lambda size=size: size,
+            estimate_bytes=size,
+        )
+    return manager, calls
+
+
+# 首次使用时加载；超出显存预算时换出最久未使用的模型，再次使用时从主机内存拷回
+@pytest.mark.asyncio
+async def test_lazy_load_and_lru_offload():
+    manager, calls = make_manager()
+    assert manager.state("a") == UNLOADED
+
+    async with manager.use("a"):
+        pass
+    async with manager.use("c"):
+        pass
+    assert calls == [("load", "a"), ("load", "c")]
+
+    async with manager.use("b"):
+        assert manager.state("a") == HOST
+        assert manager.state("c") == DEVICE
+    async with manager.use("a"):
+        pass
+    # c 比 b 更久未使用，先换出 c，仍不够再换出 b
+    assert calls[2:] == [
+        ("offload", "a"),
+        ("load", "b"),
+        ("offload", "c"),
+        ("offload", "b"),
+        ("restore", "a"),
+    ]
+    assert manager.stats()["models"]["a"]["state"] == DEVICE
+
+
+# 正在使用的模型不会被换出，另一个模型等它的请求结束后再加载
+@pytest.mark.asyncio
+async def test_in_use_model_not_evicted():
+    manager, calls = make_manager()
+    order = []
+
+    async def hold_a():
+        async with manager.use("a"):
+            order.append("a start")
+            await asyncio.sleep(0.1)
+            order.append("a end")
+
+    async def use_b():
+        await asyncio.sleep(0.02)
+        async with manager.use("b"):
+            order.append("b")
+
+    await asyncio.gather(hold_a(), use_b())
+    assert order == ["a start", "a end", "b"]
+    assert calls == [("load", "a"), ("offload", "a"), ("load", "b")]
+
+
+# 空闲超时后按 idle_action 卸载
+@pytest.mark.asyncio
+async def test_idle_unload():
+    manager, calls = make_manager(budget=0, idle_timeout_s=0.05, action="unload")
+    async with manager.use("a"):
+        pass
+    async with manager.use("b"):
+        pass
+    await manager.evict_idle()
+    assert manager.state("a") == DEVICE
+    await asyncio.sleep(0.06)
+    await manager.evict_idle()
+    assert manager.state("a") == UNLOADED and manager.state("b") == UNLOADED
+    assert manager.switches == 4
+
+
+# 预留的显存（常驻设备的缓存）从预算中扣除：a 与 c 原本能同时驻留
+@pytest.mark.asyncio
+async def test_reserved_bytes_reduce_budget():
+    manager, calls = make_manager()
+    manager.reserve("cache", 40)
+    async with manager.use("a"):
+        pass
+    async with manager.use("c"):
+        pass
+    assert calls == [("load", "a"), ("offload", "a"), ("load", "c")]
+    assert manager._device_bytes() == 70
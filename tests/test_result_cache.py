@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+from app.models.result_cache import DiskCache, LRUCache, TieredCache
+
+
+# 超过字节上限时淘汰最久未访问的条目
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"
+    cache.put("c", b"cccc")
+
+    assert "b" not in cache
+    assert cache.get("a") == b"aaaa"
+    assert cache.get("c") == b"cccc"
+    assert cache.total_bytes == 8
+
+
+# 单个条目大于容量时不缓存，覆盖写入时更新占用
+def test_lru_oversized_and_overwrite():
+    cache = LRUCache(max_bytes=4)
+    cache.put("big", b"12345")
+    assert "big" not in cache
+    cache.put("k", b"12")
+    cache.put("k", b"123")
+    assert cache.total_bytes == 3
+    assert len(cache) == 1
+
+
+# 磁盘层重启后仍可命中，并按总大小淘汰
+def test_disk_cache_survives_restart(tmp_path):
+    disk = DiskCache(str(tmp_path), max_bytes=10, suffix=".png")
+    disk.put("a", b"aaaa")
+    disk.put("b", b"bbbb")
+    assert disk.get("a") == b"aaaa"
+
+    reopened = DiskCache(str(tmp_path), max_bytes=10, suffix=".png")
+    assert reopened.get("b") == b"bbbb"
+    reopened.put("c", b"cccc")
+    assert len(reopened) == 2
+    assert reopened.total_bytes == 8
+    assert len(os.listdir(tmp_path)) == 2
+
+
+# 启动时目录已超过上限会立即淘汰到上限以内
+def test_disk_cache_evicts_on_startup(tmp_path):
+    disk = DiskCache(str(tmp_path), max_bytes=100)
+    for key in ("a", "b", "c"):
+        disk.put(key, b"x" * 40)
+
+    shrunk = DiskCache(str(tmp_path), max_bytes=50)
+    assert len(shrunk) == 1
+    assert shrunk.total_bytes == 40
+
+
+# 中断写入留下的 .tmp 临时文件在启动时被清理，不计入缓存
+def test_disk_cache_removes_stale_tmp_files(tmp_path):
+    disk = DiskCache(str(tmp_path), max_bytes=100, suffix=".img")
+    disk.put("a", b"aaaa")
+    (tmp_path / "tmpabc123.tmp").write_bytes(b"partial")
+
+    reopened = DiskCache(str(tmp_path), max_bytes=100, suffix=".img")
+    assert os.listdir(tmp_path) == ["a.img"]
+    assert len(reopened) == 1
+    assert reopened.total_bytes == 4
+
+
+# 两级缓存：磁盘命中后提升到内存，统计命中/未命中次数
+@pytest.mark.asyncio
+async def test_tiered_cache_stats(tmp_path):
+    disk = DiskCache(str(tmp_path), max_bytes=1 << 20)
+    disk.put("k", b"value")
+    cache = TieredCache(LRUCache(1 << 20), disk)
+
+    assert await cache.get("missing") is None
+    assert await cache.get("k") == b"value"
+    assert await cache.get("k") == b"value"
+    await cache.put("n", b"new")
+    assert await cache.get("n") == b"new"
+
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["disk_hits"] == 1
+    assert stats["memory_hits"] == 2
+    assert stats["hit_rate"] == 0.75
+    assert disk.get("n") == b"new"
+
+
+# 过期条目在访问时移除并释放占用
+def test_lru_ttl_expiry(monkeypatch):
+    import app.models.result_cache as result_cache
+
+    now = [100.0]
+    monkeypatch.setattr(result_cache.time, "monotonic", lambda: now[0])
+    cache = LRUCache(max_bytes=100, ttl_s=10)
+    cache.put("k", b"value")
+    now[0] += 5
+    assert cache.get("k") == b"value"
+    now[0] += 6
+    assert cache.get("k") is None
+    assert cache.total_bytes == 0
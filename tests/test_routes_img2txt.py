@@ -71,3 +71,87 @@ def test_img2txt_multiple_sequential_requests(client_img2txt, sample_png_bytes,
     resp = client_img2txt.post("/img2txt/generate", data=data, files=files)
     assert resp.status_code == 200
     assert resp.json()["text"].startswith(f"TEXT({prompt})")
+
+
+# SSE 流式输出：多个 data 事件拼接为完整文本，最后是 done 事件
+def test_img2txt_stream_success(client_img2txt, sample_png_bytes):
+    import json
+
+    files = {"image": ("s.png", sample_png_bytes, "image/png")}
+    data = {"prompt": "stream me"}
+    with client_img2txt.stream(
+        "POST", "/img2txt/stream", data=data, files=files
+    ) as resp:
+        assert resp.status_code == 200
+        assert resp.headers["content-type"].startswith("text/event-stream")
+        body = "".join(resp.iter_text())
+
+    events = [e for e in body.split("\n\n") if e]
+    texts = [json.loads(e[len("data: ") :])["text"] for e in events[:-1]]
+    assert len(texts) > 1
+    assert "".join(texts) == "TEXT(stream me)"
+    assert events[-1].startswith("event: done")
+
+
+# SSE 生成失败 -> error 事件
+def test_img2txt_stream_internal_error(app_img2txt, sample_png_bytes):
+    from fastapi.testclient import TestClient
+    from tests.conftest import FakeImg2TxtServiceError
+
+    app_img2txt.state.services["img2txt"] = FakeImg2TxtServiceError()
+    client = TestClient(app_img2txt)
+    files = {"image": ("s.png", sample_png_bytes, "image/png")}
+    resp = client.post("/img2txt/stream", data={"prompt": "boom"}, files=files)
+    assert resp.status_code == 200
+    assert "event: error" in resp.text
+    assert "Generation failed" in resp.text
+
+
+# SSE 空白 prompt -> 400
+def test_img2txt_stream_empty_prompt(client_img2txt, sample_png_bytes):
+    files = {"image": ("s.png", sample_png_bytes, "image/png")}
+    resp = client_img2txt.post("/img2txt/stream", data={"prompt": " "}, files=files)
+    assert resp.status_code == 400
+
+
+# 服务过载 -> 429 + Retry-After，不进入解码与生成
+def test_img2txt_generate_overloaded(client_img2txt, sample_png_bytes):
+    service = client_img2txt.app.state.services["img2txt"]
+    service.admission.max_queued = 0
+    files = {"image": ("o.png", sample_png_bytes, "image/png")}
+    for path in ("/img2txt/generate", "/img2txt/stream"):
+        resp = client_img2txt.post(path, data={"prompt": "hi"}, files=files)
+        assert resp.status_code == 429
+        assert int(resp.headers["Retry-After"]) >= 1
+    assert service.admission.rejected == 2
+
+
+# max_new_tokens 超出范围 -> 400
+def test_img2txt_max_new_tokens_validation(client_img2txt, sample_png_bytes):
+    files = {"image": ("a.png", sample_png_bytes, "image/png")}
+    for value, status in (("16", 200), ("0", 400), ("5000", 400)):
+        resp = client_img2txt.post(
+            "/img2txt/generate",
+            data={"prompt": "hello", "max_new_tokens": value},
+            files=files,
+        )
+        assert resp.status_code == status
+
+
+# 图片展开后 token 数超过上限 -> 413
+def test_img2txt_generate_too_large(app_img2txt, sample_png_bytes):
+    from fastapi.testclient import TestClient
+
+    from app.models.bucket_planner import InputTooLarge
+    from tests.conftest import FakeImg2TxtService
+
+    class TooLargeService(FakeImg2TxtService):
+        async def queued_generate(self, image, prompt, **params):
+            raise InputTooLarge(30000, 24576)
+
+    app_img2txt.state.services["img2txt"] = TooLargeService()
+    client = TestClient(app_img2txt)
+    files = {"image": ("big.png", sample_png_bytes, "image/png")}
+    resp = client.post("/img2txt/generate", data={"prompt": "hi"}, files=files)
+    assert resp.status_code == 413
+    assert "30000 tokens > 24576" in resp.json()["detail"]
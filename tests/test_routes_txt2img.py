@@ -49,3 +49,111 @@ def test_txt2img_multiple_sequential_requests(client_txt2img, prompt):
     resp = client_txt2img.post("/txt2img/generate", json={"prompt": prompt})
     assert resp.status_code == 200
     assert resp.headers["content-type"] == "image/png"
+
+
+# 指定支持的分辨率 -> 200；不支持 -> 400；格式错误 -> 422
+def test_txt2img_size(client_txt2img):
+    resp = client_txt2img.post(
+        "/txt2img/generate", json={"prompt": "a cat", "size": "512x512"}
+    )
+    assert resp.status_code == 200
+
+    resp = client_txt2img.post(
+        "/txt2img/generate", json={"prompt": "a cat", "size": "640x480"}
+    )
+    assert resp.status_code == 400
+    assert "1024x1024" in resp.json()["detail"]
+
+    resp = client_txt2img.post(
+        "/txt2img/generate", json={"prompt": "a cat", "size": "large"}
+    )
+    assert resp.status_code == 422
+
+
+# 生成参数原样传给服务；超出范围 -> 400
+def test_txt2img_generation_params(app_txt2img):
+    from fastapi.testclient import TestClient
+    from tests.conftest import FakeTxt2ImgService
+
+    service = FakeTxt2ImgService()
+    app_txt2img.state.services["txt2img"] = service
+    client = TestClient(app_txt2img)
+    body = {
+        "prompt": "a cat",
+        "steps": 20,
+        "guidance_scale": 7.5,
+        "seed": 42,
+        "negative_prompt": "blurry",
+        "priority": "high",
+        "timeout_ms": 30000,
+    }
+    resp = client.post("/txt2img/generate", json=body)
+    assert resp.status_code == 200
+    assert service.params == {
+        "size": None,
+        "steps": 20,
+        "guidance_scale": 7.5,
+        "seed": 42,
+        "negative_prompt": "blurry",
+        "output_format": "png",
+        "priority": "high",
+        "timeout_ms": 30000,
+    }
+
+    for field, value in (("priority", "urgent"), ("timeout_ms", 0)):
+        resp = client.post("/txt2img/generate", json={"prompt": "a cat", field: value})
+        assert resp.status_code == 422
+
+    resp = client.post("/txt2img/generate", json={"prompt": "a cat", "steps": 500})
+    assert resp.status_code == 400
+    assert "steps" in resp.json()["detail"]
+
+
+# 输出格式：请求字段优先，其次按 Accept 协商，都没有时为默认 PNG；未启用的格式 -> 400
+def test_txt2img_output_format(client_txt2img):
+    resp = client_txt2img.post(
+        "/txt2img/generate", json={"prompt": "a cat", "format": "webp"}
+    )
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "image/webp"
+    assert resp.content[8:12] == b"WEBP"
+
+    resp = client_txt2img.post(
+        "/txt2img/generate",
+        json={"prompt": "a cat"},
+        headers={"Accept": "image/avif,image/webp;q=0.8,image/jpeg;q=0.9,*/*"},
+    )
+    assert resp.headers["content-type"] == "image/jpeg"
+    assert resp.content.startswith(b"\xff\xd8")
+    assert resp.headers["vary"] == "Accept"
+
+    resp = client_txt2img.post(
+        "/txt2img/generate", json={"prompt": "a cat"}, headers={"Accept": "*/*"}
+    )
+    assert resp.headers["content-type"] == "image/png"
+
+    resp = client_txt2img.post(
+        "/txt2img/generate", json={"prompt": "a cat", "format": "avif"}
+    )
+    assert resp.status_code == 400
+    assert "webp" in resp.json()["detail"]
+
+
+# 路由直接调用服务的校验方法，同一输入与服务给出相同的错误
+def test_txt2img_route_uses_service_checks(client_txt2img):
+    service = client_txt2img.app.state.services["txt2img"]
+    cases = (
+        ("size", "640x480", lambda: service.check_size((640, 480))),
+        ("steps", 500, lambda: service.check_steps(500)),
+        ("guidance_scale", 31, lambda: service.check_guidance_scale(31)),
+        ("seed", -1, lambda: service.check_seed(-1)),
+        ("format", "avif", lambda: service.check_format("avif")),
+    )
+    for field, value, check in cases:
+        with pytest.raises(ValueError) as e:
+            check()
+        resp = client_txt2img.post(
+            "/txt2img/generate", json={"prompt": "a cat", field: value}
+        )
+        assert resp.status_code == 400
+        assert resp.json()["detail"] == str(e.value)
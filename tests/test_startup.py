@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+from fastapi.testclient import TestClient
+
+import app.main as main
+from app.models.startup import StartupTracker
+
+
+# 记录各阶段耗时；失败时记录错误
+def test_startup_tracker_phases():
+    startup = StartupTracker()
+    with startup.phase("load:x"):
+        assert startup.stats()["phase"] == "load:x"
+    startup.mark_ready()
+    stats = startup.stats()
+    assert stats["ready"] and "load:x" in stats["phases_ms"]
+    startup.fail(RuntimeError("boom"))
+    assert startup.stats()["error"] == "RuntimeError: boom"
+
+
+# 应用启动后立即响应，模型在后台加载；加载完成前 /readyz 返回 503
+def test_readyz_waits_for_background_load(monkeypatch):
+    loaded = asyncio.Event()
+
+    async def slow_build(mode, startup, warmup):
+        with startup.phase("load:fake"):
+            await loaded.wait()
+        return {}
+
+    monkeypatch.setattr("app.service.builder.build_services", slow_build)
+    monkeypatch.setattr(main, "startup", StartupTracker())
+    monkeypatch.setattr(main.settings, "model_worker_sockets", [])
+
+    with TestClient(main.app) as client:
+        assert client.get("/healthz").status_code == 200
+        response = client.get("/readyz")
+        assert response.status_code == 503
+        assert response.json()["phase"] == "load:fake"
+        assert client.get("/").json()["status"] == "starting"
+
+        client.portal.call(loaded.set)
+        for _ in range(50):
+            if client.get("/readyz").status_code == 200:
+                break
+            time.sleep(0.02)
+        response = client.get("/readyz")
+        assert response.status_code == 200
+        assert "load:fake" in response.json()["phases_ms"]
+
+
+# 后台加载失败时存活探针返回 500
+def test_healthz_reports_failed_load(monkeypatch):
+    async def failing_build(mode, startup, warmup):
+        raise RuntimeError("no weights")
+
+    monkeypatch.setattr("app.service.builder.build_services", failing_build)
+    monkeypatch.setattr(main, "startup", StartupTracker())
+    monkeypatch.setattr(main.settings, "model_worker_sockets", [])
+
+    with TestClient(main.app) as client:
+        for _ in range(50):
+            if client.get("/healthz").status_code == 500:
+                break
+            time.sleep(0.02)
+        response = client.get("/healthz")
+        assert response.status_code == 500
+        assert "no weights" in response.json()["error"]
+        assert client.get("/readyz").status_code == 503
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.models.token_stream import IncrementalDecoder, TokenStream
+
+
+# 从其它线程写入的文本按顺序被异步读取
+@pytest.mark.asyncio
+async def test_stream_from_thread():
+    stream = TokenStream()
+
+    def produce():
+        for text in ["a", "", "b", "c"]:
+            stream.put(text)
+        stream.close()
+
+    threading.Thread(target=produce).start()
+    assert [text async for text in stream] == ["a", "b", "c"]
+
+
+# close 传入异常时迭代抛出该异常，重复 close 无效
+@pytest.mark.asyncio
+async def test_stream_error():
+    stream = TokenStream()
+    stream.put("x")
+    stream.close(RuntimeError("boom"))
+    stream.close()
+
+    received = []
+    with pytest.raises(RuntimeError, match="boom"):
+        async for text in stream:
+            received.append(text)
+    assert received == ["x"]
+
+
+# 不完整的多字节字符暂缓输出，拼接结果与整体解码一致
+def test_incremental_decoder_holds_partial_chars():
+    data = "你好, ok".encode("utf-8")
+    decoder = IncrementalDecoder(
+        lambda ids: bytes(ids).decode("utf-8", errors="replace")
+    )
+
+    deltas = [decoder.push(b) for b in data]
+    assert deltas[:3] == ["", "", "你"]
+    assert "".join(deltas) + decoder.flush() == "你好, ok"
+
+
+# 没有任何输出直接关闭
+@pytest.mark.asyncio
+async def test_stream_close_without_items():
+    stream = TokenStream()
+    stream.close()
+    await asyncio.sleep(0)
+    assert [text async for text in stream] == []
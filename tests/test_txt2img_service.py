@@ -0,0 +1,549 @@
+from types import SimpleNamespace
+
+import asyncio
+import time
+
+import pytest
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from app.models.result_cache import LRUCache, TieredCache
+from app.service.txt2img_service import Txt2ImgService
+
+
+def make_service(
+    batch_size: int = 1,
+    cache: TieredCache | None = None,
+    max_wait_ms: int = 50,
+    batch_policy: str = "fixed",
+):
+    # 不加载模型，用假的 _infer_sync 代替 pipeline 调用
+    service = Txt2ImgService(
+        "fake-model", batch_size, 4, max_wait_ms, cache, batch_policy
+    )
+    calls = []
+
+    def fake_infer(batch_prompts, *args):
+        calls.append(list(batch_prompts))
+        return SimpleNamespace(
+            images=[Image.new("RGB", (2, 2), (len(p), 0, 0)) for p in batch_prompts]
+        )
+
+    service._infer_sync = fake_infer
+    return service, calls
+
+
+# 命中缓存时直接返回编码结果，不再进入推理队列
+@pytest.mark.asyncio
+async def test_cached_generate_hit_skips_inference():
+    cache = TieredCache(LRUCache(1 << 20))
+    service, calls = make_service(cache=cache)
+
+    first = await service.cached_generate("a cat", seed=1)
+    second = await service.cached_generate("a cat", seed=1)
+    assert first == second
+    assert first.startswith(b"\x89PNG")
+    assert calls == [["a cat"]]
+    assert cache.stats()["memory_hits"] == 1
+
+    await service.cached_generate("a dog", seed=1)
+    assert calls == [["a cat"], ["a dog"]]
+
+
+# 未指定 seed 的请求默认也命中缓存；关闭 cache_unseeded 后每次重新生成，不读写缓存
+@pytest.mark.asyncio
+async def test_cached_generate_unseeded():
+    cache = TieredCache(LRUCache(1 << 20))
+    service, calls = make_service(cache=cache)
+    await service.cached_generate("a cat")
+    await service.cached_generate("a cat")
+    assert calls == [["a cat"]]
+
+    cache = TieredCache(LRUCache(1 << 20))
+    service, calls = make_service(cache=cache)
+    service.cache_unseeded = False
+    await service.cached_generate("a cat")
+    await service.cached_generate("a cat")
+    assert calls == [["a cat"], ["a cat"]]
+    assert len(cache.memory) == 0
+
+
+# 缓存 key 覆盖模型、prompt、步数、尺寸与 seed
+@pytest.mark.asyncio
+async def test_cache_key_fields():
+    service, _ = make_service()
+    key = service._cache_key("p")
+    assert key == service._cache_key("p")
+    assert key != service._cache_key("q")
+    assert key != service._cache_key("p", width=512, height=512)
+    assert key != service._cache_key("p", seed=1)
+    service.num_inference_steps = 20
+    assert key != service._cache_key("p")
+
+
+# 到达率策略：低峰时单个请求不等满窗口，高峰时仍然攒成整批
+@pytest.mark.asyncio
+async def test_arrival_rate_policy_flushes_early_off_peak():
+    service, calls = make_service(
+        batch_size=4, max_wait_ms=2000, batch_policy="arrival_rate"
+    )
+    start = time.monotonic()
+    await service.queued_generate("a")
+    assert time.monotonic() - start < 0.5
+
+    await asyncio.gather(*(service.queued_generate(p) for p in "bcde"))
+    assert calls == [["a"], ["b", "c", "d", "e"]]
+
+
+# 未 flush 的请求取消后移出批次，其余请求照常生成
+@pytest.mark.asyncio
+async def test_cancel_removes_pending_request():
+    service, calls = make_service(batch_size=3, max_wait_ms=200)
+    a = asyncio.create_task(service.queued_generate("a"))
+    b = asyncio.create_task(service.queued_generate("b"))
+    await asyncio.sleep(0.05)
+    a.cancel()
+    await asyncio.sleep(0)
+    assert [r.prompt for r in service.batch_requests] == ["b"]
+
+    # 空出的名额由下一个请求补上，凑满后立即 flush
+    c = asyncio.create_task(service.queued_generate("c"))
+    d = asyncio.create_task(service.queued_generate("d"))
+    await asyncio.gather(b, c, d)
+    assert calls == [["b", "c", "d"]]
+    assert a.cancelled()
+
+
+# 已 flush 但还在推理队列中排队的批，全部取消后不再执行
+@pytest.mark.asyncio
+async def test_cancelled_batch_skipped_by_queue():
+    service, calls = make_service(batch_size=1)
+    blocker = asyncio.create_task(service.queue.submit(lambda: time.sleep(0.2)))
+    await asyncio.sleep(0)
+    task = asyncio.create_task(service.queued_generate("a"))
+    await asyncio.sleep(0.05)
+    task.cancel()
+    await blocker
+    await asyncio.sleep(0.05)
+    assert calls == []
+    assert service.queue.stats()["dropped"] == {"cancelled": 1}
+
+
+# 攒批与生成指标：flush 原因、填充率、生成图片数
+@pytest.mark.asyncio
+async def test_batch_metrics():
+    from app.models.metrics import (
+        BATCH_FILL_RATIO,
+        BATCH_FLUSHES,
+        BATCH_WAIT,
+        GENERATED_IMAGES,
+    )
+
+    full = BATCH_FLUSHES.get(queue="txt2img", reason="full")
+    timer = BATCH_FLUSHES.get(queue="txt2img", reason="timer")
+    images = GENERATED_IMAGES.get()
+    fills = BATCH_FILL_RATIO.count(queue="txt2img")
+    waits = BATCH_WAIT.count(queue="txt2img")
+    waited = BATCH_WAIT.sum(queue="txt2img")
+
+    service, _ = make_service(batch_size=2)
+    await asyncio.gather(service.queued_generate("a"), service.queued_generate("b"))
+    await service.queued_generate("c")
+
+    assert BATCH_FLUSHES.get(queue="txt2img", reason="full") == full + 1
+    assert BATCH_FLUSHES.get(queue="txt2img", reason="timer") == timer + 1
+    assert GENERATED_IMAGES.get() == images + 3
+    assert BATCH_FILL_RATIO.count(queue="txt2img") == fills + 2
+    # 每个请求记录一次攒批等待；c 等满了 50ms 的窗口才 flush
+    assert BATCH_WAIT.count(queue="txt2img") == waits + 3
+    assert BATCH_WAIT.sum(queue="txt2img") - waited >= 0.05
+
+
+# 共用设备时 pipeline 在首次请求时才加载
+@pytest.mark.asyncio
+async def test_lazy_load_with_residency():
+    from app.models.residency import DEVICE, UNLOADED, ResidencyManager
+
+    service, calls = make_service()
+    service.residency = ResidencyManager()
+    loads = []
+    service._load_pipe = lambda: loads.append("load")
+    service._pipe_bytes = lambda: 1
+    await service._initialize()
+    assert loads == [] and service.residency.state("txt2img") == UNLOADED
+
+    await service.cached_generate("a cat")
+    await service.cached_generate("a dog")
+    assert loads == ["load"]
+    assert service.residency.state("txt2img") == DEVICE
+    assert calls == [["a cat"], ["a dog"]]
+
+
+# prompt embedding 缓存的设备层按容量上限计入驻留管理器的显存占用
+@pytest.mark.asyncio
+async def test_prompt_cache_reserved_with_residency():
+    from app.models.residency import ResidencyManager
+
+    service, _ = make_service()
+    service.residency = ResidencyManager()
+    service.prompt_cache = make_prompt_cache(4 << 20)
+    await service._initialize()
+    assert service.residency.stats()["reserved_mb"] == {"txt2img_prompt_cache": 4}
+    assert service.residency.stats()["device_mb"] == 4
+
+
+# 预热按每个批大小以较少的步数各跑一次，并记录到 compile_report
+@pytest.mark.asyncio
+async def test_warmup_runs_each_batch_size():
+    service = Txt2ImgService("fake-model", 3, 4, 50, warmup_steps=1)
+    steps = []
+
+    def fake_pipe(prompts, num_inference_steps, width, height, **kwargs):
+        steps.append((len(prompts), num_inference_steps, width, height))
+        return SimpleNamespace(images=[Image.new("RGB", (2, 2))] * len(prompts))
+
+    service.pipe = fake_pipe
+    service.device_str = "cpu"
+    await service.warmup()
+    assert steps == [(1, 1, 1024, 1024), (2, 1, 1024, 1024), (3, 1, 1024, 1024)]
+    shapes = [s["shape"] for s in service.compile_report.summary()["shapes"]]
+    assert shapes == ["1x1024x1024", "2x1024x1024", "3x1024x1024"]
+
+
+# 不同分辨率各自攒批，按各自的尺寸推理，cost 按像素数折算
+@pytest.mark.asyncio
+async def test_batches_per_shape():
+    service = Txt2ImgService("fake-model", 2, 4, 100, sizes=[(1024, 1024), (512, 512)])
+    batches = []
+
+    def fake_infer(batch_prompts, batch_progress, width, height, *args):
+        batches.append((list(batch_prompts), width, height))
+        return SimpleNamespace(images=[Image.new("RGB", (2, 2))] * len(batch_prompts))
+
+    service._infer_sync = fake_infer
+    costs = []
+    submit = service.queue.submit
+
+    async def recording_submit(infer_sync, **kwargs):
+        costs.append(kwargs["cost"])
+        return await submit(infer_sync, **kwargs)
+
+    service.queue.submit = recording_submit
+    await asyncio.gather(
+        service.queued_generate("a", size=(512, 512)),
+        service.queued_generate("b"),
+        service.queued_generate("c", size=(512, 512)),
+    )
+    assert batches == [(["a", "c"], 512, 512), (["b"], 1024, 1024)]
+    assert costs == [0.5, 1.0]
+
+    with pytest.raises(ValueError):
+        await service.queued_generate("d", size=(640, 480))
+    assert service.batch_requests == []
+
+
+# 步数或 guidance 不同的请求分开成批；seed 与 negative prompt 按行混在同一批中
+@pytest.mark.asyncio
+async def test_groups_by_steps_and_guidance():
+    service = Txt2ImgService("fake-model", 3, 50, 100)
+    batches = []
+
+    def fake_infer(batch_prompts, batch_progress, *args):
+        batches.append((list(batch_prompts), *args))
+        return SimpleNamespace(images=[Image.new("RGB", (2, 2))] * len(batch_prompts))
+
+    service._infer_sync = fake_infer
+    await asyncio.gather(
+        service.queued_generate("a", steps=20, seed=1),
+        service.queued_generate("b", steps=20, negative_prompt="blurry"),
+        service.queued_generate("c"),
+        service.queued_generate("d", guidance_scale=7.5),
+    )
+    assert sorted(batches) == [
+        (["a", "b"], 1024, 1024, 20, 5.0, [1, None], [None, "blurry"]),
+        (["c"], 1024, 1024, 50, 5.0, [None], [None]),
+        (["d"], 1024, 1024, 50, 7.5, [None], [None]),
+    ]
+    assert service.batch_requests == [] and service._batches == {}
+
+    with pytest.raises(ValueError):
+        await service.queued_generate("e", steps=101)
+
+
+# 逐行的 seed 转为 CPU generator，negative prompt 缺省行用空串
+@pytest.mark.asyncio
+async def test_infer_passes_per_row_params():
+    service = Txt2ImgService("fake-model", 2, 50, 100)
+    service.device_str = "cpu"
+    calls = []
+
+    def fake_pipe(prompts, **kwargs):
+        calls.append(kwargs)
+        return SimpleNamespace(images=[Image.new("RGB", (2, 2))] * len(prompts))
+
+    service.pipe = fake_pipe
+    service._infer_sync(
+        ["a", "b"], [None, None], 512, 512, 20, 6.0, [3, None], [None, "x"]
+    )
+    kwargs = calls[-1]
+    assert kwargs["num_inference_steps"] == 20 and kwargs["guidance_scale"] == 6.0
+    assert kwargs["negative_prompt"] == ["", "x"]
+    assert kwargs["generator"][0].initial_seed() == 3
+    assert len(kwargs["generator"]) == 2
+
+    service._infer_sync(["a"], [None], 512, 512)
+    assert calls[-1]["generator"] is None and calls[-1]["negative_prompt"] is None
+    assert calls[-1]["guidance_scale"] == 5.0
+
+    # 0.0 是合法取值（关闭 CFG），不能被当作未指定
+    service._infer_sync(["a"], [None], 512, 512, 20, 0.0)
+    assert calls[-1]["guidance_scale"] == 0.0
+    await service.queued_generate("a", guidance_scale=0.0)
+    assert calls[-1]["guidance_scale"] == 0.0
+
+
+class TinyHunyuanPipe:
+    # 随机初始化的小 HunyuanDiT transformer + 真实调度器；文本编码按 prompt 生成固定的
+    # 伪 embedding，VAE 解码取 latent 前三个通道放大 8 倍
+    def __init__(self):
+        from diffusers import DDPMScheduler, HunyuanDiT2DModel
+        from diffusers.image_processor import VaeImageProcessor
+        from diffusers.pipelines.hunyuandit.pipeline_hunyuandit import (
+            HunyuanDiTPipeline,
+        )
+
+        torch.manual_seed(0)
+        self.transformer = HunyuanDiT2DModel(
+            num_attention_heads=2,
+            attention_head_dim=8,
+            in_channels=4,
+            patch_size=2,
+            hidden_size=16,
+            num_layers=2,
+            cross_attention_dim=16,
+            cross_attention_dim_t5=16,
+            pooled_projection_dim=16,
+            sample_size=8,
+        ).eval()
+        self.scheduler = DDPMScheduler()
+        self.vae = SimpleNamespace(
+            config=SimpleNamespace(scaling_factor=1.0),
+            decode=lambda x, return_dict: (
+                F.interpolate(x[:, :3].clamp(-1, 1), scale_factor=8),
+            ),
+        )
+        self.vae_scale_factor = 8
+        self.image_processor = VaeImageProcessor()
+        self._execution_device = torch.device("cpu")
+        self._prepare_latents = HunyuanDiTPipeline.prepare_latents
+        self.transformer_batches = []
+        # 每次 encode_prompt 编码的文本（两个编码器各记一次）
+        self.encoded = []
+        self.transformer.register_forward_hook(
+            lambda module, args, output: self.transformer_batches.append(
+                len(args[0]) // 2
+            )
+        )
+
+    def prepare_latents(self, *args):
+        return self._prepare_latents(self, *args)
+
+    def encode_prompt(self, prompt, max_sequence_length, **kwargs):
+        def embed(text):
+            g = torch.Generator().manual_seed(sum(text.encode("utf-8")))
+            return torch.randn((1, max_sequence_length, 16), generator=g)
+
+        self.encoded.extend(prompt)
+        mask = torch.ones((len(prompt), max_sequence_length), dtype=torch.long)
+        return torch.cat([embed(text) for text in prompt]), None, mask, None
+
+    def run_safety_checker(self, image, device, dtype):
+        return image, None
+
+
+def make_prompt_cache(device_bytes: int = 1 << 20):
+    from app.models.feature_cache import FeatureCache
+
+    return FeatureCache(
+        device_bytes,
+        0,
+        sizeof=lambda v: sum(t.numel() * t.element_size() for t in v),
+        to_host=lambda v: v,
+        to_device=lambda v: v,
+        name="prompt_embeds",
+    )
+
+
+def make_continuous_service(max_running: int = 4, prompt_cache=None):
+    from app.models.continuous_batcher import ContinuousBatcher
+    from app.service.txt2img_service import HunyuanStepEngine
+
+    service = Txt2ImgService(
+        "fake-model",
+        2,
+        4,
+        50,
+        sizes=[(64, 64)],
+        continuous_batching=True,
+        prompt_cache=prompt_cache,
+    )
+    service.pipe = TinyHunyuanPipe()
+    service.device_str = "cpu"
+    service.batcher = ContinuousBatcher(
+        service.queue,
+        HunyuanStepEngine(service.pipe, "cpu", prompt_cache),
+        max_running,
+    )
+    return service
+
+
+# step 级批处理：后到的请求在 step 边界加入运行批，步数少的先完成；
+# 加入与移出不改变其它样本的结果
+@pytest.mark.asyncio
+async def test_continuous_batching_joins_running_batch():
+    import numpy as np
+
+    from app.models.progress import GenerationProgress
+
+    alone = await make_continuous_service().queued_generate("a cat", steps=10, seed=1)
+
+    service = make_continuous_service()
+    progress = GenerationProgress()
+    first = asyncio.create_task(
+        service.queued_generate("a cat", progress, steps=10, seed=1)
+    )
+    while service.pipe.transformer_batches.count(1) < 2:
+        await asyncio.sleep(0.001)
+    second = asyncio.create_task(
+        service.queued_generate("a dog", steps=2, guidance_scale=7.0, seed=2)
+    )
+    done, _ = await asyncio.wait({first, second}, return_when=asyncio.FIRST_COMPLETED)
+    assert done == {second}
+    image = await first
+
+    batches = service.pipe.transformer_batches
+    assert 2 in batches and batches[-1] == 1 and len(batches) == 10
+    assert progress.step == 10 and progress.total_steps == 10
+    diff = np.abs(np.asarray(image, np.int16) - np.asarray(alone, np.int16))
+    assert image.size == (64, 64) and diff.max() <= 1
+
+
+# 每行的 guidance 分别作用；<= 1 时只取有条件预测
+def test_guide_per_row():
+    from app.service.txt2img_service import _guide
+
+    uncond = torch.zeros((2, 1, 2, 2))
+    text = torch.ones((2, 1, 2, 2))
+    guided = _guide(torch.cat([uncond, text]), torch.tensor([3.0, 0.5]))
+    assert guided[0].eq(3.0).all() and guided[1].eq(1.0).all()
+
+
+# prompt embedding 缓存：重复的 prompt 与 negative prompt 不再运行文本编码器，
+# 生成结果与不走缓存时一致
+@pytest.mark.asyncio
+async def test_prompt_cache_skips_text_encoders():
+    import numpy as np
+
+    alone = await make_continuous_service().queued_generate("a cat", steps=2, seed=1)
+
+    cache = make_prompt_cache()
+    service = make_continuous_service(prompt_cache=cache)
+    first = await service.queued_generate("a cat", steps=2, seed=1)
+    assert service.pipe.encoded == ["", "a cat"] * 2
+    second = await service.queued_generate("a cat", steps=2, seed=1)
+    assert service.pipe.encoded == ["", "a cat"] * 2
+    await service.queued_generate("a dog", steps=2)
+    assert service.pipe.encoded == ["", "a cat"] * 2 + ["a dog"] * 2
+
+    assert np.array_equal(np.asarray(first), np.asarray(second))
+    assert np.array_equal(np.asarray(first), np.asarray(alone))
+    stats = cache.stats()
+    assert (stats["device_hits"], stats["misses"]) == (6, 6)
+
+
+# 开启缓存时 pipeline 收到的是 embedding 而不是文本；批内重复的文本只编码一次
+def test_prompt_cache_passes_embeddings_to_pipeline():
+    class RecordingPipe(TinyHunyuanPipe):
+        def __call__(self, prompt, **kwargs):
+            self.calls.append((prompt, kwargs))
+            return SimpleNamespace(images=[])
+
+    service = Txt2ImgService("fake-model", 2, 4, 50, prompt_cache=make_prompt_cache())
+    service.pipe = RecordingPipe()
+    service.pipe.calls = []
+    service.device_str = "cpu"
+    service._infer_sync(["a", "b", "a"], [None] * 3, 512, 512)
+
+    assert service.pipe.encoded == ["a", "b", ""] * 2
+    prompt, kwargs = service.pipe.calls[0]
+    assert prompt is None and "negative_prompt" not in kwargs
+    assert kwargs["prompt_embeds"].shape == (3, 77, 16)
+    assert kwargs["negative_prompt_embeds_2"].shape == (3, 256, 16)
+    assert kwargs["prompt_embeds"][0].equal(kwargs["prompt_embeds"][2])
+    assert kwargs["prompt_attention_mask_2"].shape == (3, 256)
+
+
+# 结果按请求的格式编码；缓存 key 区分格式，同一 prompt 的不同格式分别推理
+@pytest.mark.asyncio
+async def test_cached_generate_output_format():
+    cache = TieredCache(LRUCache(1 << 20))
+    service, calls = make_service(cache=cache)
+    service.output_formats = {"png": 6, "webp": 80}
+
+    png = await service.cached_generate("a cat", seed=1)
+    webp = await service.cached_generate("a cat", seed=1, output_format="webp")
+    assert png.startswith(b"\x89PNG") and webp[8:12] == b"WEBP"
+    assert await service.cached_generate("a cat", seed=1, output_format="webp") == webp
+    assert calls == [["a cat"], ["a cat"]]
+    with pytest.raises(ValueError):
+        await service.cached_generate("a cat", output_format="jpeg")
+
+
+# step 级批处理中按间隔生成 latent 预览：输出 1/8 分辨率的 WebP，不经过 VAE
+@pytest.mark.asyncio
+async def test_continuous_batching_previews():
+    from io import BytesIO
+
+    from app.models.progress import GenerationProgress
+
+    service = make_continuous_service()
+    progress = GenerationProgress(preview_every=2)
+    await service.queued_generate("a cat", progress, steps=5, seed=1)
+    await asyncio.sleep(0.01)
+
+    assert progress.preview_step == 4
+    image = Image.open(BytesIO(progress.preview))
+    assert image.format == "WEBP" and image.size == (8, 8)
+
+
+# 请求的 priority / timeout_ms 随批提交到推理队列：批取最高优先级与最晚截止时间；
+# flow 权重来自服务配置
+@pytest.mark.asyncio
+async def test_priority_and_deadline_reach_queue():
+    from app.models.infer_queue import HIGH
+
+    weighted = Txt2ImgService("fake-model", 1, 4, 50, flow_weights={"txt2img": 2.0})
+    assert weighted.queue._weights == {"txt2img": 2.0}
+
+    service, calls = make_service(batch_size=2)
+    submitted = []
+    submit = service.queue.submit
+
+    async def spy(infer_sync, **kwargs):
+        submitted.append(kwargs)
+        return await submit(infer_sync, **kwargs)
+
+    service.queue.submit = spy
+    before = time.monotonic()
+    await asyncio.gather(
+        service.cached_generate("a", priority="best_effort", timeout_ms=60000),
+        service.cached_generate("b", priority="high", timeout_ms=1000),
+    )
+    assert calls == [["a", "b"]]
+    (kwargs,) = submitted
+    assert kwargs["priority"] == HIGH
+    assert before + 59 < kwargs["deadline"] <= time.monotonic() + 60
+
+    with pytest.raises(ValueError):
+        await service.cached_generate("c", priority="urgent")
@@ -13,15 +13,16 @@ def test_ws_img2txt_success(client_img2txt, sample_png_bytes):
         ws.send_bytes(sample_png_bytes)
         ws.send_text("Describe the image")
 
-        received_texts = ""
+        frames = []
         while True:
             try:
-                received_texts += ws.receive_text()
+                frames.append(ws.receive_text())
             except WebSocketDisconnect as e:
                 assert e.code == 1000  # 正常关闭
                 break
 
-        assert len(received_texts) > 0
+        received_texts = "".join(frames)
+        assert len(frames) > 1  # 流式输出
         assert received_texts == "TEXT(Describe the image)"
 
 
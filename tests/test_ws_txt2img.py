@@ -58,3 +58,101 @@ def test_ws_txt2img_internal_error(app_txt2img):
             ws.receive_text()
         except WebSocketDisconnect as e:
             assert e.code == 1011  # Internal Error: Generation failed
+
+
+# JSON 进度帧：包含阶段、步数与各阶段耗时，最后一帧为 done
+def test_ws_txt2img_json_progress(client_txt2img):
+    import json
+
+    with client_txt2img.websocket_connect(
+        "/txt2img/ws/generate?progress_format=json"
+    ) as ws:
+        ws.send_text("a cat")
+
+        frames = []
+        while True:
+            frame = json.loads(ws.receive_text())
+            frames.append(frame)
+            if frame["phase"] == "done":
+                break
+
+        phases = [f["phase"] for f in frames]
+        assert phases[0] == "queued"
+        assert "denoising" in phases
+        assert [f["progress"] for f in frames] == sorted(f["progress"] for f in frames)
+        assert frames[-1]["progress"] == 100
+        assert frames[-1]["step"] == frames[-1]["total_steps"] == 4
+        assert set(frames[-1]["durations_ms"]) == {"queued", "denoising", "decoding"}
+        assert len(ws.receive_bytes()) > 0
+
+
+# 服务过载时以 1013 关闭连接
+def test_ws_txt2img_overloaded(client_txt2img):
+    service = client_txt2img.app.state.services["txt2img"]
+    service.admission.max_queued = 0
+
+    with client_txt2img.websocket_connect("/txt2img/ws/generate") as ws:
+        ws.send_text("a cat")
+        try:
+            while True:
+                ws.receive_text()
+        except WebSocketDisconnect as e:
+            assert e.code == 1013  # Try Again Later
+
+
+# 客户端提前断开时取消生成
+def test_ws_txt2img_disconnect_cancels(app_txt2img):
+    import asyncio
+    import time
+
+    from fastapi.testclient import TestClient
+    from tests.conftest import FakeTxt2ImgService
+
+    class RecordingService(FakeTxt2ImgService):
+        cancelled = False
+
+        async def queued_generate(self, prompt: str, progress=None, size=None):
+            try:
+                return await super().queued_generate(prompt, progress)
+            except asyncio.CancelledError:
+                RecordingService.cancelled = True
+                raise
+
+    app_txt2img.state.services["txt2img"] = RecordingService()
+    client = TestClient(app_txt2img)
+    with client.websocket_connect("/txt2img/ws/generate") as ws:
+        ws.send_text("a cat")
+        ws.receive_text()
+    for _ in range(20):
+        if RecordingService.cancelled:
+            break
+        time.sleep(0.05)
+    assert RecordingService.cancelled
+
+
+# preview_every：完成帧之前的二进制帧是 WebP 预览，之后的一帧是结果
+def test_ws_txt2img_previews(client_txt2img):
+    from io import BytesIO
+
+    from PIL import Image
+
+    with client_txt2img.websocket_connect("/txt2img/ws/generate?preview_every=1") as ws:
+        ws.send_text("a cat")
+        previews = []
+        while True:
+            message = ws.receive()
+            if message.get("text") == "100":
+                break
+            if message.get("bytes") is not None:
+                previews.append(Image.open(BytesIO(message["bytes"])))
+        assert 1 <= len(previews) <= 3
+        assert all(p.format == "WEBP" for p in previews)
+        assert Image.open(BytesIO(ws.receive_bytes())).format == "PNG"
+
+    with client_txt2img.websocket_connect(
+        "/txt2img/ws/generate?preview_every=-1"
+    ) as ws:
+        try:
+            ws.receive_text()
+        except WebSocketDisconnect as e:
+            assert e.code == 1008